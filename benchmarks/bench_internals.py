@@ -0,0 +1,219 @@
+"""
+ bench_internals.py
+ Micro-benchmarks of the model server's internal hot paths, at several
+ payload sizes:
+   pipe_round_trip - a request and its response crossing a worker pipe
+   json_flask      - decoding a request and encoding its response in
+                     executeModelMethod
+   preprocess      - ModelServer.preprocess dispatching to the model
+   import_model    - importing a model's module from its source path
+   zip_package     - Controller.recursively_add_files_to_zip over a source tree
+
+ Results are compared against a baseline file, and any benchmark more than
+ `--threshold` slower than its baseline is reported as a regression (with a
+ non-zero exit status). `--save` stores the results as the new baseline.
+ Baselines are only comparable on the machine they were recorded on.
+ No AWS access is needed.
+ Usage: python benchmarks/bench_internals.py [--save] [--threshold 0.25] [--only NAME]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Runs from a checkout without installing the package
+sys.path.insert(0, ROOT)
+
+from pressurize.model.model import PressurizeModel
+from pressurize.model.model_server_utils import import_model
+from pressurize.model.transport import SharedMemoryConnection
+
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+TEST_MODEL_DIR = os.path.join(ROOT, "tests", "test_data", "test_model_server")
+SIZES = [1024, 64 * 1024, 1024 * 1024]
+
+
+def payload(size):
+    """
+    A request body of roughly `size` bytes of JSON
+    """
+    return {"data": {"values": [0.5] * (size // 5)}}
+
+
+def measure(operation, min_time=0.2, repeat=5):
+    """
+    Returns the median over `repeat` runs of the mean time per call of
+    `operation`, each run calling it for at least `min_time` seconds.
+    """
+    operation()
+    runs = []
+    for _ in range(repeat):
+        calls = 0
+        started = time.perf_counter()
+        while True:
+            operation()
+            calls += 1
+            elapsed = time.perf_counter() - started
+            if elapsed >= min_time:
+                break
+        runs.append(elapsed / calls)
+    runs.sort()
+    return runs[len(runs) // 2]
+
+
+def echo(conn):
+    while True:
+        item = conn.recv()
+        if item is None:
+            return
+        conn.send(item)
+
+
+def bench_pipe_round_trip(size):
+    context = multiprocessing.get_context("fork")
+    parent_conn, child_conn = [SharedMemoryConnection(conn) for conn in context.Pipe()]
+    process = context.Process(target=echo, args=(child_conn,))
+    process.start()
+    child_conn.close()
+    item = {"model": "TestModel", "method": "predict", "data": payload(size),
+            "resId": "0" * 32, "timings": {"submitted": time.time()}}
+
+    def round_trip():
+        parent_conn.send(item)
+        parent_conn.recv()
+    try:
+        return measure(round_trip)
+    finally:
+        parent_conn.send(None)
+        process.join()
+        parent_conn.close()
+
+
+def bench_json_flask(size):
+    from flask import jsonify, request
+    from pressurize.model.model_server import app
+    body = json.dumps(payload(size))
+
+    def decode_encode():
+        with app.test_request_context("/api/TestModel/predict/", method="POST", data=body,
+                                      content_type="application/json"):
+            data = request.get_json()
+            jsonify({"result": data["data"]}).get_data()
+    return measure(decode_encode)
+
+
+class EchoModel(PressurizeModel):
+    def predict(self, data):
+        return data
+
+
+def bench_preprocess(size):
+    from pressurize.model.model_server import ModelServer
+    # Only the model is needed to preprocess, so skip loading resources and logging
+    server = ModelServer.__new__(ModelServer)
+    server._model = EchoModel({})
+    item = {"method": "predict", "data": payload(size), "timings": {}}
+    return measure(lambda: server.preprocess(item))
+
+
+def bench_import_model(size):
+    return measure(lambda: import_model("models.TestModel.TestModel", TEST_MODEL_DIR))
+
+
+def bench_zip_package(size):
+    from pressurize.Controller import Controller
+    # recursively_add_files_to_zip needs no configuration
+    controller = Controller.__new__(Controller)
+    source = tempfile.mkdtemp()
+    output = tempfile.mkdtemp()
+    try:
+        files = 32
+        for idx in range(files):
+            folder = os.path.join(source, "module%d" % (idx % 4))
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, "file%d.py" % idx), "wb") as f:
+                f.write(os.urandom(size // files // 2) * 2)
+
+        def package():
+            with zipfile.ZipFile(os.path.join(output, "package.zip"), "w") as package_zip:
+                controller.recursively_add_files_to_zip(source, package_zip)
+        return measure(package, repeat=3)
+    finally:
+        shutil.rmtree(source)
+        shutil.rmtree(output)
+
+
+BENCHMARKS = [
+    ("pipe_round_trip", bench_pipe_round_trip, SIZES),
+    ("json_flask", bench_json_flask, SIZES),
+    ("preprocess", bench_preprocess, SIZES),
+    ("import_model", bench_import_model, [0]),
+    ("zip_package", bench_zip_package, [64 * 1024, 1024 * 1024, 16 * 1024 * 1024]),
+]
+
+
+def run(only=None):
+    results = {}
+    for name, benchmark, sizes in BENCHMARKS:
+        if only and name not in only:
+            continue
+        for size in sizes:
+            results["%s/%d" % (name, size)] = benchmark(size)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints each result against its baseline, returning the regressions
+    """
+    regressions = []
+    print("%-26s %14s %14s %9s" % ("benchmark", "time (us)", "baseline (us)", "change"))
+    for key, seconds in results.items():
+        if key in baseline:
+            change = seconds / baseline[key] - 1
+            flag = ""
+            if change > threshold:
+                regressions.append(key)
+                flag = "  REGRESSION"
+            print("%-26s %14.1f %14.1f %+8.1f%%%s" % (key, seconds * 1e6, baseline[key] * 1e6,
+                                                     change * 100, flag))
+        else:
+            print("%-26s %14.1f %14s %9s" % (key, seconds * 1e6, "-", "-"))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="Store the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Fraction slower than the baseline that counts as a regression")
+    parser.add_argument("--only", action="append", help="Only run the named benchmark")
+    args = parser.parse_args()
+
+    results = run(args.only)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print("Saved baseline to %s" % args.baseline)
+    elif regressions:
+        print("%d regression(s) beyond %d%%: %s" % (len(regressions), args.threshold * 100,
+                                                   ", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+ bench_transport.py
+ Compares round trip times of the plain multiprocessing Pipe with the shared
+ memory transport used between the model server front end and its workers.
+ Every payload is forced through shared memory here, though the transport
+ only uses it for messages with large out-of-band buffers such as ndarrays.
+ Usage: python benchmarks/bench_transport.py [--repeat N]
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+# Runs from a checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pressurize.model.transport import SharedMemoryConnection, SHARED_MEMORY_SUPPORTED
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SIZES = [1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024, 32 * 1024 * 1024]
+
+
+def echo(conn):
+    while True:
+        item = conn.recv()
+        if item is None:
+            return
+        conn.send(item)
+
+
+def payloads(size):
+    yield "bytes", {"data": b"x" * size}
+    yield "json", {"data": {"values": [0.5] * (size // 9)}}
+    if np is not None:
+        yield "ndarray", {"data": np.ones(size // 8)}
+
+
+def round_trip(wrap, payload, repeat):
+    context = multiprocessing.get_context("fork")
+    parent_conn, child_conn = context.Pipe()
+    parent_conn, child_conn = wrap(parent_conn), wrap(child_conn)
+    process = context.Process(target=echo, args=(child_conn,))
+    process.start()
+    child_conn.close()
+    parent_conn.send(payload)
+    parent_conn.recv()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        parent_conn.send(payload)
+        parent_conn.recv()
+        timings.append(time.perf_counter() - started)
+    parent_conn.send(None)
+    process.join()
+    parent_conn.close()
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    if not SHARED_MEMORY_SUPPORTED:
+        print("Shared memory transport is not supported on this platform")
+        return
+
+    transports = [
+        ("pipe", lambda conn: conn),
+        ("shared_memory", lambda conn: SharedMemoryConnection(conn, threshold=0)),
+    ]
+    print("%-8s %10s %14s %14s %8s" % ("payload", "size", "pipe (ms)", "shm (ms)", "speedup"))
+    for size in SIZES:
+        for kind, payload in payloads(size):
+            medians = [round_trip(wrap, payload, args.repeat) for name, wrap in transports]
+            print("%-8s %10d %14.3f %14.3f %7.2fx" % (kind, size, medians[0] * 1000,
+                                                     medians[1] * 1000, medians[0] / medians[1]))
+
+
+if __name__ == '__main__':
+    main()
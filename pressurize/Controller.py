@@ -46,6 +46,7 @@ class Controller(object):
         self._aws_profile = aws_profile
         self._aws_manager = AWSManager.AWSManager(aws_profile=aws_profile)
         self._resource_manager = ResourceManager.ResourceManager(self)
+        self._deployments = None
 
     def create_resources(self, force_update=False):
         try:
@@ -61,7 +62,8 @@ class Controller(object):
     def validate_config(self, config):
         required_keys = ['deployment_name', 'aws_region', 'models']
         accepted_keys = required_keys + ['api_min_size', 'api_max_size',
-                                         'api_instance_type', 'custom_parameters']
+                                         'api_instance_type', 'custom_parameters',
+                                         'model_server', 'pack_models']
         for key in required_keys:
             if key not in config:
                 raise Exception('Config must have key %s' % key)
@@ -80,7 +82,15 @@ class Controller(object):
         accepted_keys = required_keys + ['min_size', 'max_size', 'instance_type',
                                          'required_memory', 'required_ecu',
                                          'required_resources', 'storage_gb',
-                                         'custom_parameters'
+                                         'custom_parameters', 'workers',
+                                         'min_batch_time', 'max_batch_time',
+                                         'max_batch_size', 'shared_memory_threshold',
+                                         'cache_methods', 'cache_size_mb', 'cache_ttl',
+                                         'max_queue_size', 'max_queue_size_by_method',
+                                         'request_timeout', 'request_timeout_by_method',
+                                         'caller_weights', 'spare_workers', 'worker_timeout',
+                                         'lazy', 'deployment', 'extract_resources',
+                                         'lazy_resources', 'prefetch_resources'
         ]
         for key in model:
             if key not in accepted_keys:
@@ -112,6 +122,64 @@ class Controller(object):
         new_config['models'] = list(filter(lambda x: x['name'] == model_name, new_config['models']))
         return new_config
 
+    def deployments(self):
+        """
+        The elastic beanstalk environments the models are deployed to. With
+        `pack_models` set, small models share environments.
+        """
+        if self._deployments is None:
+            self._deployments = self._resource_manager.plan_deployments(
+                self.config['models'], pack=self.config.get('pack_models', False))
+        return self._deployments
+
+    def deployment(self, deployment_name):
+        for deployment in self.deployments():
+            if deployment['name'] == deployment_name:
+                return deployment
+        raise Exception('No deployment named %s' % deployment_name)
+
+    def deployment_for(self, model_name):
+        """
+        Returns the deployment serving the given model
+        """
+        for deployment in self.deployments():
+            if model_name in deployment['models']:
+                return deployment
+        raise Exception('Model %s not found in config' % model_name)
+
+    def packing_report(self):
+        """
+        Describes each deployment's instances and models, and compares their
+        cost with one environment per model
+        """
+        unpacked = self._resource_manager.plan_deployments(self.config['models'])
+        return self._resource_manager.format_deployments(self.deployments(), unpacked)
+
+    def api_config(self):
+        """
+        Returns a copy of the current config in which every model names the
+        deployment serving it, so that the API can route requests to it
+        """
+        new_config = {}
+        for k in self.config:
+            new_config[k] = self.config[k]
+        new_config['models'] = []
+        for model in self.config['models']:
+            model = dict(model)
+            model['deployment'] = self.deployment_for(model['name'])['name']
+            new_config['models'].append(model)
+        return new_config
+
+    def deployment_config(self, deployment_name):
+        """
+        Returns a copy of the API config, excluding all models except those
+        in the given deployment. Used for deployment to model servers.
+        """
+        new_config = self.api_config()
+        models = self.deployment(deployment_name)['models']
+        new_config['models'] = list(filter(lambda x: x['name'] in models, new_config['models']))
+        return new_config
+
     def create_api_package(self):
         """
         Creates a zip package deployable to elastic beanstalk for the pressurize API
@@ -130,16 +198,17 @@ class Controller(object):
             # Write the custom config for this particular model server
             tmpfile = '/tmp/custom_api_config.json'
             with open(tmpfile, 'w') as f:
-                json.dump(self.config, f)
+                json.dump(self.api_config(), f)
             zipfile.write(tmpfile, 'pressurize.json')
         return filename
 
-    def create_model_package(self, source_path, model_name):
+    def create_model_package(self, source_path, deployment_name):
         """
-        Creates a zip package deployable to elastic beanstalk for the given model
+        Creates a zip package deployable to elastic beanstalk for the given
+        deployment. A deployment of a single model is named after the model.
         """
         template_dir = "/" + os.path.join(*(__file__.split("/")[:-1] + ["model", "deploy_template"]))
-        filename = "deploy_model_%s.zip" % model_name
+        filename = "deploy_model_%s.zip" % deployment_name
         target = os.path.join(os.getcwd(), filename)
         try:
             os.remove(target)
@@ -151,7 +220,7 @@ class Controller(object):
             self.recursively_add_files_to_zip(source_path, zipfile)
 
             # Write the custom config for this particular model server
-            custom_config = self.custom_config(model_name)
+            custom_config = self.deployment_config(deployment_name)
             tmpfile = '/tmp/custom_config.json'
             with open(tmpfile, 'w') as f:
                 json.dump(custom_config, f)
@@ -205,12 +274,12 @@ class Controller(object):
         """
         packagefile = self.create_api_package()
         print("Created API elastic beanstalk package ", packagefile)
-        bucket_name = self._resource_manager.elastic_beanstalk_bucket()
-        manager = ElasticBeanstalkManager(self._aws_manager)
-        manager.upload_package(bucket_name, os.path.join(os.getcwd(), packagefile), packagefile)
         cluster = self._resource_manager.create_api_cluster(packagefile)
         if dry_run:
             return cluster.cloud_formation_template()
+        bucket_name = self._resource_manager.elastic_beanstalk_bucket()
+        manager = ElasticBeanstalkManager(self._aws_manager)
+        manager.upload_package(bucket_name, os.path.join(os.getcwd(), packagefile), packagefile)
         try:
             cluster.blocking_deploy(verbose=True)
         except botocore.exceptions.ClientError as e:
@@ -222,16 +291,24 @@ class Controller(object):
 
     def deploy_model(self, source_path, model_name, blocking=True, dry_run=False):
         """
-        Deploys an elastic beanstalk environment for the given model
+        Deploys the elastic beanstalk environment serving the given model,
+        along with any models it shares the environment with
         """
-        packagefile = self.create_model_package(source_path, model_name)
+        return self.deploy_deployment(source_path, self.deployment_for(model_name)['name'],
+                                      blocking=blocking, dry_run=dry_run)
+
+    def deploy_deployment(self, source_path, deployment_name, blocking=True, dry_run=False):
+        """
+        Deploys the elastic beanstalk environment for the given deployment
+        """
+        packagefile = self.create_model_package(source_path, deployment_name)
         print("Created model elastic beanstalk package ", source_path, packagefile)
+        cluster = self._resource_manager.create_model_cluster(packagefile, deployment_name)
+        if dry_run:
+            return cluster.cloud_formation_template()
         bucket_name = self._resource_manager.elastic_beanstalk_bucket()
         manager = ElasticBeanstalkManager(self._aws_manager)
         manager.upload_package(bucket_name, os.path.join(os.getcwd(), packagefile), packagefile)
-        cluster = self._resource_manager.create_model_cluster(packagefile, model_name)
-        if dry_run:
-            return cluster.cloud_formation_template()
         try:
             if blocking:
                 cluster.blocking_deploy()
@@ -250,10 +327,13 @@ class Controller(object):
     def deploy_models(self, source_path=None, dry_run=False):
         if source_path is None:
             source_path = os.getcwd()
+        print(self.packing_report())
         res = []
-        for model in self.models:
-            print("Deploying model %s" % model)
-            res.append(self.deploy_model(source_path, model, blocking=False, dry_run=dry_run))
+        for deployment in self.deployments():
+            print("Deploying %s with model(s) %s" % (deployment['name'],
+                                                    ", ".join(deployment['models'])))
+            res.append(self.deploy_deployment(source_path, deployment['name'],
+                                              blocking=False, dry_run=dry_run))
         return res
 
     def destroy_api_cluster(self):
@@ -289,12 +369,14 @@ class Controller(object):
 
     def destroy_model_cluster(self, model_name):
         """
-        Destroys the elastic beanstalk environment for the given model
+        Destroys the elastic beanstalk environment serving the given model,
+        which also serves any models sharing it
         """
-        filename = "deploy_model_%s.zip" % model_name
-        cluster = self._resource_manager.create_model_cluster(filename, model_name)
+        deployment = self.deployment_for(model_name)
+        filename = "deploy_model_%s.zip" % deployment['name']
+        cluster = self._resource_manager.create_model_cluster(filename, deployment['name'])
         cluster.blocking_delete(verbose=True)
-        print("Destroyed cluster for model " % model_name)
+        print("Destroyed cluster for model(s) %s" % ", ".join(deployment['models']))
 
 class MyEncoder(json.JSONEncoder):
     def default(self, obj):
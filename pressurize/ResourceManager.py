@@ -1,5 +1,6 @@
 import json
 import csv
+import hashlib
 import random
 from collections import OrderedDict
 
@@ -10,6 +11,11 @@ from redleader.util import sanitize
 import redleader.resources as r
 
 import pressurize.AWSManager
+from pressurize.model.model_server_utils import parse_s3_url
+
+# Hourly cost of an environment's load balancer, which instance_types.csv omits
+LOAD_BALANCER_HOURLY_COST = 0.025
+DEFAULT_INSTANCE_TYPE = 't2.micro'
 
 class ResourceManager(object):
     """
@@ -83,11 +89,12 @@ class ResourceManager(object):
         for resource_name in model["required_resources"]:
             resource = model["required_resources"][resource_name]
             if("s3://" in resource):
-                parts = resource.split("//")
-                if len(parts) < 3:
+                try:
+                    bucket = parse_s3_url(resource)[1]
+                except ValueError:
                     raise RuntimeError("Invalid s3 url in configuration: %s" % resource)
-                print("S3 Bucket Resource:", parts[2])
-                bucket_names[parts[2]] = True
+                print("S3 Bucket Resource:", bucket)
+                bucket_names[bucket] = True
             if("dynamodb://" in resource):
                 parts = resource.split("//")
                 if len(parts) < 2:
@@ -160,13 +167,15 @@ class ResourceManager(object):
 
     def elastic_beanstalk_model_resources(self, name, version, source_file, config_options):
         """
-        Create RedLeader resources for a single elastic beanstalk model deployment
+        Create RedLeader resources for a single elastic beanstalk model deployment,
+        which may serve several models
         """
         context = self._aws_context
         app = ElasticBeanstalkAppResource(context, self.prefix_name(sanitize(name)))
         cname_prefix = self.cname_prefix(name)
-        model_config = self._controller.models[name]
-        model_resources = self.model_resources(context, model_config)
+        model_resources = []
+        for model_name in self._controller.deployment(name)['models']:
+            model_resources += self.model_resources(context, self._controller.models[model_name])
         permission_resources = list(map(lambda x: r.ReadWritePermission(x), model_resources))
         version = ElasticBeanstalkAppVersionResource(
             context,
@@ -252,20 +261,32 @@ class ResourceManager(object):
                 })
         return instance_types
 
+    def load_instance_types(self):
+        if not hasattr(self, 'instance_types'):
+            path = "/" + os.path.join(*(__file__.split("/")[:-1] + ["instance_types.csv"]))
+            self.instance_types = self.read_instance_types(path)
+        return self.instance_types
+
+    def instance_type(self, name):
+        for instance in self.load_instance_types():
+            if instance['name'] == name:
+                return instance
+        # Still deployable, but its capacity and cost are unknown
+        print("Instance type %s is not in instance_types.csv" % name)
+        return {"name": name, "ecu": 0, "memory": 0, "cost": 0}
+
     def determine_instance_type(self, required_ecu, required_memory):
         """
         Find the least expensive EC2 instance that meets the provided
         ECU and memory requirements
         """
-        if not hasattr(self, 'instance_types'):
-            path = "/" + os.path.join(*(__file__.split("/")[:-1] + ["instance_types.csv"]))
-            self.instance_types = self.read_instance_types(path)
-
         candidates = []
-        for instance_idx in range(len(self.instance_types)):
-            instance = self.instance_types[instance_idx]
+        for instance in self.load_instance_types():
             if instance['memory'] > required_memory and instance['ecu'] > required_ecu:
                 candidates.append(instance)
+        if not candidates:
+            raise RuntimeError("No instance type has more than %s ECU and %sGB of memory" %
+                               (required_ecu, required_memory))
         lwm = candidates[0]['cost']
         least_expensive = candidates[0]
         for candidate in candidates:
@@ -274,39 +295,160 @@ class ResourceManager(object):
                 lwm = candidate['cost']
         return least_expensive
 
-    def create_model_cluster(self, source_file, model_name, min_size=1, max_size=2):
+    def _deployment(self, name, models, instance_type):
+        return {
+            "name": name,
+            "models": [model['name'] for model in models],
+            "instance_type": instance_type['name'],
+            "min_size": models[0].get('min_size', 1),
+            "max_size": models[0].get('max_size', 2),
+            "storage_gb": max(model.get('storage_gb', 16) for model in models),
+            "required_ecu": sum(model.get('required_ecu', 0) for model in models),
+            "required_memory": sum(model.get('required_memory', 0) for model in models),
+            "ecu": instance_type['ecu'],
+            "memory": instance_type['memory'],
+            "hourly_cost": self._hourly_cost(models, instance_type)
+        }
+
+    def _packed_instance_type(self, models):
         """
-        Create a pressurize model cluster based on the Controller's config.
+        The cheapest instance type with room for all of `models`, or None
+        """
+        try:
+            return self.determine_instance_type(sum(model['required_ecu'] for model in models),
+                                                sum(model['required_memory'] for model in models))
+        except RuntimeError:
+            return None
 
-        InstanceType for this elasticbeanstalk deployment is determined by
-         1) `required_ecu` and `required_memory` parameters.
-         2) `instance_type` property
+    def _hourly_cost(self, models, instance_type):
+        return instance_type['cost'] * int(models[0].get('min_size', 1)) + LOAD_BALANCER_HOURLY_COST
+
+    def _shared_name(self, group, taken):
+        """
+        Names a shared environment "shared" followed by a hash of its sorted
+        model names, so that it keeps its name for as long as it serves the
+        same models. The hash is lengthened until the name differs from every
+        name in `taken`.
+        """
+        members = ",".join(sorted(model['name'] for model in group))
+        digest = hashlib.sha1(members.encode("utf-8")).hexdigest()
+        for length in range(8, len(digest) + 1):
+            name = "shared" + digest[:length]
+            if sanitize(name) not in taken:
+                return name
+        raise RuntimeError("No environment name available for models %s" % members)
+
+    def plan_deployments(self, models, pack=False):
+        """
+        Groups models into the elastic beanstalk environments that will serve
+        them, returning a list of deployments. A model's instance type is
+        determined as for create_model_cluster.
+
+        With `pack`, models with `required_ecu` and `required_memory` and the
+        same `min_size` and `max_size` are packed into shared environments.
+        Models are placed largest first, each into the environment where it
+        saves the most cost compared with an environment of its own, on the
+        cheapest instance type with room for every model in the environment.
+        Models with an explicit `instance_type` are never packed.
+        Single model environments are named after their model, and shared
+        environments after their models (see _shared_name).
+        """
+        deployments = []
+        packable = []
+        for model in models:
+            if pack and 'instance_type' not in model and 'required_ecu' in model and \
+               'required_memory' in model:
+                packable.append(model)
+            elif 'instance_type' in model:
+                deployments.append(self._deployment(model['name'], [model],
+                                                    self.instance_type(model['instance_type'])))
+            elif 'required_ecu' in model:
+                deployments.append(self._deployment(model['name'], [model],
+                                                    self.determine_instance_type(
+                                                        model['required_ecu'],
+                                                        model['required_memory'])))
+            else:
+                deployments.append(self._deployment(model['name'], [model],
+                                                    self.instance_type(DEFAULT_INSTANCE_TYPE)))
+
+        groups = []
+        for model in sorted(packable, key=lambda model: (-model['required_memory'],
+                                                          -model['required_ecu'])):
+            alone = self._hourly_cost([model], self.determine_instance_type(
+                model['required_ecu'], model['required_memory']))
+            best, best_saving = None, 0
+            for group in groups:
+                if (group[0].get('min_size', 1), group[0].get('max_size', 2)) != \
+                   (model.get('min_size', 1), model.get('max_size', 2)):
+                    continue
+                instance_type = self._packed_instance_type(group + [model])
+                if instance_type is None:
+                    continue
+                saving = self._hourly_cost(group, self._packed_instance_type(group)) + alone - \
+                         self._hourly_cost(group, instance_type)
+                if saving > best_saving:
+                    best, best_saving = group, saving
+            if best is None:
+                groups.append([model])
+            else:
+                best.append(model)
+        taken = set(sanitize(model['name']) for model in models)
+        for group in groups:
+            name = group[0]['name']
+            if len(group) > 1:
+                name = self._shared_name(group, taken)
+                taken.add(sanitize(name))
+            deployments.append(self._deployment(name, group, self._packed_instance_type(group)))
+        return deployments
+
+    def format_deployments(self, deployments, unpacked=None):
+        """
+        Formats a packing report of planned deployments, comparing their cost
+        with the `unpacked` deployments if given
+        """
+        lines = ["%-16s %-13s %9s %13s %13s %8s  %s" % (
+            "Environment", "Instance type", "Instances", "Memory (GB)", "ECU", "$/hour", "Models")]
+        for deployment in deployments:
+            lines.append("%-16s %-13s %9s %13s %13s %8.3f  %s" % (
+                deployment['name'], deployment['instance_type'], deployment['min_size'],
+                "%g/%g" % (deployment['required_memory'], deployment['memory']),
+                "%g/%g" % (deployment['required_ecu'], deployment['ecu']),
+                deployment['hourly_cost'], ", ".join(deployment['models'])))
+        total = sum(deployment['hourly_cost'] for deployment in deployments)
+        summary = "%d environment(s) for %d model(s), $%.3f/hour" % (
+            len(deployments), sum(len(deployment['models']) for deployment in deployments), total)
+        if unpacked is not None:
+            summary += " ($%.3f/hour with one environment per model)" % sum(
+                deployment['hourly_cost'] for deployment in unpacked)
+        lines.append(summary)
+        return "\n".join(lines)
+
+    def create_model_cluster(self, source_file, deployment_name):
+        """
+        Create a pressurize model cluster for one of the Controller's planned
+        deployments (see plan_deployments). A deployment of a single model is
+        named after the model.
+
+        InstanceType for a single model deployment is determined by
+         1) `instance_type` property
+         2) `required_ecu` and `required_memory` parameters.
          3)  Defaults to t2.micro
         """
 
-        cluster = Cluster(sanitize(self._cluster_name() + model_name), self._aws_context)
+        cluster = Cluster(sanitize(self._cluster_name() + deployment_name), self._aws_context)
         version = str(random.randint(0, 100000))
 
-        model_config = self._controller.models[model_name]
-
-        # Determine instance type
-        instance_type = 't2.micro'
-        if 'required_ecu' in model_config:
-            instance_type = self.determine_instance_type(
-                model_config['required_ecu'],
-                model_config['required_memory'])['name']
-            print("Determined instance type: ", instance_type)
-        if 'instance_type' in model_config:
-            instance_type = model_config['instance_type']
+        deployment = self._controller.deployment(deployment_name)
+        print("Instance type for %s: %s" % (deployment_name, deployment['instance_type']))
 
         config_options = {
             "aws:autoscaling:asg": {
-                "MinSize": str(model_config.get('min_size', min_size)),
-                "MaxSize": str(model_config.get('max_size', max_size))
+                "MinSize": str(deployment['min_size']),
+                "MaxSize": str(deployment['max_size'])
             },
             "aws:autoscaling:launchconfiguration": {
-                "InstanceType": instance_type,
-                "RootVolumeSize": str(model_config.get('storage_gb', 16)),
+                "InstanceType": deployment['instance_type'],
+                "RootVolumeSize": str(deployment['storage_gb']),
                 "BlockDeviceMappings": "/dev/xvdcz=:128:true"
             },
             "aws:elasticbeanstalk:command": {
@@ -333,7 +475,7 @@ class ResourceManager(object):
                 "RetentionInDays": 30
             }
         }
-        resources = self.elastic_beanstalk_model_resources(model_name,
+        resources = self.elastic_beanstalk_model_resources(deployment_name,
                                                            version,
                                                            source_file,
                                                            config_options)
@@ -26,6 +26,7 @@ type Model struct {
 	MinBatchTime *int `json:"min_batch_time,omitempty"`
 	MaxBatchTime *int `json:"max_batch_time,omitempty"`
 	MaxBatchSize *int `json:"max_batch_size,omitempty"`
+	Deployment string `json:"deployment,omitempty"`
 }
 
 type PressurizeConfig struct {
@@ -76,7 +77,12 @@ func GetModelURL(model_name string) string {
 	if model_host != "" {
 		return model_host
 	}
-	return "http://" + Sanitize(config.DeploymentName) + "-" + model_name + "." +
+	// Models packed into a shared environment are served by that environment
+	deployment := model_name
+	if model, ok := models[model_name]; ok && model.Deployment != "" {
+		deployment = model.Deployment
+	}
+	return "http://" + Sanitize(config.DeploymentName) + "-" + deployment + "." +
 		config.AWSRegion + ".elasticbeanstalk.com"
 }
 
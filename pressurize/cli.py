@@ -152,11 +152,100 @@ def local(ctx, model_name, port, docker, aws_profile):
         raise click.Abort()
     controller.run_local(model_name, port=port, docker=docker)
 
+@cli.command(name="batch-predict")
+@click.pass_context
+@click.argument("model_name")
+@click.argument("method")
+@click.option("--input", "input_path", required=True,
+              help='JSON lines file with one request per line')
+@click.option("--output", "output_path", required=True,
+              help='JSON lines file to write results to, in input order')
+@click.option("--processes", default=None, type=int,
+              help='Number of worker processes (default: one per CPU)')
+@click.option("--batch-size", default=None, type=int,
+              help='Requests per batch (default: the model\'s max_batch_size or 100)')
+def batch_predict(ctx, model_name, method, input_path, output_path, processes, batch_size):
+    if ctx.obj['config_file'] not in os.listdir(ctx.obj['project_dir']):
+        click.echo('No pressurize.json file found in directory')
+        raise click.Abort()
+
+    print("Config path", os.path.join(ctx.obj['project_dir'], ctx.obj['config_file']))
+    with open(os.path.join(ctx.obj['project_dir'], ctx.obj['config_file']), 'r') as f:
+        config = json.load(f)
+    from pressurize.model.batch_predict import batch_predict
+    try:
+        batch_predict(config, model_name, method, input_path, output_path,
+                      source_path=ctx.obj['project_dir'], resource_path=ctx.obj['project_dir'],
+                      processes=processes, batch_size=batch_size)
+    except RuntimeError as e:
+        click.echo('Error: %s' % e)
+        raise click.Abort()
+
+@cli.command()
+@click.pass_context
+@click.argument("model_name")
+@click.argument("method")
+@click.option("--payloads", required=True,
+              help='JSON lines file of request bodies to send, in turn')
+@click.option("--url", default=None,
+              help='Model server to target, e.g. http://localhost:5000. '
+                   'By default a local model server is started for the model.')
+@click.option("--port", default=5055, help='Port for the local model server')
+@click.option("--resource", "resources", multiple=True,
+              help='Use a local file for a required resource, as NAME=PATH')
+@click.option("--concurrency", default="1,2,4,8,16,32",
+              help='Comma separated concurrency levels to sweep')
+@click.option("--rate", default=None,
+              help='Comma separated request rates (per second) to sweep instead')
+@click.option("--duration", default=10.0, help='Seconds to measure each level for')
+@click.option("--warmup", default=1.0, help='Seconds to run each level before measuring')
+@click.option("--json", "json_path", default=None, help='Write results as JSON to this file')
+def bench(ctx, model_name, method, payloads, url, port, resources, concurrency, rate,
+          duration, warmup, json_path):
+    from pressurize.model import bench as model_bench
+    server = None
+    if url is None:
+        if ctx.obj['config_file'] not in os.listdir(ctx.obj['project_dir']):
+            click.echo('No pressurize.json file found in directory')
+            raise click.Abort()
+        with open(os.path.join(ctx.obj['project_dir'], ctx.obj['config_file']), 'r') as f:
+            config = json.load(f)
+        config['models'] = [model for model in config['models'] if model['name'] == model_name]
+        if len(config['models']) == 0:
+            click.echo("Model %s not found in config" % model_name)
+            raise click.Abort()
+        for resource in resources:
+            name, _, path = resource.partition("=")
+            config['models'][0].setdefault('required_resources', {})[name] = os.path.abspath(path)
+
+        import pressurize.model.model_server as model_server
+        url = "http://localhost:%s" % port
+        server = model_server.run_server(config, source_path=ctx.obj['project_dir'],
+                                         resource_path=ctx.obj['project_dir'],
+                                         port=str(port), separate_process=True)
+    try:
+        model_bench.wait_for_server(url)
+        results = model_bench.bench(
+            "%s/api/%s/%s/" % (url.rstrip("/"), model_name, method),
+            model_bench.load_payloads(payloads),
+            concurrency=[int(level) for level in concurrency.split(",")],
+            rates=[float(level) for level in rate.split(",")] if rate else None,
+            duration=duration, warmup=warmup)
+    finally:
+        for process in (server if isinstance(server, list) else [server] if server else []):
+            process.terminate()
+            process.join()
+    if json_path is not None:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=4)
+
 @cli.command(name="dry-run")
 @click.option('--aws-profile', default=None,
               help='AWS Profile to use for cluster commands')
+@click.option('--report-only', is_flag=True, default=False,
+              help='Only print how models are packed into environments')
 @click.pass_context
-def dry_run(ctx, aws_profile):
+def dry_run(ctx, aws_profile, report_only):
     if ctx.obj['config_file'] not in os.listdir(ctx.obj['project_dir']):
         click.echo('No pressurize.json file found in directory')
         raise click.Abort()
@@ -169,6 +258,9 @@ def dry_run(ctx, aws_profile):
     except Exception as e:
         click.echo('Error with config: %s' % e)
         raise click.Abort()
+    if report_only:
+        print(controller.packing_report())
+        return
     print(json.dumps(controller.deploy_api(dry_run=True), indent=4))
     print(json.dumps(controller.deploy_models(dry_run=True), indent=4))
 
@@ -195,6 +287,24 @@ def create_token(ctx, aws_profile, token_lifetime_in_hours):
     print("----- Generated Token ------")
     print(json.dumps(token, indent=4))
 
+@cli.command(name="flatten-resource")
+@click.argument("source")
+@click.option("--target", default=None,
+              help='Path to write to, without extension (default: the source path)')
+@click.option("--dtype", default=None,
+              help='NumPy dtype to convert arrays to, e.g. float32')
+def flatten_resource(source, target, dtype):
+    """
+    Converts a resource into .npy files that models can memory map
+    """
+    from pressurize.model.resources import flatten
+    try:
+        result = flatten(source, target, dtype)
+    except (ValueError, IOError) as e:
+        click.echo("Failed to flatten %s: %s" % (source, e))
+        raise click.Abort()
+    print(json.dumps(result, indent=4))
+
 
 def main():
     cli(obj={})
@@ -0,0 +1,162 @@
+"""
+ activation.py
+ Loads lazy models on their first request, and evicts idle ones to keep the
+ model workers within a memory budget.
+
+ A lazy model's workers are only started when a request for it arrives, and
+ each worker loads the model itself, so that all of the model's memory is
+ released when it is evicted and its workers exit. Requests wait in the
+ workers' pipes while the model loads.
+
+ Before a lazy model is started, its `required_memory` (GiB across all of its
+ workers, as when packing models into environments) is reserved against
+ `memory_budget_gb`, evicting idle lazy models (those with no requests
+ outstanding) in least recently used order to make room. If there is still
+ not enough room the request is rejected as overloaded. A monitor thread
+ evicts idle models the same way whenever the workers' measured memory goes
+ over the budget. Models that are loaded at startup count towards the budget
+ but are never evicted.
+
+ Worker memory is measured as proportional set size where the kernel reports
+ it, so that pages shared copy-on-write between workers are only counted once.
+"""
+
+import collections
+import os
+import threading
+import time
+
+from .dispatcher import OverloadedError
+
+GIB = 1024 ** 3
+# Models used more recently than this are not evicted, so that a request's
+# model is not evicted between activating it and sending the request
+MIN_IDLE = 1
+RETRY_AFTER = 1
+
+
+def process_memory(pid):
+    """
+    Bytes of memory used by a process: its proportional set size, or its
+    resident set size where that is not available, or 0 once it has exited
+    """
+    try:
+        with open("/proc/%d/smaps_rollup" % pid) as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    try:
+        with open("/proc/%d/statm" % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, ValueError, IndexError):
+        return 0
+
+
+class ActivationManager(object):
+    def __init__(self, supervisors, memory_budget=None, interval=1):
+        """
+        `supervisors` maps the names of running models to their Supervisors,
+        and `memory_budget` is in bytes.
+        """
+        self.supervisors = supervisors
+        self.memory_budget = memory_budget
+        self.interval = interval
+        self.activations = collections.Counter()
+        self.evictions = collections.Counter()
+        self._models = {}
+        # Running lazy models, least recently used first, with when they were used
+        self._active = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def register(self, name, start, stop, required_memory=0):
+        """
+        Registers a lazy model. `start` starts its workers, `stop` stops them,
+        and `required_memory` is the bytes its workers are expected to use.
+        """
+        self._models[name] = (start, stop, required_memory)
+
+    def is_lazy(self, name):
+        return name in self._models
+
+    def start(self):
+        if self.memory_budget is None:
+            return
+        thread = threading.Thread(target=self._run, name="activation-monitor")
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with self._lock:
+                    self._make_room(0)
+            except Exception as e:
+                print("Failed to check model memory usage: %s" % e)
+
+    def activate(self, name):
+        """
+        Marks a lazy model as used, starting its workers if it is not running.
+        Raises OverloadedError if there is not enough memory to start it.
+        """
+        with self._lock:
+            if name not in self._active:
+                start, stop, required_memory = self._models[name]
+                if not self._make_room(required_memory):
+                    raise OverloadedError("Not enough memory to load model %s" % name,
+                                          RETRY_AFTER)
+                print("Activating model %s" % name)
+                start()
+                self.activations[name] += 1
+            self._active[name] = time.time()
+            self._active.move_to_end(name)
+
+    def evict(self, name):
+        with self._lock:
+            print("Evicting model %s" % name)
+            del self._active[name]
+            self._models[name][1]()
+            self.evictions[name] += 1
+
+    def model_memory(self, name):
+        supervisor = self.supervisors.get(name)
+        measured = sum(process_memory(pid) for pid in supervisor.pids()) if supervisor else 0
+        if name in self._models:
+            # Workers use little memory until they have loaded the model
+            return max(measured, self._models[name][2])
+        return measured
+
+    def usage(self):
+        """
+        Bytes of memory used by the workers of every running model
+        """
+        return sum(self.model_memory(name) for name in list(self.supervisors))
+
+    def _idle(self, name):
+        supervisor = self.supervisors.get(name)
+        if time.time() - self._active[name] < MIN_IDLE:
+            return False
+        if supervisor is None:
+            return True
+        # Streamed responses are complete as soon as they start, but stay in
+        # flight until their last message
+        return supervisor.dispatcher.outstanding() == 0 and supervisor.dispatcher.in_flight() == 0
+
+    def _make_room(self, required_memory):
+        """
+        Evicts idle lazy models, least recently used first, until
+        `required_memory` more bytes fit within the budget. Returns whether
+        they fit.
+        """
+        if self.memory_budget is None:
+            return True
+        usage = self.usage()
+        for name in list(self._active):
+            if usage + required_memory <= self.memory_budget:
+                break
+            if self._idle(name):
+                usage -= self.model_memory(name)
+                self.evict(name)
+        return usage + required_memory <= self.memory_budget
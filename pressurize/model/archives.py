@@ -0,0 +1,162 @@
+"""
+ archives.py
+ Extracts archived resources while they download.
+
+ An archive is read from S3 sequentially, with the next parts fetched ahead by
+ concurrent ranged GETs, and is decompressed and unpacked as its bytes arrive.
+ The archive itself is never written to disk, and downloading overlaps with
+ decompression, so a resource is ready in about the longer of the two rather
+ than their sum.
+
+ Tar archives (.tar, optionally compressed as .tar.gz/.tgz, .tar.bz2, .tar.xz
+ or .tar.zst/.tzst) are extracted to a directory, and other compressed files
+ (.gz, .bz2, .xz, .zst) are decompressed to a file. Zstandard needs the
+ zstandard package.
+"""
+
+import bz2
+import collections
+import gzip
+import io
+import lzma
+import os
+import shutil
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+# (suffix, compression, whether it is a tar archive), longest suffixes first
+ARCHIVE_FORMATS = [
+    (".tar.gz", "gz", True), (".tgz", "gz", True),
+    (".tar.bz2", "bz2", True), (".tbz2", "bz2", True),
+    (".tar.xz", "xz", True), (".txz", "xz", True),
+    (".tar.zst", "zst", True), (".tzst", "zst", True),
+    (".tar", None, True),
+    (".gz", "gz", False), (".bz2", "bz2", False), (".xz", "xz", False), (".zst", "zst", False)
+]
+STREAM_CHUNKSIZE = 8 * 1024 * 1024
+
+
+def archive_format(key):
+    """
+    Returns the (suffix, compression, is_tar) of an archive's key, or None
+    """
+    for archive in ARCHIVE_FORMATS:
+        if key.lower().endswith(archive[0]):
+            return archive
+    return None
+
+
+def extracted_name(key):
+    """
+    The name of an archive's extracted directory or file
+    """
+    name = os.path.basename(key)
+    return name[:-len(archive_format(key)[0])] or name
+
+
+class RangedReader(io.RawIOBase):
+    """
+    Reads an S3 object sequentially, fetching up to `concurrency` parts of
+    `chunksize` bytes ahead with ranged GETs. `callback` is called with the
+    size of each part as it arrives.
+    """
+    def __init__(self, client, bucket, key, size, etag=None, chunksize=STREAM_CHUNKSIZE,
+                 concurrency=8, callback=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.chunksize = chunksize
+        self.concurrency = concurrency
+        self.callback = callback
+        self._executor = ThreadPoolExecutor(max_workers=concurrency,
+                                            thread_name_prefix="ranged-get")
+        self._parts = collections.deque()
+        self._offset = 0
+        self._buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def _fetch(self, start):
+        args = {"Bucket": self.bucket, "Key": self.key,
+                "Range": "bytes=%d-%d" % (start, min(start + self.chunksize, self.size) - 1)}
+        if self.etag:
+            # Fail rather than mix parts of two versions of the object
+            args["IfMatch"] = self.etag
+        data = self.client.get_object(**args)["Body"].read()
+        if self.callback is not None:
+            self.callback(len(data))
+        return data
+
+    def _fill(self):
+        while len(self._parts) < self.concurrency and self._offset < self.size:
+            self._parts.append(self._executor.submit(self._fetch, self._offset))
+            self._offset += self.chunksize
+
+    def readinto(self, b):
+        if not self._buffer:
+            self._fill()
+            if not self._parts:
+                return 0
+            self._buffer = memoryview(self._parts.popleft().result())
+            self._fill()
+        count = min(len(b), len(self._buffer))
+        b[:count] = self._buffer[:count]
+        self._buffer = self._buffer[count:]
+        return count
+
+    def close(self):
+        for part in self._parts:
+            part.cancel()
+        self._executor.shutdown(wait=False)
+        super(RangedReader, self).close()
+
+
+def decompressed(stream, compression):
+    """
+    A readable stream of the decompressed contents of `stream`
+    """
+    if compression is None:
+        return stream
+    if compression == "gz":
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    if compression == "bz2":
+        return bz2.BZ2File(stream, mode="rb")
+    if compression == "xz":
+        return lzma.LZMAFile(stream, mode="rb")
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("The zstandard package is needed to extract .zst resources")
+    return zstandard.ZstdDecompressor().stream_reader(stream)
+
+
+def extract(stream, key, path):
+    """
+    Decompresses the archive `key` from a readable stream, extracting it into
+    the directory `path` if it is a tar archive, or else writing it to the
+    file `path`
+    """
+    suffix, compression, is_tar = archive_format(key)
+    source = decompressed(io.BufferedReader(stream, STREAM_CHUNKSIZE), compression)
+    try:
+        if not is_tar:
+            with open(path, "wb") as f:
+                shutil.copyfileobj(source, f, STREAM_CHUNKSIZE)
+            return
+        os.makedirs(path)
+        # Stream mode reads members in order, without seeking back
+        with tarfile.open(fileobj=source, mode="r|") as archive:
+            if hasattr(tarfile, "data_filter"):
+                archive.extractall(path, filter="data")
+            else:
+                for member in archive:
+                    target = os.path.realpath(os.path.join(path, member.name))
+                    if not target.startswith(os.path.realpath(path) + os.sep) or \
+                       member.issym() or member.islnk():
+                        raise RuntimeError("Refusing to extract %s from %s" % (member.name, key))
+                    archive.extract(member, path)
+    finally:
+        source.close()
@@ -0,0 +1,218 @@
+"""
+ async_server.py
+ A small asyncio HTTP/1.1 server used as the production front end of the
+ model server.
+
+ Connections are kept alive between requests and every request is handled by
+ a coroutine, so waiting on model workers never ties up a thread. Several
+ front end processes can share a port via SO_REUSEPORT.
+
+ The server knows nothing about models: `handler` is a coroutine receiving an
+ HTTPRequest and returning (status, headers, body), where body is either bytes
+ or an async iterator of bytes sent with chunked transfer encoding. Errors
+ raised by `handler` are logged and answered with a 500, and errors raised
+ while streaming a body close the connection.
+"""
+
+import asyncio
+import logging
+import socket
+from http.client import responses
+
+MAX_BODY_CHUNK = 64 * 1024
+INTERNAL_ERROR = (500, {"Content-Type": "application/json"}, b'{"error": "Internal server error"}')
+
+
+class HTTPRequest(object):
+    def __init__(self, method, path, query, version, headers, reader, writer,
+                 disconnected=None):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.version = version
+        self.headers = headers
+        self._reader = reader
+        self._writer = writer
+        self._disconnected = disconnected or asyncio.Event()
+        self._consumed = False
+
+    async def stream(self):
+        """
+        Yields the request body in chunks as it arrives.
+        """
+        if self._consumed:
+            return
+        self._consumed = True
+        if self.headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await self._reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # Skip trailers
+                    while (await self._reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    return
+                yield await self._reader.readexactly(size)
+                await self._reader.readline()
+        else:
+            remaining = int(self.headers.get("content-length", 0))
+            while remaining > 0:
+                chunk = await self._reader.read(min(remaining, MAX_BODY_CHUNK))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                remaining -= len(chunk)
+                yield chunk
+
+    async def lines(self):
+        """
+        Yields the request body line by line as it arrives.
+        """
+        buffered = b""
+        async for chunk in self.stream():
+            lines = (buffered + chunk).split(b"\n")
+            buffered = lines.pop()
+            for line in lines:
+                yield line
+        if buffered:
+            yield buffered
+
+    async def body(self):
+        chunks = []
+        async for chunk in self.stream():
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    async def disconnected(self):
+        """
+        Returns once the client has closed the connection. Only meaningful once
+        the body has been read, as input is not consumed.
+        """
+        await self._disconnected.wait()
+
+    async def drain(self):
+        async for chunk in self.stream():
+            pass
+
+
+def _keep_alive(version, headers):
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+
+async def _write_response(writer, version, status, headers, body, keep_alive):
+    lines = ["%s %d %s" % (version, status, responses.get(status, ""))]
+    headers = dict(headers)
+    headers["Connection"] = "keep-alive" if keep_alive else "close"
+    chunked = not isinstance(body, bytes)
+    if chunked:
+        headers["Transfer-Encoding"] = "chunked"
+    else:
+        headers["Content-Length"] = str(len(body))
+    lines += ["%s: %s" % (key, value) for key, value in headers.items()]
+    head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+    if not chunked:
+        # A single write, so headers and body leave in the same segment
+        writer.write(head + body)
+    else:
+        writer.write(head)
+        try:
+            async for chunk in body:
+                if chunk:
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    await writer.drain()
+        finally:
+            # Let the body clean up at once if the client has gone away
+            await body.aclose()
+        writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+class _ConnectionProtocol(asyncio.StreamReaderProtocol):
+    """
+    Serves a connection with `handler`, setting `disconnected` once the client
+    has closed it, so that requests do not have to poll for it
+    """
+    def __init__(self, handler, loop):
+        self.disconnected = asyncio.Event()
+        super(_ConnectionProtocol, self).__init__(
+            asyncio.StreamReader(loop=loop),
+            lambda reader, writer: _serve_connection(reader, writer, handler,
+                                                     self.disconnected),
+            loop=loop)
+
+    def eof_received(self):
+        self.disconnected.set()
+        return super(_ConnectionProtocol, self).eof_received()
+
+    def connection_lost(self, exc):
+        self.disconnected.set()
+        super(_ConnectionProtocol, self).connection_lost(exc)
+
+
+def create_server(handler, loop, **kwargs):
+    """
+    Returns a coroutine starting a server for `handler`, taking the arguments
+    of loop.create_server
+    """
+    return loop.create_server(lambda: _ConnectionProtocol(handler, loop), **kwargs)
+
+
+async def _serve_connection(reader, writer, handler, disconnected=None):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            method, target, version = line.decode("latin-1").split()
+            headers = {}
+            while True:
+                header = await reader.readline()
+                if header in (b"\r\n", b"\n", b""):
+                    break
+                key, value = header.decode("latin-1").split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            path, _, query = target.partition("?")
+
+            request = HTTPRequest(method, path, query, version, headers, reader, writer,
+                                  disconnected)
+            try:
+                status, response_headers, body = await handler(request)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                raise
+            except Exception:
+                logging.getLogger().exception("Failed to handle %s %s" % (method, path))
+                status, response_headers, body = INTERNAL_ERROR
+            keep_alive = _keep_alive(version, headers)
+            await _write_response(writer, version, status, response_headers, body, keep_alive)
+            # Leave the connection positioned at the start of the next request
+            await request.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    except Exception:
+        # The response has been started, so the connection is closed instead
+        logging.getLogger().exception("Failed to serve connection")
+    finally:
+        writer.close()
+
+
+def serve(handler, host='0.0.0.0', port=5000, reuse_port=False):
+    """
+    Serves `handler` until the process is terminated.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, int(port)))
+    server = loop.run_until_complete(create_server(handler, loop, sock=sock, backlog=1024))
+    print("Serving on %s:%s" % (host, port))
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.close()
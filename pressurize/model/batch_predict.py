@@ -0,0 +1,119 @@
+"""
+ batch_predict.py
+ Offline inference over a JSON lines file, without the model server.
+
+ The model is loaded once and forked into `processes` worker processes, which
+ share it through copy-on-write memory. Input lines are read in batches of
+ `batch_size` requests, each batch is processed by one worker (through
+ batch_{method} when the model has one), and results are written in input
+ order as they complete. At most two batches per worker are in flight, so
+ memory use does not depend on the size of the input.
+
+ Each input line is a request in the same form as the body of an API request,
+ and each output line is either {"result": ...} or {"error": "..."}.
+"""
+
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from .model_server_utils import import_model, acquire_resources, run_bulk
+
+# The model being run, inherited by forked worker processes
+_model = None
+_method = None
+
+
+def _init_worker():
+    # Enter the model's context for the lifetime of the worker process
+    _model.modelcontext().__enter__()
+
+
+def _process_batch(lines):
+    """
+    Runs a batch of input lines through the model, returning the encoded
+    output lines and the number of errors.
+    """
+    requests, errors = [], {}
+    for idx, line in enumerate(lines):
+        try:
+            requests.append(json.loads(line))
+        except ValueError:
+            errors[idx] = {'error': 'Invalid JSON request'}
+    results = iter(run_bulk(_model, _method, requests))
+    results = [errors[idx] if idx in errors else next(results) for idx in range(len(lines))]
+    output = "".join(json.dumps(result) + "\n" for result in results)
+    return output, sum(1 for result in results if 'error' in result)
+
+
+def _read_batches(f, batch_size):
+    batch = []
+    for line in f:
+        if not line.strip():
+            continue
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def batch_predict(config, model_name, method, input_path, output_path,
+                  source_path=os.getcwd(), resource_path=os.getcwd(),
+                  processes=None, batch_size=None, report_interval=10):
+    """
+    Runs `method` of a model from a pressurize.json config over every request
+    in `input_path`, writing results to `output_path`.
+    Returns (records, errors, seconds).
+    """
+    global _model, _method
+    models = dict((model['name'], model) for model in config['models'])
+    if model_name not in models:
+        raise RuntimeError("Model %s not found in config" % model_name)
+    model_conf = models[model_name]
+    batch_size = int(batch_size or model_conf.get('max_batch_size', 100))
+    processes = int(processes or os.cpu_count() or 1)
+
+    model_resource_path = os.path.join(resource_path, "resources", model_name)
+    resources = acquire_resources(config, model_conf, model_resource_path)
+    model_class = import_model(model_conf['path'], source_path)
+    _model = model_class(resources, config=model_conf, logger=logging.getLogger())
+    _method = method
+    if not hasattr(_model, method):
+        raise RuntimeError("Model %s does not have method %s" % (model_name, method))
+
+    # Fork explicitly so that workers share the loaded model copy-on-write
+    context = multiprocessing.get_context("fork")
+    started = reported = time.time()
+    records = errors = 0
+    with open(input_path, 'r') as infile, open(output_path, 'w') as outfile, \
+         context.Pool(processes, initializer=_init_worker) as pool:
+        pending = collections.deque()
+
+        def write_oldest():
+            nonlocal records, errors, reported
+            count, result = pending.popleft()
+            output, batch_errors = result.get()
+            outfile.write(output)
+            records += count
+            errors += batch_errors
+            if time.time() - reported >= report_interval:
+                reported = time.time()
+                print("%d records (%.0f records/sec)" % (records, records / (reported - started)),
+                      file=sys.stderr)
+
+        for batch in _read_batches(infile, batch_size):
+            pending.append((len(batch), pool.apply_async(_process_batch, (batch,))))
+            while pending and (len(pending) >= 2 * processes or pending[0][1].ready()):
+                write_oldest()
+        while pending:
+            write_oldest()
+    seconds = time.time() - started
+    print("Processed %d records in %.1fs (%.0f records/sec), %d errors" %
+          (records, seconds, records / max(seconds, 1e-9), errors), file=sys.stderr)
+    return records, errors, seconds
@@ -0,0 +1,177 @@
+"""
+ bench.py
+ Load generator for a model server.
+
+ Request payloads are read from a sample file (one JSON request body per line)
+ and sent to a model method in one of two ways:
+   concurrency - a fixed number of clients, each sending its next request as
+                 soon as its previous one completes
+   rate        - requests are sent on a fixed schedule whether or not earlier
+                 requests have completed, and latency is measured from the
+                 scheduled send time so that queueing is not hidden
+ Each level of a sweep is reported with its throughput, latency percentiles
+ (over successful requests) and error rate.
+"""
+
+import concurrent.futures
+import itertools
+import json
+import math
+import threading
+import time
+
+import requests
+
+PERCENTILES = (50, 95, 99, 99.9)
+MAX_RATE_CLIENTS = 512
+
+
+def load_payloads(path):
+    with open(path, 'r') as f:
+        payloads = [json.loads(line) for line in f if line.strip()]
+    if len(payloads) == 0:
+        raise RuntimeError("No payloads found in %s" % path)
+    return payloads
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    if len(values) == 0:
+        return None
+    # Rounded first, so that float error cannot push an exact rank up by one
+    rank = max(int(math.ceil(round(p / 100.0 * len(values), 9))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(mode, level, samples, seconds):
+    """
+    Summarizes (latency, ok) samples collected over `seconds`
+    """
+    latencies = sorted(latency for latency, ok in samples if ok)
+    errors = sum(1 for latency, ok in samples if not ok)
+    summary = {
+        "mode": mode,
+        "level": level,
+        "requests": len(samples),
+        "throughput": len(latencies) / seconds if seconds > 0 else 0,
+        "error_rate": errors / float(len(samples)) if samples else 0
+    }
+    for p in PERCENTILES:
+        value = percentile(latencies, p)
+        summary["p%s_ms" % ("%g" % p).replace(".", "")] = value * 1000 if value is not None else None
+    return summary
+
+
+def _send(session, url, payload):
+    started = time.time()
+    try:
+        ok = session.post(url, json=payload).status_code == 200
+    except requests.exceptions.RequestException:
+        ok = False
+    return started, time.time(), ok
+
+
+def run_concurrency(url, payloads, concurrency, duration, warmup=1):
+    samples = []
+    lock = threading.Lock()
+    measure_from = time.time() + warmup
+    end = measure_from + duration
+
+    def client(offset):
+        session = requests.Session()
+        for payload in itertools.islice(itertools.cycle(payloads), offset, None):
+            started, finished, ok = _send(session, url, payload)
+            if finished > end:
+                return
+            if started >= measure_from:
+                with lock:
+                    samples.append((finished - started, ok))
+
+    threads = [threading.Thread(target=client, args=(idx,)) for idx in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize("concurrency", concurrency, samples, duration)
+
+
+def run_rate(url, payloads, rate, duration, warmup=1):
+    samples = []
+    lock = threading.Lock()
+    sessions = threading.local()
+    started = time.time()
+    measure_from = started + warmup
+    end = measure_from + duration
+
+    def request(scheduled, payload):
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        sent, finished, ok = _send(sessions.session, url, payload)
+        if scheduled >= measure_from:
+            with lock:
+                samples.append((finished - scheduled, ok))
+
+    with concurrent.futures.ThreadPoolExecutor(MAX_RATE_CLIENTS) as executor:
+        for idx, payload in enumerate(itertools.cycle(payloads)):
+            scheduled = started + idx / float(rate)
+            if scheduled >= end:
+                break
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(request, scheduled, payload)
+    return summarize("rate", rate, samples, duration)
+
+
+def wait_for_server(url, timeout=60):
+    """
+    Waits until something is accepting connections at `url`
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            if time.time() > deadline:
+                raise RuntimeError("Model server at %s did not start" % url)
+            time.sleep(0.2)
+
+
+def bench(url, payloads, concurrency=None, rates=None, duration=10, warmup=1):
+    """
+    Runs a sweep over each of the given rates, or else concurrency levels,
+    returning a summary per level.
+    """
+    results = []
+    if rates:
+        for rate in rates:
+            results.append(run_rate(url, payloads, rate, duration, warmup))
+            print(format_table(results[-1:], header=len(results) == 1))
+    else:
+        for level in concurrency or (1,):
+            results.append(run_concurrency(url, payloads, level, duration, warmup))
+            print(format_table(results[-1:], header=len(results) == 1))
+    return results
+
+
+def format_table(results, header=True):
+    columns = ["mode", "level", "requests", "throughput", "p50_ms", "p95_ms",
+               "p99_ms", "p999_ms", "error_rate"]
+    lines = []
+    if header:
+        lines.append(" ".join("%12s" % column for column in columns))
+    for result in results:
+        cells = []
+        for column in columns:
+            value = result[column]
+            if value is None:
+                cells.append("%12s" % "-")
+            elif isinstance(value, float):
+                cells.append("%12.2f" % value)
+            else:
+                cells.append("%12s" % value)
+        lines.append(" ".join(cells))
+    return "\n".join(lines)
@@ -0,0 +1,434 @@
+"""
+ dispatcher.py
+ Routes requests from the HTTP front end to a model's worker processes.
+
+ Every request is tagged with a unique `resId` and written to a worker pipe
+ without holding a lock for the round trip. A reader thread per worker receives
+ responses and resolves the future registered under the matching `resId`, so
+ any number of requests can be in flight for a model at once and responses are
+ always routed back to the handler that is waiting for them.
+
+ When a model has several workers, each request goes to the worker with the
+ fewest requests in flight, so idle workers are always preferred.
+
+ Requests beyond a model's `max_queue_size` outstanding requests (or a
+ method's entry in `max_queue_size_by_method`) are rejected immediately with
+ an OverloadedError, which estimates when to retry from the rate at which the
+ model's workers have been completing requests. The requests of bulk requests
+ are counted separately, and do not count towards these limits.
+
+ Requests can be cancelled: the worker is told to skip the request if it has
+ not started it yet, or to stop streaming it.
+
+ When a worker exits, its requests in flight fail with a DispatchError, and a
+ Supervisor (see supervisor.py) puts a replacement in its place.
+
+ Methods that yield their results are streamed: the worker sends a "chunk"
+ message per yielded value and a final "done" (or "error") message, and the
+ request's future resolves to a ResponseStream as soon as the first message
+ arrives.
+"""
+
+import collections
+import itertools
+import math
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+
+class DispatchError(RuntimeError):
+    """
+    Raised (via the request future) when a request cannot be delivered to,
+    or answered by, a model worker.
+    """
+    pass
+
+
+class OverloadedError(DispatchError):
+    """
+    Raised by ModelDispatcher.submit when a model's queue is full.
+    `retry_after` estimates the number of seconds until it has room.
+    """
+    def __init__(self, message, retry_after):
+        super(OverloadedError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class ResponseStream(object):
+    """
+    The messages streamed back by a worker for a single request, in order.
+    `get` returns a Future for the next message, so a stream can be consumed
+    from a thread or from an event loop.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._messages = collections.deque()
+        self._waiters = collections.deque()
+        self._finished = False
+        self._callbacks = []
+
+    def put(self, message=None, exception=None):
+        callbacks = []
+        with self._lock:
+            if self._waiters:
+                future = self._waiters.popleft()
+            else:
+                future = Future()
+                self._messages.append(future)
+            if exception is not None or "chunk" not in message:
+                self._finished = True
+                callbacks, self._callbacks = self._callbacks, []
+        # Run before the final message is seen, so its consumer finds the stream finished
+        for callback in callbacks:
+            callback()
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(message)
+
+    def add_done_callback(self, callback):
+        """
+        Calls `callback` once the stream's final message (or error) has arrived
+        """
+        with self._lock:
+            if not self._finished:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def get(self):
+        with self._lock:
+            if self._messages:
+                return self._messages.popleft()
+            future = Future()
+            self._waiters.append(future)
+            return future
+
+
+class WorkerConnection(object):
+    """
+    The front end's side of the pipe to a single model worker process.
+    """
+    def __init__(self, name, conn):
+        self.name = name
+        self.alive = True
+        self._conn = conn
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._streams = {}
+        self._reader = None
+        self._reader_pid = None
+        # When the worker last sent a message, or became busy
+        self.last_progress = time.time()
+
+    def _ensure_reader(self):
+        """
+        Starts the response reader thread. Threads do not survive a fork, so the
+        reader is started lazily in whichever process actually serves requests.
+        """
+        if self._reader_pid == os.getpid():
+            return
+        with self._lock:
+            if self._reader_pid == os.getpid():
+                return
+            reader = threading.Thread(target=self._read_loop,
+                                      name="dispatcher-%s" % self.name)
+            reader.daemon = True
+            reader.start()
+            self._reader = reader
+            self._reader_pid = os.getpid()
+
+    def _read_loop(self):
+        while True:
+            try:
+                res = self._conn.recv()
+            except (EOFError, OSError) as e:
+                self.alive = False
+                self._fail_pending("Model worker %s is unavailable: %s" %
+                                   (self.name, e or "connection closed"))
+                return
+            self.last_progress = time.time()
+            if "chunk" in res or "done" in res or res.get("resId") in self._streams:
+                self._route_stream(res)
+                continue
+            res.setdefault("timings", {})["returned"] = time.time()
+            with self._lock:
+                future = self._pending.pop(res.get("resId"), None)
+            if future is None:
+                print("Dropping response for unknown request %s" % res.get("resId"))
+                continue
+            future.set_result(res)
+
+    def _route_stream(self, res):
+        """
+        Adds a message from a streaming method to its request's ResponseStream,
+        resolving the request's future with the stream on the first message.
+        """
+        future = None
+        finished = "chunk" not in res
+        if finished:
+            res.setdefault("timings", {})["returned"] = time.time()
+        with self._lock:
+            stream = self._streams.get(res["resId"])
+            if stream is None:
+                future = self._pending.pop(res["resId"], None)
+                if future is None:
+                    print("Dropping stream message for unknown request %s" % res["resId"])
+                    return
+                stream = self._streams[res["resId"]] = ResponseStream()
+            if finished:
+                del self._streams[res["resId"]]
+        stream.put(res)
+        if future is not None:
+            future.set_result({"resId": res["resId"], "stream": stream})
+
+    def _fail_pending(self, message):
+        with self._lock:
+            pending, streams = self._pending, self._streams
+            self._pending, self._streams = {}, {}
+        for future in pending.values():
+            future.set_exception(DispatchError(message))
+        for stream in streams.values():
+            stream.put(exception=DispatchError(message))
+
+    def in_flight(self):
+        return len(self._pending) + len(self._streams)
+
+    def _busy(self):
+        # Control messages such as profiles may legitimately wait without replying
+        return bool(self._streams) or any(not future.control for future in self._pending.values())
+
+    def stalled(self, timeout):
+        """
+        Whether the worker has had requests in flight for `timeout` seconds
+        without sending anything back
+        """
+        with self._lock:
+            busy = self._busy()
+        return busy and time.time() - self.last_progress > timeout
+
+    def close(self, message):
+        """
+        Fails the requests in flight and closes the pipe, once the worker's
+        process has exited
+        """
+        self.alive = False
+        self._fail_pending(message)
+        if self._reader is not None and self._reader_pid == os.getpid():
+            # The reader sees EOF now that the worker has exited, and must not be
+            # left reading a file descriptor that may be reused
+            self._reader.join(5)
+        self._conn.close()
+
+    def send(self, item):
+        """
+        Sends an item to the worker, returning a Future that resolves to the
+        worker's response dict, or to {"stream": ResponseStream} for a
+        streaming method.
+        """
+        self._ensure_reader()
+        future = Future()
+        future.res_id = item["resId"]
+        future.worker = self
+        future.control = "control" in item
+        with self._lock:
+            if not future.control and not self._busy():
+                self.last_progress = time.time()
+            self._pending[item["resId"]] = future
+        try:
+            with self._send_lock:
+                item["timings"]["sent"] = time.time()
+                self._conn.send(item)
+        except (EOFError, OSError) as e:
+            with self._lock:
+                self._pending.pop(item["resId"], None)
+            future.set_exception(DispatchError(
+                "Failed to send request to model worker %s: %s" % (self.name, e)))
+        return future
+
+
+    def cancel(self, res_id):
+        """
+        Asks the worker to drop a request it has not yet answered. The request's
+        future still resolves, with the worker's reply.
+        """
+        with self._lock:
+            if res_id not in self._pending and res_id not in self._streams:
+                return
+        try:
+            with self._send_lock:
+                self._conn.send({"control": "cancel", "target": res_id})
+        except (EOFError, OSError):
+            pass
+
+
+class ModelDispatcher(object):
+    def __init__(self, name, conns, max_queue_size=None, max_queue_size_by_method=None):
+        self.name = name
+        self.workers = [WorkerConnection("%s-%d" % (name, idx), conn)
+                        for idx, conn in enumerate(conns)]
+        self.max_queue_size = max_queue_size
+        self.max_queue_size_by_method = max_queue_size_by_method or {}
+        self.rejected = collections.Counter()
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._outstanding = collections.Counter()
+        # Requests of bulk requests, which are bounded by their callers instead
+        self._outstanding_bulk = collections.Counter()
+        self._completed = 0
+        self._busy_time = 0
+        self._last_change = time.time()
+        self._rate = None
+
+    def in_flight(self):
+        return sum(worker.in_flight() for worker in self.workers)
+
+    def replace_worker(self, idx, conn):
+        """
+        Puts a new worker process's pipe in place of worker `idx`
+        """
+        self.workers[idx] = WorkerConnection("%s-%d" % (self.name, idx), conn)
+
+    def outstanding(self, method=None):
+        """
+        Requests submitted (for `method`, if given) that are awaiting a
+        response, including those of bulk requests
+        """
+        with self._lock:
+            if method is None:
+                return sum(self._outstanding.values()) + sum(self._outstanding_bulk.values())
+            return self._outstanding[method] + self._outstanding_bulk[method]
+
+    def service_rate(self):
+        """
+        Requests completed per second while requests were outstanding, smoothed
+        over recent seconds
+        """
+        return self._rate
+
+    def retry_after(self, queued):
+        """
+        Estimates the seconds until `queued` requests have been served
+        """
+        if not self._rate:
+            return 1
+        return max(int(math.ceil(queued / self._rate)), 1)
+
+    def _admit(self, method):
+        total = sum(self._outstanding.values())
+        if self.max_queue_size is not None and total >= self.max_queue_size:
+            self.rejected[method] += 1
+            raise OverloadedError("Model %s has %d requests queued" % (self.name, total),
+                                  self.retry_after(total))
+        limit = self.max_queue_size_by_method.get(method)
+        if limit is not None and self._outstanding[method] >= limit:
+            self.rejected[method] += 1
+            raise OverloadedError("Method %s of model %s has %d requests queued" %
+                                  (method, self.name, self._outstanding[method]),
+                                  self.retry_after(self._outstanding[method]))
+
+    def _record_busy_time(self):
+        # Idle time says nothing about how fast requests are served
+        now = time.time()
+        if sum(self._outstanding.values()) > 0 or sum(self._outstanding_bulk.values()) > 0:
+            self._busy_time += now - self._last_change
+        self._last_change = now
+
+    def _complete(self, method, count, bulk=False):
+        with self._lock:
+            self._record_busy_time()
+            (self._outstanding_bulk if bulk else self._outstanding)[method] -= count
+            self._completed += count
+            if self._busy_time >= 1:
+                rate = self._completed / self._busy_time
+                self._rate = rate if self._rate is None else (rate + self._rate) / 2
+                self._completed = 0
+                self._busy_time = 0
+
+    def queue_depth(self):
+        """
+        Requests sent to workers that are waiting behind the request each
+        worker is currently processing.
+        """
+        return sum(max(worker.in_flight() - 1, 0) for worker in self.workers)
+
+    def choose_worker(self):
+        """
+        Returns the live worker with the fewest requests in flight, rotating the
+        starting point so that ties are spread across workers.
+        """
+        start = next(self._next)
+        candidates = [self.workers[(start + idx) % len(self.workers)]
+                      for idx in range(len(self.workers))]
+        candidates = [worker for worker in candidates if worker.alive] or candidates
+        return min(candidates, key=lambda worker: worker.in_flight())
+
+    def control(self, control, worker=0, **params):
+        """
+        Sends a control message (e.g. "profile") to the given worker, returning
+        a Future that resolves to the worker's response dict.
+        """
+        item = dict(params)
+        item.update({
+            "control": control,
+            "resId": uuid.uuid4().hex,
+            "timings": {"submitted": time.time()}
+        })
+        return self.workers[worker].send(item)
+
+    def cancel(self, future):
+        """
+        Cancels the request a future returned by submit is waiting on
+        """
+        future.worker.cancel(future.res_id)
+
+    def submit(self, method, data, bulk=False, deadline=None, priority=0, caller=None):
+        """
+        Sends a request to one of the model's workers, returning a Future that
+        resolves to the worker's response dict. A bulk request's `data` is a
+        list of requests, answered with a list of `results`. Bulk requests are
+        bounded by their callers and are not subject to admission control.
+        Raises OverloadedError if the model's queue is full. Workers skip
+        requests whose `deadline` (a timestamp) has passed, and serve waiting
+        requests by `priority` class and then fairly across `caller`s (see
+        scheduler.py).
+        """
+        count = len(data) if bulk else 1
+        with self._lock:
+            if not bulk:
+                self._admit(method)
+            self._record_busy_time()
+            (self._outstanding_bulk if bulk else self._outstanding)[method] += count
+        item = {
+            "model": self.name,
+            "method": method,
+            "data": data,
+            "resId": uuid.uuid4().hex,
+            "timings": {"submitted": time.time()}
+        }
+        if bulk:
+            item["bulk"] = True
+        if deadline is not None:
+            item["deadline"] = deadline
+        if priority:
+            item["priority"] = priority
+        if caller is not None:
+            item["caller"] = caller
+        future = self.choose_worker().send(item)
+        future.add_done_callback(lambda future: self._release(future, method, count, bulk))
+        return future
+
+    def _release(self, future, method, count, bulk):
+        """
+        Releases a request's admission slot once it has been answered. A
+        stream keeps its slot until its final message.
+        """
+        if future.exception() is None and "stream" in future.result():
+            future.result()["stream"].add_done_callback(
+                lambda: self._complete(method, count, bulk))
+        else:
+            self._complete(method, count, bulk)
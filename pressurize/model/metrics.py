@@ -0,0 +1,113 @@
+"""
+ metrics.py
+ Latency histograms and gauges for the model server, rendered in the
+ Prometheus text exposition format at /metrics.
+
+ Each request's time is split into the following stages, labeled by model
+ and method:
+   parse       - decoding the HTTP request body
+   queue       - waiting for the model worker: in the pipe until the worker
+                 reads it, and then in the worker's backlog until the
+                 scheduler releases it
+   ipc         - transferring the request and its response across the worker
+                 pipe
+   batch_wait  - waiting inside the worker for a batch to form, once released
+   preprocess  - the model's preprocess()
+   method      - the model method itself (shared by every request in a batch)
+   serialize   - encoding the HTTP response
+
+ Metrics are kept per front end process.
+"""
+
+import threading
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram(object):
+    def __init__(self, name, help, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # One count per bucket, then the sum and count of observations
+                counts = self._values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s histogram" % self.name]
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        for label_values, counts in values:
+            for bound, count in zip(self.buckets + (float("inf"),),
+                                    counts[:len(self.buckets)] + [counts[-1]]):
+                lines.append("%s_bucket%s %d" % (
+                    self.name, _format_labels(self.labels + ("le",), label_values + (_format_value(bound),)),
+                    count))
+            labels = _format_labels(self.labels, label_values)
+            lines.append("%s_sum%s %s" % (self.name, labels, _format_value(counts[-2])))
+            lines.append("%s_count%s %d" % (self.name, labels, counts[-1]))
+        return lines
+
+
+class Gauge(object):
+    """
+    A gauge (or counter) whose values are read from `collect` at render time.
+    `collect` returns a dict mapping label value tuples to values.
+    """
+    def __init__(self, name, help, labels, collect, type="gauge"):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        self.type = type
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.type)]
+        for label_values, value in sorted(self.collect().items()):
+            lines.append("%s%s %s" % (self.name, _format_labels(self.labels, label_values),
+                                      _format_value(value)))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -3,9 +3,50 @@
  Runs a simple API granting access to all available models.
  Usage: python model_server.py
 
- This server uses a separate process to perform predictions, with a pipe
- from `multiprocessing` connecting the flask server thread to the prediction
- process. Access to the server side of the pipe is guarded by a Lock from multiprocessing.
+ This server uses separate processes to perform predictions, with a pipe
+ from `multiprocessing` connecting the HTTP front end to each prediction
+ process. Requests are multiplexed over the pipes by a ModelDispatcher, which
+ routes each response back to its caller by request id.
+
+ Each model is loaded once in the parent process and then forked into
+ `workers` prediction processes (1 by default), which share the loaded model
+ and its resources through copy-on-write memory. Models are loaded
+ concurrently, each in its own thread.
+
+ Messages larger than `shared_memory_threshold` bytes cross the pipe through
+ shared memory (see transport.py).
+
+ Requests beyond a model's `max_queue_size` (or `max_queue_size_by_method`)
+ outstanding requests are rejected with a 503 and a Retry-After estimate.
+
+ A request's deadline is `X-Request-Timeout` seconds (or the model's
+ `request_timeout` / `request_timeout_by_method`) after it arrives. Requests
+ still waiting at their deadline are answered with a 504 and skipped by the
+ worker, as are requests whose client disconnects (asyncio front end only).
+
+ Workers serve waiting requests by their `X-Priority` class, and fairly across
+ the callers named by `X-Caller` within a class (see scheduler.py).
+
+ Results of the methods listed in a model's `cache_methods` are cached in the
+ front end (see cache.py); statistics are served at /cache/.
+
+ Per-stage latency histograms are served at /metrics (see metrics.py).
+
+ Models marked `lazy` are only loaded on their first request, and are
+ evicted when idle to stay within a memory budget (see activation.py).
+
+ Workers that exit are replaced, and with `worker_timeout` set, workers that
+ stop responding are killed and replaced (see supervisor.py).
+
+ Methods that return a generator are streamed to the client as NDJSON, one
+ line per yielded value, as the worker produces them.
+
+ POST /api/<model>/<method>/bulk/ accepts an NDJSON body of requests, which
+ are sent to the workers in batches and answered with NDJSON results in order.
+
+ When `admin_endpoints` is enabled in the config's `model_server` section,
+ POST /admin/profile/<model>/ profiles a model worker's next requests
+ (see profiler.py).
 """
 
 
@@ -14,28 +55,74 @@ import logging
 import logging.handlers
 
 import multiprocessing
+import collections
 import queue as Q
 import random
 import os.path
 import json
+import math
 import os
+import re
+import threading
+import time
+import asyncio
+import concurrent.futures
+import functools
 import importlib
 import pkgutil
 
-from flask import Flask, jsonify, request, abort, make_response
+from flask import Flask, Response, jsonify, request, abort, make_response, stream_with_context
 from flask_cors import CORS, cross_origin
 from .model_server_utils import *
-import boto3
-import botocore
+from .dispatcher import ModelDispatcher, DispatchError, OverloadedError
+from .transport import SharedMemoryConnection, DEFAULT_THRESHOLD
+from .cache import ResultCache, request_key
+from .metrics import Registry, Histogram, Gauge
+from .profiler import ProfileSession
+from .supervisor import Supervisor
+from .activation import ActivationManager, GIB
+from .scheduler import RequestQueue, PRIORITY_CLASSES, priority_class
+from . import async_server
+# Cancellations to remember for requests that have not been seen yet
+MAX_CANCELLED = 10000
 
 
 class ModelServer(object):
-    def __init__(self, config, source_path, resource_path, model_conf, pipe):
+    def __init__(self, config, source_path, resource_path, model_conf, pipe=None, lazy=False):
+        """
+        A `lazy` model server only loads its model when it is run, in the
+        worker process.
+        """
         self._pipe = pipe
-        self._resources = acquire_resources(config, model_conf, resource_path)
-        self._model_class = import_model(model_conf['path'], source_path)
+        self._config = config
+        self._source_path = source_path
+        self._resource_path = resource_path
+        self._model_conf = model_conf
+        self._last_arrival = 0
+        self._previous_arrival = 0
+        self._profile = None
+        self._backlog = RequestQueue(weights=model_conf.get('caller_weights'))
+        self._cancelled = collections.OrderedDict()
+        self._model = None
+        self.load_timings = None
+        if not lazy:
+            self.load()
+
+    def load(self):
+        started = time.time()
+        self._resources = acquire_resources(self._config, self._model_conf, self._resource_path)
+        acquired = time.time()
+        self._model_class = import_model(self._model_conf['path'], self._source_path)
+        imported = time.time()
         self._logger = self.setup_logging()
-        self._model = self._model_class(self._resources, config=model_conf, logger=self._logger)
+        self._model = self._model_class(self._resources, config=self._model_conf,
+                                        logger=self._logger)
+        # Seconds spent in each stage of loading the model
+        self.load_timings = {
+            'resources': acquired - started,
+            'import': imported - acquired,
+            'init': time.time() - imported
+        }
         print("ModelServer initialized")
 
     def setup_logging(self):
@@ -48,31 +135,291 @@ class ModelServer(object):
         logger.addHandler(handler)
         return logger
 
-    def run(self):
+    def run(self, pipe=None):
+        if pipe is not None:
+            self._pipe = pipe
+        if self._model is None:
+            self.load()
+        if self._model_conf.get('prefetch_resources') and self._resources.deferred():
+            self._resources.prefetch()
         #logger = multiprocessing.log_to_stderr()
         self._logger.info('About to enter model processing loop')
         print("run()")
         try:
             with self._model.modelcontext():
                 print("Modelcontext Initialized")
+                backlog = self._backlog
                 while True:
                     print("Received item. Processing")
-                    item = self._pipe.recv()
+                    self.drain()
+                    if self._profile is not None and not backlog and \
+                       not self._pipe.poll(self._profile.remaining_time()):
+                        self.finish_profile()
+                        continue
+                    item = backlog.popleft() if backlog else self.receive()
+                    if item is None:
+                        continue
+                    item["timings"]["dequeued"] = time.time()
+                    if "control" in item:
+                        try:
+                            self.control(item)
+                        except Exception as e:
+                            self._logger.exception("Failed to handle control message %s" %
+                                                   item["control"])
+                            self.reply(item, error="Exception: " + str(e))
+                        continue
+                    if self.skip(item):
+                        continue
                     if not hasattr(self._model, item['method']):
-                        self._pipe.send({"error": "Model does not have method %s" % item['method']})
-                    try:
-                        preprocessed = self._model.preprocess(item["data"])
-                        result = getattr(self._model, item['method'])(preprocessed)
-                        self._pipe.send({"result": result})
-                    except Exception as e:
-                        self._pipe.send({"error": "Exception: " + str(e)})
-                        self._logger.exception("Encountered error during invocation of method %s: %s" %
-                                     (item['method'], str(e)))
+                        self.reply(item, error="Model does not have method %s" % item['method'])
+                        continue
+                    if self._profile is None:
+                        self.process(item, backlog)
+                    else:
+                        self.profile(item, backlog)
         except Exception as e:
             print("Unexpected error encountered during model setup or request processing.")
             print(e)
             self._logger.exception("Unexpected error encountered during model setup or request processing.")
 
+    def process(self, item, backlog):
+        """
+        Processes an item, along with any requests it can be batched with.
+        Returns the number of requests processed.
+        """
+        if item.get('bulk'):
+            self.process_bulk(item)
+            return len(item['data'])
+        if can_batch(self._model, item['method']):
+            batch = self.collect_batch(item, backlog)
+            self.process_batch(batch)
+            return len(batch)
+        self.process_item(item)
+        return 1
+
+    def profile(self, item, backlog):
+        profiler = self._profile.profiler
+        profiler.resume()
+        try:
+            processed = self.process(item, backlog)
+        finally:
+            profiler.pause()
+        self._profile.count(processed)
+        if self._profile.done():
+            self.finish_profile()
+
+    def control(self, item):
+        """
+        Handles control messages from the front end
+        """
+        if item["control"] == "cancel":
+            self._cancelled[item["target"]] = True
+            # Requests may be cancelled after they have been answered
+            while len(self._cancelled) > MAX_CANCELLED:
+                self._cancelled.popitem(last=False)
+        elif item["control"] == "profile":
+            if self._profile is not None:
+                return self.reply(item, error="A profile is already in progress")
+            try:
+                self._profile = ProfileSession(item, format=item.get("format", "pstats"),
+                                               seconds=item.get("seconds", 10),
+                                               requests=item.get("requests"))
+            except ValueError as e:
+                return self.reply(item, error=str(e))
+            print("Profiling started")
+        else:
+            self.reply(item, error="Unknown control message %s" % item["control"])
+
+    def finish_profile(self):
+        session = self._profile
+        self._profile = None
+        print("Profiling finished after %d requests" % session.processed)
+        try:
+            summary = session.summary()
+        except Exception as e:
+            self._logger.exception("Failed to report profile")
+            return self.reply(session.item, error="Exception: " + str(e))
+        self.reply(session.item, result=summary)
+
+    def receive(self):
+        """
+        Receives the next item from the front end. Cancellations are recorded
+        and None is returned in their place.
+        """
+        receiving = time.time()
+        item = self._pipe.recv()
+        if item.get("control") == "cancel":
+            self.control(item)
+            return None
+        self._previous_arrival = self._last_arrival
+        self._last_arrival = time.time()
+        timings = item.setdefault("timings", {})
+        timings["receiving"] = receiving
+        timings["received"] = self._last_arrival
+        return item
+
+    def drain(self):
+        """
+        Moves every item waiting in the pipe to the backlog, so that
+        cancellations are seen before the requests they cancel are processed.
+        """
+        while self._pipe.poll(0):
+            item = self.receive()
+            if item is not None:
+                self._backlog.append(item)
+
+    def skip(self, item):
+        """
+        Replies to an item instead of processing it if it has been cancelled or
+        its deadline has passed, returning whether it was skipped.
+        """
+        if self._cancelled.pop(item.get("resId"), False):
+            self.reply(item, error="Request cancelled", cancelled=True)
+            return True
+        if item.get("deadline") is not None and item["deadline"] < time.time():
+            self.reply(item, error="Deadline exceeded", expired=True)
+            return True
+        return False
+
+    def reply(self, item, **response):
+        """
+        Sends the response to an item, along with its timings
+        """
+        timings = item.get("timings", {})
+        timings["replied"] = time.time()
+        response["resId"] = item["resId"]
+        response["timings"] = timings
+        self._pipe.send(response)
+
+    def preprocess(self, item):
+        timings = item.setdefault("timings", {})
+        timings["started"] = time.time()
+        preprocessed = self._model.preprocess(item["data"])
+        timings["preprocess"] = time.time() - timings["started"]
+        return preprocessed
+
+    def process_item(self, item):
+        try:
+            preprocessed = self.preprocess(item)
+            started = time.time()
+            result = getattr(self._model, item['method'])(preprocessed)
+            if is_stream(result):
+                return self.stream(item, result, started)
+            item["timings"]["method"] = time.time() - started
+            self.reply(item, result=result)
+        except Exception as e:
+            self.reply(item, error="Exception: " + str(e))
+            self._logger.exception("Encountered error during invocation of method %s: %s" %
+                                   (item['method'], str(e)))
+
+    def process_bulk(self, item):
+        """
+        Processes the requests of a bulk item, replying with a result or error
+        for each request.
+        """
+        timings = item['timings']
+        timings['started'] = time.time()
+        results = run_bulk(self._model, item['method'], item['data'], timings=timings)
+        self.reply(item, results=results)
+
+    def stream(self, item, chunks, started):
+        """
+        Sends each value yielded by a streaming method to the front end as soon
+        as it is produced, followed by a final "done" message.
+        """
+        for chunk in chunks:
+            self._pipe.send({"resId": item["resId"], "chunk": chunk})
+            self.drain()
+            if self._cancelled.pop(item["resId"], False):
+                if hasattr(chunks, "close"):
+                    chunks.close()
+                return self.reply(item, error="Request cancelled", cancelled=True)
+        item["timings"]["method"] = time.time() - started
+        self.reply(item, done=True)
+
+    def collect_batch(self, first, backlog):
+        """
+        Collects requests for the same method as `first` into a batch, following
+        the same rules as the API's batching:
+          - a batch only waits for more requests if `first` arrived within
+            `min_batch_time` ms of the previous request,
+          - it keeps forming while requests arrive within `min_batch_time` ms
+            of each other, for at most `max_batch_time` ms,
+          - and fires as soon as it holds `max_batch_size` requests.
+        Backlogged requests join the batch in the order they would be served,
+        so the highest priority work is batched first; requests for other
+        methods are left in `backlog`.
+        """
+        method = first['method']
+        max_batch_size = self._model_conf.get('max_batch_size', 100)
+        min_batch_time = self._model_conf.get('min_batch_time', 100) / 1000.0
+        max_batch_time = self._model_conf.get('max_batch_time', 1000) / 1000.0
+
+        batch = [first]
+        batch += backlog.take(lambda item: item.get('method') == method and not item.get('bulk'),
+                              max_batch_size - 1)
+        dequeued = time.time()
+        for item in batch[1:]:
+            item["timings"]["dequeued"] = dequeued
+        if len(batch) >= max_batch_size:
+            return batch
+
+        started = time.time()
+        wait = self._last_arrival - self._previous_arrival < min_batch_time
+        while len(batch) < max_batch_size:
+            timeout = 0
+            if wait:
+                timeout = min(min_batch_time, started + max_batch_time - time.time())
+            if not self._pipe.poll(max(timeout, 0)):
+                break
+            item = self.receive()
+            if item is None:
+                continue
+            if item.get('method') == method and not item.get('bulk'):
+                item["timings"]["dequeued"] = item["timings"]["received"]
+                batch.append(item)
+            else:
+                backlog.append(item)
+        return batch
+
+    def process_batch(self, batch):
+        """
+        Preprocesses each request of a batch and invokes `batch_{method}` once
+        on those that succeeded, replying to each request individually.
+        """
+        # Requests may have been cancelled or expired while the batch formed
+        batch = [item for item in batch if not self.skip(item)]
+        if len(batch) == 0:
+            return
+        if len(batch) == 1:
+            return self.process_item(batch[0])
+        method = batch[0]['method']
+        print("Processing batch of %d requests for method %s" % (len(batch), method))
+        items, preprocessed = [], []
+        for item in batch:
+            try:
+                preprocessed.append(self.preprocess(item))
+                items.append(item)
+            except Exception as e:
+                self.reply(item, error="Exception: " + str(e))
+                self._logger.exception("Encountered error during preprocessing for method %s: %s" %
+                                       (method, str(e)))
+        if len(items) == 0:
+            return
+        try:
+            started = time.time()
+            results = run_batch(self._model, method, preprocessed)
+            duration = time.time() - started
+        except Exception as e:
+            for item in items:
+                self.reply(item, error="Exception: " + str(e))
+            self._logger.exception("Encountered error during invocation of method batch_%s: %s" %
+                                   (method, str(e)))
+            return
+        for item, result in zip(items, results):
+            item["timings"]["method"] = duration
+            self.reply(item, result=result)
+
     @staticmethod
     def import_model(path, source_path):
         """
@@ -87,114 +434,806 @@ class ModelServer(object):
         spec.loader.exec_module(module)
         return getattr(module, path.split(".")[-1])
 
-    @staticmethod
-    def acquire_resources(config, model, model_resource_path):
-        resources = {}
-        for resource_name in model['required_resources']:
-            s3_path = model['required_resources'][resource_name]
-            print("Downloading resource %s from %s" % (resource_name, s3_path))
-            if not isinstance(s3_path, str):
-                continue
-            parts = s3_path.split("//")
-            region = parts[1]
+    acquire_resources = staticmethod(acquire_resources)
 
-            if len(parts) < 3:
-                raise RuntimeError("Invalid s3 resource in config: " + resource_name)
+dispatchers = {}
+supervisors = {}
+models = {}
+caches = {}
+activations = ActivationManager(supervisors)
+admin_endpoints = False
+# The front end's ends of all worker pipes, which new workers must close
+server_conns = []
+spawn_lock = threading.Lock()
 
-            session = boto3.Session(region_name=region)
-            client = session.client('s3')
+def dispatcher_gauge(attribute):
+    return lambda: dict(((name,), getattr(dispatcher, attribute)())
+                        for name, dispatcher in list(dispatchers.items()))
 
-            if parts[0] != "s3:":
-                resources[resource_name] = s3_path
-                continue
+def rejected_counts():
+    counts = collections.Counter()
+    for name, dispatcher in list(dispatchers.items()):
+        for method, count in list(dispatcher.rejected.items()):
+            counts[(name, method_label(name, method))] += count
+    return counts
+
+def cache_gauge(stat):
+    return lambda: dict((key, cache.stats()[stat]) for key, cache in caches.items())
+
+registry = Registry()
+stage_seconds = registry.register(Histogram(
+    'pressurize_stage_seconds', 'Time spent in each stage of serving a request',
+    ('model', 'method', 'stage')))
+request_seconds = registry.register(Histogram(
+    'pressurize_request_seconds', 'Total time spent serving a request',
+    ('model', 'method', 'status')))
+registry.register(Gauge('pressurize_in_flight', 'Requests sent to model workers awaiting a response',
+                        ('model',), dispatcher_gauge('in_flight')))
+registry.register(Gauge('pressurize_queue_depth', 'Requests waiting for a model worker',
+                        ('model',), dispatcher_gauge('queue_depth')))
+registry.register(Gauge('pressurize_rejected_total', 'Requests rejected because a queue was full',
+                        ('model', 'method'),
+                        rejected_counts, type='counter'))
+registry.register(Gauge('pressurize_worker_restarts_total', 'Model workers replaced after exiting',
+                        ('model',),
+                        lambda: dict(((name,), supervisor.restarts)
+                                     for name, supervisor in list(supervisors.items())),
+                        type='counter'))
+for stat in ('activations', 'evictions'):
+    registry.register(Gauge('pressurize_model_%s_total' % stat, 'Lazy model %s' % stat, ('model',),
+                            lambda stat=stat: dict(((name,), count) for name, count in
+                                                   list(getattr(activations, stat).items())),
+                            type='counter'))
+for stat in ('hits', 'misses', 'evictions', 'expirations'):
+    registry.register(Gauge('pressurize_cache_%s_total' % stat, 'Result cache %s' % stat,
+                            ('model', 'method'), cache_gauge(stat), type='counter'))
+registry.register(Gauge('pressurize_cache_bytes', 'Size of cached results',
+                        ('model', 'method'), cache_gauge('bytes')))
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+app = Flask(__name__)
+CORS(app)
+
+TIMEOUT_HEADER = 'X-Request-Timeout'
+PRIORITY_HEADER = 'X-Priority'
+CALLER_HEADER = 'X-Caller'
+API_ROUTE = re.compile(r'^/api/([^/]+)/([^/]+)/$')
+BULK_ROUTE = re.compile(r'^/api/([^/]+)/([^/]+)/bulk/$')
+PROFILE_ROUTE = re.compile(r'^/admin/profile/([^/]+)/$')
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+
+class ModelRequest(object):
+    """
+    A request for a model method, independent of the HTTP front end serving it.
+    `response` is set to a (status, payload) tuple once the request completes.
+    For a streaming method `stream` is set instead, and the front end sends
+    the lines produced by iter_stream (or iter_stream_async).
+    `priority` is the X-Priority header, if given.
+    """
+    def __init__(self, model, method, data, started=None, timeout=None, priority=None,
+                 caller=None):
+        self.model = model
+        self.method = method
+        self.data = data
+        self.priority = priority
+        self.caller = caller
+        self.future = None
+        self.response = None
+        self.headers = {}
+        self.stream = None
+        self.cache = None
+        # `started` is when the front end began reading the request
+        self.parsed = time.time()
+        self.started = started or self.parsed
+        if timeout is None:
+            timeout = request_timeout(model, method)
+        self.deadline = self.started + timeout if timeout else None
+
+    def remaining(self):
+        """
+        Seconds until the request's deadline, or None if it has none
+        """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def cancel(self):
+        if self.future is not None and not self.future.done():
+            self.future.worker.cancel(self.future.res_id)
+
+    def expire(self):
+        self.cancel()
+        self.response = (504, {'error': 'Deadline exceeded'})
+
+    def start(self):
+        """
+        Validates the request and sends it to a model worker. Returns False if
+        the request was completed immediately instead.
+        """
+        if self.data is None:
+            print("Data not provided")
+            self.response = (400, {'error': 'Data not provided'})
+            return False
+        try:
+            self.priority = priority_class(self.priority)
+        except ValueError:
+            self.response = (400, {'error': 'Invalid priority %s' % self.priority})
+            return False
+        if self.model not in models:
+            print("Error: Model does not exist")
+            self.response = (404, {'error': 'Model does not exist'})
+            return False
+        self.cache = caches.get((self.model, self.method))
+        if self.cache is not None:
+            self.cache_key = request_key(self.data)
+            hit, result = self.cache.get(self.cache_key)
+            if hit:
+                self.response = (200, {'result': result})
+                return False
+        if self.remaining() == 0:
+            self.expire()
+            return False
+        try:
+            self.future = get_dispatcher(self.model).submit(self.method, self.data,
+                                                            deadline=self.deadline,
+                                                            priority=self.priority,
+                                                            caller=self.caller)
+        except OverloadedError as e:
+            self.response = (503, {'error': str(e)})
+            self.headers['Retry-After'] = str(e.retry_after)
+            return False
+        return True
+
+    def finish(self):
+        """
+        Sets `response` from the model worker's reply
+        """
+        try:
+            res = self.future.result()
+        except DispatchError as e:
+            self.response = (503, {'error': str(e)})
+            return
+        if "stream" in res:
+            self.stream = res["stream"]
+            self.response = (200, None)
+            return
+        observe_timings(self.model, self.method, res.get("timings", {}))
+        if res.get("expired"):
+            self.response = (504, {'error': res['error']})
+            return
+        if "error" in res:
+            self.response = (400, {'error': res['error']})
+            return
+        if self.cache is not None:
+            self.cache.put(self.cache_key, res['result'])
+        self.response = (200, {'result': res['result']})
 
-            bucket = parts[2] # s3://{bucket}
-            key = parts[3]
+    def observe(self, serialize_time):
+        """
+        Records the request's front end stages once its response is encoded
+        """
+        if self.model not in models:
+            return
+        labels = (self.model, method_label(self.model, self.method))
+        stage_seconds.observe(labels + ('parse',), self.parsed - self.started)
+        stage_seconds.observe(labels + ('serialize',), serialize_time)
+        request_seconds.observe(labels + (str(self.response[0]),), time.time() - self.started)
+
+    def stream_line(self, future):
+        """
+        Encodes the next message of a streamed response as an NDJSON line,
+        returning (line, finished).
+        """
+        try:
+            message = future.result()
+        except DispatchError as e:
+            message = {'error': str(e)}
+        if "chunk" in message:
+            return (json.dumps(message["chunk"]) + "\n").encode('utf-8'), False
+        observe_timings(self.model, self.method, message.get("timings", {}))
+        if "error" in message:
+            # The status has already been sent, so errors end the stream instead
+            return (json.dumps({'error': message['error']}) + "\n").encode('utf-8'), True
+        return b'', True
 
-            print("PARTS", parts)
-            print("BUCKET", bucket)
-            print("KEY", key)
-            #key = "/".join(parts[3:]) # s3://{bucket}/{key/with/slashes}
+    def iter_stream(self):
+        serialize_time, finished = 0, False
+        try:
+            while not finished:
+                future = self.stream.get()
+                concurrent.futures.wait([future])
+                started = time.time()
+                line, finished = self.stream_line(future)
+                serialize_time += time.time() - started
+                if line:
+                    yield line
+        finally:
+            # The client went away mid-stream
+            if not finished:
+                self.future.worker.cancel(self.future.res_id)
+        self.observe(serialize_time)
 
-            # Ensure local folder exists
-            local_folder = model_resource_path #os.path.join(model_resource_path, *parts[3:-1])
+    async def iter_stream_async(self):
+        serialize_time, finished = 0, False
+        try:
+            while not finished:
+                future = self.stream.get()
+                await asyncio.wait([asyncio.wrap_future(future)])
+                started = time.time()
+                line, finished = self.stream_line(future)
+                serialize_time += time.time() - started
+                if line:
+                    yield line
+        finally:
+            if not finished:
+                self.future.worker.cancel(self.future.res_id)
+        self.observe(serialize_time)
 
-            print("local_folder", local_folder)
-            if not os.path.exists(local_folder):
-                print("Makedirs")
-                os.makedirs(local_folder)
+    def run(self):
+        if self.start():
+            done, waiting = concurrent.futures.wait([self.future], timeout=self.remaining())
+            if done:
+                self.finish()
+            else:
+                self.expire()
+        return self.response
 
-            local_path = os.path.join(model_resource_path, key.replace("/", "_"))
-            print("local_path", local_path)
+    async def run_async(self, disconnected=None):
+        """
+        Runs the request, cancelling it if the coroutine returned by
+        `disconnected()` completes first.
+        """
+        if self.start():
+            waiting = [asyncio.wrap_future(self.future)]
+            watcher = None
+            if disconnected is not None:
+                watcher = asyncio.ensure_future(disconnected())
+                waiting.append(watcher)
             try:
-                client.download_file(bucket, key, local_path)
-            except botocore.exceptions.ClientError as e:
-                raise RuntimeError("Failed to download resource '%s' @ %s: %s" % \
-                      (resource_name, s3_path, "bucket" + bucket + "key" + key + str(e)))
-            resources[resource_name] = local_path
-        print("Resources Acquired")
-        return resources
+                done, pending = await asyncio.wait(waiting, timeout=self.remaining(),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                if watcher is not None:
+                    watcher.cancel()
+            if self.future.done():
+                self.finish()
+            elif done:
+                self.cancel()
+                self.response = (499, {'error': 'Client disconnected'})
+            else:
+                self.expire()
+        return self.response
 
 
-serverPipeLock = Lock()
-pipes = {}
-app = Flask(__name__)
-CORS(app)
+class BulkRequest(object):
+    """
+    A bulk request for a model method. NDJSON requests are sent to the model's
+    workers in batches of the model's `max_batch_size`, with at most two
+    batches per worker in flight, and NDJSON results are produced in input
+    order. Input is only read as fast as results are consumed, so memory use
+    does not depend on the size of the input. Bulk requests default to the
+    batch priority class, behind interactive requests.
+    """
+    def __init__(self, model, method, started=None, priority=PRIORITY_CLASSES['batch'],
+                 caller=None):
+        self.model = model
+        self.method = method
+        self.priority = priority
+        self.caller = caller
+        self.started = started or time.time()
+        self.batch_size = int(models[model].get('max_batch_size', 100))
+        self.window = 2 * int(models[model].get('workers', 1))
+        self.batch = []
+        self.errors = {}
+        self.pending = collections.deque()
+
+    def add(self, line):
+        """
+        Adds a line of the body to the current batch, sending the batch once full
+        """
+        line = line.strip()
+        if not line:
+            return
+        try:
+            self.batch.append(json.loads(line.decode('utf-8') if isinstance(line, bytes) else line))
+        except ValueError:
+            self.errors[len(self.batch)] = 'Invalid JSON request'
+            self.batch.append(None)
+        if len(self.batch) >= self.batch_size:
+            self.send()
+
+    def send(self):
+        if not self.batch:
+            return
+        data = [data for idx, data in enumerate(self.batch) if idx not in self.errors]
+        if data:
+            try:
+                # Lazy models may have been evicted since the previous batch
+                future = get_dispatcher(self.model).submit(self.method, data, bulk=True,
+                                                           priority=self.priority,
+                                                           caller=self.caller)
+            except DispatchError as e:
+                # The status has already been sent, so the batch's results are errors
+                future = concurrent.futures.Future()
+                future.set_exception(e)
+        else:
+            future = concurrent.futures.Future()
+            future.set_result({'results': []})
+        self.pending.append((future, len(self.batch), self.errors))
+        self.batch, self.errors = [], {}
+
+    def ready(self):
+        """
+        Whether the oldest batch must be waited on before reading more input
+        """
+        return len(self.pending) >= self.window or self.pending[0][0].done()
+
+    def pop(self):
+        """
+        Encodes the results of the oldest batch as NDJSON lines
+        """
+        future, count, errors = self.pending.popleft()
+        try:
+            res = future.result()
+        except DispatchError as e:
+            res = {'error': str(e)}
+        observe_timings(self.model, self.method, res.get('timings', {}))
+        results = iter(res.get('results', []))
+        lines = []
+        for idx in range(count):
+            if idx in errors:
+                result = {'error': errors[idx]}
+            elif 'error' in res:
+                result = {'error': res['error']}
+            else:
+                result = next(results)
+            lines.append(json.dumps(result))
+        return ("\n".join(lines) + "\n").encode('utf-8')
+
+    def finish(self):
+        request_seconds.observe((self.model, method_label(self.model, self.method), '200'),
+                                time.time() - self.started)
+
+    def cancel(self):
+        """
+        Cancels the batches still in flight, once the client has gone away
+        """
+        for future, count, errors in self.pending:
+            if hasattr(future, "worker") and not future.done():
+                future.worker.cancel(future.res_id)
+
+    def iter_results(self, lines):
+        try:
+            for line in lines:
+                self.add(line)
+                while self.pending and self.ready():
+                    concurrent.futures.wait([self.pending[0][0]])
+                    yield self.pop()
+            self.send()
+            while self.pending:
+                concurrent.futures.wait([self.pending[0][0]])
+                yield self.pop()
+        finally:
+            self.cancel()
+        self.finish()
+
+    async def iter_results_async(self, lines):
+        try:
+            async for line in lines:
+                self.add(line)
+                while self.pending and self.ready():
+                    await asyncio.wait([asyncio.wrap_future(self.pending[0][0])])
+                    yield self.pop()
+            self.send()
+            while self.pending:
+                await asyncio.wait([asyncio.wrap_future(self.pending[0][0])])
+                yield self.pop()
+        finally:
+            self.cancel()
+        self.finish()
+
 
 @app.route('/api/<string:model>/<string:method>/', methods=['POST'])
 def executeModelMethod(model, method):
-    data = request.get_json()
-    if data is None:
-        print("Data not provided")
-        return make_response(jsonify({'error': 'Data not provided'}), 400)
+    started = time.time()
+    try:
+        timeout = request_timeout(model, method, request.headers.get(TIMEOUT_HEADER))
+    except ValueError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+    model_request = ModelRequest(model, method, request.get_json(), started=started,
+                                 timeout=timeout,
+                                 priority=request.headers.get(PRIORITY_HEADER),
+                                 caller=request.headers.get(CALLER_HEADER))
+    status, payload = model_request.run()
+    if model_request.stream is not None:
+        return Response(model_request.iter_stream(), status, mimetype=NDJSON_CONTENT_TYPE)
+    serialize_started = time.time()
+    response = make_response(jsonify(payload), status, model_request.headers)
+    model_request.observe(time.time() - serialize_started)
+    return response
 
-    if model not in pipes:
-        print("Error: Model does not exist")
+@app.route('/api/<string:model>/<string:method>/bulk/', methods=['POST'])
+def executeBulkModelMethod(model, method):
+    if model not in models:
         return make_response(jsonify({'error': 'Model does not exist'}), 404)
+    try:
+        priority = priority_class(request.headers.get(PRIORITY_HEADER), PRIORITY_CLASSES['batch'])
+    except ValueError:
+        return make_response(jsonify({'error': 'Invalid priority'}), 400)
+    bulk_request = BulkRequest(model, method, priority=priority,
+                               caller=request.headers.get(CALLER_HEADER))
+    return Response(stream_with_context(bulk_request.iter_results(request.stream)),
+                    200, mimetype=NDJSON_CONTENT_TYPE)
 
-    # Send our task over the pipe and wait for a result.
-    resId = str(random.random())
-    serverPipeLock.acquire()
-    serverPipe = pipes[model][0]
+@app.route('/admin/profile/<string:model>/', methods=['POST'])
+def profileModel(model):
+    response, future = start_profile(model, request.get_json(silent=True) or {})
+    if future is not None:
+        concurrent.futures.wait([future])
+        response = profile_response(future)
+    return make_response(jsonify(response[1]), response[0])
 
-    # Drain pipe in the event there was an error
-    while serverPipe.poll():
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(registry.render(), mimetype=METRICS_CONTENT_TYPE)
+
+@app.route('/cache/', methods=['GET'])
+def cacheStats():
+    return jsonify(cache_stats())
+
+def request_timeout(model, method, header=None):
+    """
+    Returns a request's timeout in seconds: the X-Request-Timeout header if
+    given, or else the model's default for the method, if any. Raises
+    ValueError if the header is not a finite, positive number of seconds.
+    """
+    if header:
         try:
-            res = serverPipe.recv()
-            print("Drained failed event", str(res))
-        except EOFError:
-            continue
+            timeout = float(header)
+        except ValueError:
+            timeout = None
+        if timeout is None or not math.isfinite(timeout) or timeout <= 0:
+            raise ValueError("Invalid %s %s" % (TIMEOUT_HEADER, header))
+        return timeout
+    model_conf = models.get(model, {})
+    return model_conf.get('request_timeout_by_method', {}).get(
+        method, model_conf.get('request_timeout'))
+
+def cache_stats():
+    stats = {}
+    for (model, method), cache in caches.items():
+        stats.setdefault(model, {})[method] = cache.stats()
+    return stats
+
+def json_response(status, payload, extra_headers=None):
+    headers = dict(CORS_HEADERS)
+    headers['Content-Type'] = 'application/json'
+    headers.update(extra_headers or {})
+    return status, headers, json.dumps(payload).encode('utf-8')
 
-    serverPipe.send({
-        "model": model,
-        "method": method,
-        "data": data,
-        "resId": resId
-    })
-    res = serverPipe.recv()
-    serverPipeLock.release()
+def start_profile(model, params):
+    """
+    Asks a model worker to profile its next requests. Returns either an
+    immediate (status, payload) response, or a future for the profile.
+    """
+    if not admin_endpoints:
+        return (404, {'error': 'Not found'}), None
+    if model not in models:
+        return (404, {'error': 'Model does not exist'}), None
+    if not isinstance(params, dict):
+        return (400, {'error': 'Profile parameters must be a JSON object'}), None
+    dispatcher = dispatchers.get(model)
+    if dispatcher is None:
+        return (409, {'error': 'Model %s is not loaded' % model}), None
+    try:
+        worker = int(params.get('worker', 0))
+        seconds = float(params.get('seconds', 10))
+        requests = params.get('requests')
+        requests = int(requests) if requests is not None else None
+    except (TypeError, ValueError):
+        return (400, {'error': 'Invalid profile parameters'}), None
+    if worker < 0 or worker >= len(dispatcher.workers):
+        return (400, {'error': 'Model %s has no worker %d' % (model, worker)}), None
+    future = dispatcher.control('profile', worker=worker,
+                                format=params.get('format', 'pstats'),
+                                seconds=seconds, requests=requests)
+    return None, future
 
+def profile_response(future):
+    try:
+        res = future.result()
+    except DispatchError as e:
+        return 503, {'error': str(e)}
     if "error" in res:
-        return make_response(jsonify({'error': res['error']}), 400)
-    return jsonify(res)
+        return 400, {'error': res['error']}
+    return 200, {'result': res['result']}
+
+def observe_timings(model, method, timings):
+    """
+    Records the dispatch and worker stages of a request from the timestamps
+    and durations collected by the dispatcher and the model worker.
+    """
+    for stage, seconds in stage_durations(timings).items():
+        stage_seconds.observe((model, method_label(model, method), stage), max(seconds, 0))
+
+def method_label(model, method):
+    """
+    Labels metrics with the method only if it is one of the model's `methods`,
+    so that requests for arbitrary methods do not each add a new series.
+    """
+    if method in models.get(model, {}).get('methods', ()):
+        return method
+    return 'unknown'
+
+def stage_durations(timings):
+    """
+    Returns the seconds a request spent in each dispatch and worker stage.
+    The worker starts `receiving` a request once it has been sent, or before,
+    if it was idle and waiting for it.
+    """
+    stages = {}
+    if 'dequeued' in timings:
+        # Waiting in the pipe for the worker to read it, then in its backlog
+        stages['queue'] = max(timings['receiving'] - timings['sent'], 0) + \
+                          (timings['dequeued'] - timings['received'])
+    if 'received' in timings and 'replied' in timings:
+        stages['ipc'] = (timings['received'] - max(timings['receiving'], timings['sent'])) + \
+                        (timings['returned'] - timings['replied'])
+    if 'started' in timings:
+        stages['batch_wait'] = timings['started'] - timings['dequeued']
+    for stage in ('preprocess', 'method'):
+        if stage in timings:
+            stages[stage] = timings[stage]
+    return stages
+
+async def handle_async_request(http_request):
+    """
+    Serves the model API for the asyncio front end (see async_server.py)
+    """
+    if http_request.method == 'OPTIONS':
+        return 200, CORS_HEADERS, b''
+    if http_request.path == '/cache/' and http_request.method == 'GET':
+        return json_response(200, cache_stats())
+    profile_match = PROFILE_ROUTE.match(http_request.path)
+    if profile_match is not None and http_request.method == 'POST':
+        try:
+            params = json.loads((await http_request.body()).decode('utf-8') or '{}')
+        except ValueError:
+            params = {}
+        response, future = start_profile(profile_match.group(1), params)
+        if future is not None:
+            await asyncio.wait([asyncio.wrap_future(future)])
+            response = profile_response(future)
+        return json_response(*response)
+    if http_request.path == '/metrics' and http_request.method == 'GET':
+        return 200, {'Content-Type': METRICS_CONTENT_TYPE}, registry.render().encode('utf-8')
+    bulk_match = BULK_ROUTE.match(http_request.path)
+    if bulk_match is not None and http_request.method == 'POST':
+        if bulk_match.group(1) not in models:
+            return json_response(404, {'error': 'Model does not exist'})
+        try:
+            priority = priority_class(http_request.headers.get(PRIORITY_HEADER.lower()),
+                                      PRIORITY_CLASSES['batch'])
+        except ValueError:
+            return json_response(400, {'error': 'Invalid priority'})
+        bulk_request = BulkRequest(bulk_match.group(1), bulk_match.group(2), priority=priority,
+                                   caller=http_request.headers.get(CALLER_HEADER.lower()))
+        headers = dict(CORS_HEADERS)
+        headers['Content-Type'] = NDJSON_CONTENT_TYPE
+        return 200, headers, bulk_request.iter_results_async(http_request.lines())
+    match = API_ROUTE.match(http_request.path)
+    if match is None or http_request.method != 'POST':
+        return 404, CORS_HEADERS, b'{"error": "Not found"}'
+    started = time.time()
+    try:
+        data = json.loads((await http_request.body()).decode('utf-8'))
+    except ValueError:
+        data = None
+    model, method = match.group(1), match.group(2)
+    try:
+        timeout = request_timeout(model, method, http_request.headers.get(TIMEOUT_HEADER.lower()))
+    except ValueError as e:
+        return json_response(400, {'error': str(e)})
+    model_request = ModelRequest(model, method, data, started=started, timeout=timeout,
+                                 priority=http_request.headers.get(PRIORITY_HEADER.lower()),
+                                 caller=http_request.headers.get(CALLER_HEADER.lower()))
+    status, payload = await model_request.run_async(http_request.disconnected)
+    if model_request.stream is not None:
+        headers = dict(CORS_HEADERS)
+        headers['Content-Type'] = NDJSON_CONTENT_TYPE
+        return status, headers, model_request.iter_stream_async()
+    serialize_started = time.time()
+    response = json_response(status, payload, model_request.headers)
+    model_request.observe(time.time() - serialize_started)
+    return response
+
+def run_worker(model_server, pipe, inherited_conns):
+    # Only the front end should hold the front end's ends of the pipes, so that
+    # the worker sees EOF and exits once the front end does
+    for conn in inherited_conns:
+        conn.close()
+    model_server.run(pipe)
+
+def spawn_worker(model, model_server, context):
+    """
+    Forks a worker process for a model, returning (process, conn)
+    """
+    threshold = model.get('shared_memory_threshold', DEFAULT_THRESHOLD)
+    # Held until the worker's end is closed, so that no other worker inherits it
+    with spawn_lock:
+        server_conn, worker_conn = [SharedMemoryConnection(conn, threshold)
+                                    for conn in context.Pipe()]
+        server_conns[:] = [conn for conn in server_conns if not conn.closed]
+        server_conns.append(server_conn)
+        taskProcess = context.Process(target=run_worker,
+                                      args=(model_server, worker_conn, list(server_conns)))
+        taskProcess.start()
+        # Only the worker should hold its end, so its exit is seen as EOF
+        worker_conn.close()
+    return taskProcess, server_conn
+
+def start_model(model, model_server, context):
+    """
+    Forks `workers` processes (and `spare_workers` idle ones) for a model,
+    registering a ModelDispatcher and a Supervisor for it in this process.
+    Returns the Supervisor, which has not been started.
+    """
+    spawn = functools.partial(spawn_worker, model, model_server, context)
+    workers = [spawn() for idx in range(int(model.get('workers', 1)))]
+    spares = [spawn() for idx in range(int(model.get('spare_workers', 0)))]
+    print("Started %d worker(s) and %d spare(s) for model %s" %
+          (len(workers), len(spares), model['name']))
+    dispatcher = ModelDispatcher(
+        model['name'], [conn for process, conn in workers],
+        max_queue_size=model.get('max_queue_size'),
+        max_queue_size_by_method=model.get('max_queue_size_by_method'))
+    supervisor = Supervisor(dispatcher, spawn, [process for process, conn in workers], spares,
+                            worker_timeout=model.get('worker_timeout'))
+    dispatchers[model['name']] = dispatcher
+    supervisors[model['name']] = supervisor
+    return supervisor
+
+def stop_model(name):
+    dispatchers.pop(name)
+    supervisors.pop(name).stop()
+
+def start_workers(model_servers, context):
+    """
+    Starts the workers of every model loaded at startup, and registers lazy
+    models to be started on their first request.
+    """
+    for model, model_server in model_servers:
+        models[model['name']] = model
+        if model_server.load_timings is None:
+            activations.register(
+                model['name'],
+                lambda model=model, model_server=model_server:
+                    start_model(model, model_server, context).start(),
+                functools.partial(stop_model, model['name']),
+                # required_memory is the model's memory per instance, across its workers
+                required_memory=int(model.get('required_memory', 0) * GIB))
+        else:
+            start_model(model, model_server, context)
+    # Threads are only started once every worker has been forked
+    for supervisor in supervisors.values():
+        supervisor.start()
+    activations.start()
+
+def get_dispatcher(model):
+    """
+    Returns a model's ModelDispatcher, starting the model if it is lazy and
+    not running. Raises OverloadedError if there is no memory to start it.
+    """
+    if activations.is_lazy(model):
+        activations.activate(model)
+    return dispatchers[model]
+
+def setup_caches(model_servers):
+    """
+    Creates a ResultCache for each method listed in a model's `cache_methods`
+    """
+    for model, model_server in model_servers:
+        for method in model.get('cache_methods', []):
+            caches[(model['name'], method)] = ResultCache(
+                int(model.get('cache_size_mb', 64) * 1024 * 1024),
+                ttl=model.get('cache_ttl'))
+
+def serve(model_servers, context, frontend, port, debug, reuse_port=False):
+    setup_caches(model_servers)
+    start_workers(model_servers, context)
+    if frontend == 'asyncio':
+        async_server.serve(handle_async_request, port=port, reuse_port=reuse_port)
+    else:
+        app.run(host='0.0.0.0', port=int(port), debug=debug, threaded=True)
+
+def load_models(config, source_path, resource_path):
+    """
+    Loads every model in a pressurize.json config concurrently, returning
+    (model config, ModelServer) pairs in config order. Lazy models are left
+    to be loaded by their workers.
+    """
+    started = time.time()
+    lazy_models = config.get('model_server', {}).get('lazy_models', False)
+    with concurrent.futures.ThreadPoolExecutor(max(len(config['models']), 1)) as executor:
+        futures = collections.OrderedDict()
+        for model in config['models']:
+            model_resource_path = os.path.join(resource_path, "resources", model['name'])
+            futures[executor.submit(ModelServer, config, source_path, model_resource_path,
+                                    model, lazy=model.get('lazy', lazy_models))] = model
+        for future in concurrent.futures.as_completed(futures):
+            model = futures[future]
+            try:
+                timings = future.result().load_timings
+            except Exception as e:
+                print("Failed to load model %s: %s" % (model['name'], e))
+                raise
+            if timings is None:
+                print("Model %s will be loaded on its first request" % model['name'])
+                continue
+            print("Loaded model %s in %.1fs (resources %.1fs, import %.1fs, init %.1fs)" %
+                  (model['name'], sum(timings.values()), timings['resources'],
+                   timings['import'], timings['init']))
+    model_servers = [(model, future.result()) for future, model in futures.items()]
+    timings = [server.load_timings for model, server in model_servers if server.load_timings]
+    print("Loaded %d model(s) in %.1fs (%.1fs if loaded one at a time)" %
+          (len(timings), time.time() - started,
+           sum(sum(timing.values()) for timing in timings)))
+    return model_servers
 
 def run_server(config, source_path=os.getcwd(), resource_path=os.getcwd(),
-               port='5000', debug=False, separate_process=False):
+               port='5000', debug=False, separate_process=False,
+               frontend=None, frontends=None):
     """
     run_server takes a list of models from a pressurize.json config,
-    starting a ModelServer in a separate process for each model.
+    loading each model once and forking its ModelServer into `workers`
+    separate processes. Models are loaded concurrently, and the port is only
+    opened once all of them have loaded. Lazy models (`lazy`, or
+    `lazy_models` in the `model_server` section) are instead loaded on their
+    first request, within the `memory_budget_gb` (see activation.py).
+
+    Requests are served by the `frontend` named in the config's
+    `model_server` section: 'flask' (the default) or 'asyncio'. The asyncio
+    front end can run as `frontends` processes sharing the port, each with
+    its own workers.
     """
-    for model in config['models']:
-        model_resource_path = os.path.join(resource_path, "resources", model['name'])
-        pipes[model['name']] = Pipe()
-        model_server = ModelServer(config, source_path, model_resource_path,
-                                   model, pipes[model['name']][1])
+    global admin_endpoints
+    server_config = config.get('model_server', {})
+    admin_endpoints = bool(server_config.get('admin_endpoints', False))
+    if server_config.get('memory_budget_gb') is not None:
+        activations.memory_budget = int(float(server_config['memory_budget_gb']) * GIB)
+    frontend = frontend or server_config.get('frontend', 'flask')
+    frontends = int(frontends or server_config.get('frontends', 1))
+    if frontend not in ('flask', 'asyncio'):
+        raise RuntimeError("Unknown model server frontend %s" % frontend)
+    if frontend == 'flask' and frontends > 1:
+        raise RuntimeError("Multiple frontends require the asyncio frontend")
+
+    # Fork explicitly so that workers share the loaded model copy-on-write
+    context = multiprocessing.get_context("fork")
+    model_servers = load_models(config, source_path, resource_path)
+
+    if frontends > 1:
+        processes = []
+        for idx in range(frontends):
+            process = context.Process(target=serve, args=(model_servers, context, frontend,
+                                                          port, False, True))
+            process.start()
+            processes.append(process)
+        if separate_process:
+            return processes
+        for process in processes:
+            process.join()
+        return
 
-        taskProcess = Process(target=model_server.run)
-        taskProcess.start()
     if separate_process:
-        serverProcess = Process(target=app.run, args=(('0.0.0.0', port, debug)))
+        serverProcess = context.Process(target=serve, args=(model_servers, context,
+                                                            frontend, port, debug))
         serverProcess.start()
         return serverProcess
-    else:
-        app.run(host='0.0.0.0', port=int(port), debug=debug)
+    serve(model_servers, context, frontend, port, debug)
@@ -2,14 +2,47 @@ import logging
 import logging.handlers
 
 import random
+import collections.abc
 import os.path
 import json
 import os
+import time
 import importlib
 import pkgutil
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import botocore
+import botocore.config
+from boto3.s3.transfer import TransferConfig
+
+from .resource_cache import ResourceCache, DEFAULT_CACHE_DIR
+from .resources import Resources
+from . import archives
+
+MB = 1024 ** 2
+# Resource download settings, tuned for multi-GB model weights. Each of up to
+# `download_concurrency` resources is fetched in `multipart_chunksize_mb`
+# parts, `part_concurrency` ranged GETs at a time.
+DOWNLOAD_CONCURRENCY = 4
+PART_CONCURRENCY = 16
+MULTIPART_CHUNKSIZE_MB = 32
+PROGRESS_INTERVAL = 5
+RESOURCE_CACHE_GB = 50
+
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+def _reset_s3_clients():
+    global _s3_clients_lock
+    # Forked workers must not share the pooled connections of the parent's clients
+    _s3_clients.clear()
+    _s3_clients_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_s3_clients)
 
 
 def import_model(path, source_path):
@@ -25,49 +58,268 @@ def import_model(path, source_path):
     spec.loader.exec_module(module)
     return getattr(module, path.split(".")[-1])
 
+def can_batch(model, method):
+    """
+    A method can be batched if the model has a corresponding batch_{method} method
+    """
+    return hasattr(model, "batch_" + method)
+
+def run_batch(model, method, data):
+    """
+    Invokes batch_{method} once for a list of preprocessed requests, returning
+    the list of per-request results.
+    batch_{method} receives {"requests": [...]} and returns {"responses": [...]}
+    """
+    result = getattr(model, "batch_" + method)({"requests": data})
+    responses = result["responses"]
+    if len(responses) != len(data):
+        raise RuntimeError("batch_%s returned %d responses for %d requests" %
+                           (method, len(responses), len(data)))
+    return responses
+
+def run_bulk(model, method, data, timings=None):
+    """
+    Preprocesses a list of requests and invokes a method on them, through
+    batch_{method} when the model has one. Returns a {"result": ...} or
+    {"error": ...} dict per request. Generator results are collected into lists.
+    If given, `timings` receives the time spent in preprocess and the method.
+    """
+    started = time.time()
+    results = [None] * len(data)
+    indices, preprocessed = [], []
+    for idx, request in enumerate(data):
+        try:
+            preprocessed.append(model.preprocess(request))
+            indices.append(idx)
+        except Exception as e:
+            results[idx] = {'error': "Exception: " + str(e)}
+    preprocessed_at = time.time()
+    if can_batch(model, method) and len(preprocessed) > 1:
+        try:
+            for idx, result in zip(indices, run_batch(model, method, preprocessed)):
+                results[idx] = {'result': result}
+        except Exception as e:
+            logging.getLogger().exception("Encountered error during invocation of method batch_%s: %s" %
+                                          (method, str(e)))
+            for idx in indices:
+                results[idx] = {'error': "Exception: " + str(e)}
+    else:
+        for idx, request in zip(indices, preprocessed):
+            try:
+                result = getattr(model, method)(request)
+                if is_stream(result):
+                    result = list(result)
+                results[idx] = {'result': result}
+            except Exception as e:
+                results[idx] = {'error': "Exception: " + str(e)}
+    if timings is not None:
+        timings['preprocess'] = preprocessed_at - started
+        timings['method'] = time.time() - preprocessed_at
+    return results
+
+def is_stream(result):
+    """
+    Methods that return a generator (or any other iterator) stream their results
+    """
+    return isinstance(result, collections.abc.Iterator)
+
+def parse_s3_url(url, default_region=None):
+    """
+    Splits an s3 resource url into (region, bucket, key). Resources are given
+    as s3://{bucket}/{key/with/slashes}, in `default_region`, or as
+    s3://{region}//{bucket}//{key}
+    """
+    if not url.startswith("s3://"):
+        raise ValueError("Not an s3 url: %s" % url)
+    parts = url[len("s3://"):].split("//")
+    if len(parts) == 3:
+        region, bucket, key = parts
+    elif len(parts) == 1 and "/" in parts[0]:
+        region = default_region
+        bucket, key = parts[0].split("/", 1)
+    else:
+        raise ValueError("Invalid s3 url: %s" % url)
+    if not bucket or not key:
+        raise ValueError("Invalid s3 url: %s" % url)
+    return region, bucket, key
+
+def s3_client(region=None, endpoint_url=None, max_pool_connections=10):
+    """
+    Returns the S3 client shared by all downloads from a region and endpoint.
+    Clients are thread safe, so concurrent downloads share its connection pool.
+    """
+    with _s3_clients_lock:
+        if (region, endpoint_url) not in _s3_clients:
+            config = botocore.config.Config(max_pool_connections=max_pool_connections)
+            if endpoint_url:
+                # S3 stand-ins seldom serve virtual host style bucket names
+                config = config.merge(botocore.config.Config(s3={'addressing_style': 'path'}))
+            _s3_clients[(region, endpoint_url)] = boto3.Session().client(
+                's3', region_name=region, endpoint_url=endpoint_url, config=config)
+        return _s3_clients[(region, endpoint_url)]
+
+class DownloadProgress(object):
+    """
+    Counts the bytes downloaded for each resource, printing progress and
+    throughput at most every `interval` seconds
+    """
+    def __init__(self, interval=PROGRESS_INTERVAL):
+        self.interval = interval
+        self.started = time.time()
+        self._reported = self.started
+        self._sizes = collections.OrderedDict()
+        self._done = {}
+        self._times = {}
+        self._lock = threading.Lock()
+
+    def start(self, name, size):
+        with self._lock:
+            self._sizes[name] = size
+            self._done[name] = 0
+            self._times[name] = time.time()
+
+    def callback(self, name):
+        def downloaded(count):
+            with self._lock:
+                self._done[name] += count
+                now = time.time()
+                if now - self._reported < self.interval:
+                    return
+                self._reported = now
+                done = sum(self._done.values())
+                print("Downloaded %.1f/%.1f MB of resources (%.1f MB/s): %s" % (
+                    done / MB, sum(self._sizes.values()) / MB,
+                    done / MB / (now - self.started),
+                    ", ".join("%s %d%%" % (name, 100 * self._done[name] / max(size, 1))
+                              for name, size in self._sizes.items())))
+        return downloaded
+
+    def finish(self, name):
+        with self._lock:
+            seconds = max(time.time() - self._times[name], 1e-6)
+            print("Downloaded resource %s, %.1f MB in %.2fs (%.1f MB/s)" % (
+                name, self._sizes[name] / MB, seconds, self._sizes[name] / MB / seconds))
+
+    def summary(self):
+        seconds = max(time.time() - self.started, 1e-6)
+        size = sum(self._sizes.values())
+        print("Downloaded %d resource(s), %.1f MB in %.2fs (%.1f MB/s)" % (
+            len(self._sizes), size / MB, seconds, size / MB / seconds))
+
 def acquire_resources(config, model, model_resource_path):
-    resources = {}
+    """
+    Downloads a model's s3 resources into `model_resource_path`, returning a
+    Resources map of resource names to local paths. Other resources are local
+    paths, used in place. Each resource is stored at
+    {model_resource_path}/{resource name}/{file name of its key}.
+
+    Archives among the resources named by the model's `extract_resources` (or
+    all of them, if it is true) are extracted as they download, and their
+    path is the extracted directory, or file (see archives.py).
+
+    Resources named by the model's `lazy_resources` (or all of them, if it is
+    true) are deferred until the model first reads them (see resources.py).
+
+    Resources are downloaded concurrently through one shared client, each in
+    parts fetched by ranged GETs. The `model_server` section of the config can
+    set `download_concurrency`, `part_concurrency`, `multipart_chunksize_mb`
+    and `s3_endpoint_url` (for an S3 compatible store).
+
+    Downloads are kept in a ResourceCache at `resource_cache_dir`, of up to
+    `resource_cache_gb`, and only fetched again once the object has changed.
+    """
+    server_config = config.get('model_server', {})
+    concurrency = int(server_config.get('download_concurrency', DOWNLOAD_CONCURRENCY))
+    part_concurrency = int(server_config.get('part_concurrency', PART_CONCURRENCY))
+    chunksize = int(float(server_config.get('multipart_chunksize_mb', MULTIPART_CHUNKSIZE_MB)) * MB)
+    endpoint_url = server_config.get('s3_endpoint_url')
+    transfer_config = TransferConfig(multipart_threshold=chunksize, multipart_chunksize=chunksize,
+                                     max_concurrency=part_concurrency)
+
+    extract = model.get('extract_resources', False)
+    lazy = model.get('lazy_resources', False)
+    resources = Resources()
+    downloads = collections.OrderedDict()
     for resource_name in model['required_resources']:
         s3_path = model['required_resources'][resource_name]
-        print("Downloading resource %s from %s" % (resource_name, s3_path))
         if not isinstance(s3_path, str):
             continue
-        parts = s3_path.split("//")
-        region = parts[1]
-
-        if len(parts) < 3:
-            raise RuntimeError("Invalid s3 resource in config: " + resource_name)
-
-        session = boto3.Session(region_name=region)
-        client = session.client('s3')
-
-        if parts[0] != "s3:":
+        if not s3_path.startswith("s3:"):
+            # Local files are used in place
             resources[resource_name] = s3_path
             continue
+        try:
+            downloads[resource_name] = parse_s3_url(s3_path, config.get('aws_region'))
+        except ValueError:
+            raise RuntimeError("Invalid s3 resource in config: " + resource_name)
+    if not downloads:
+        return resources
 
-        bucket = parts[2] # s3://{bucket}
-        key = parts[3]
-
-        print("PARTS", parts)
-        print("BUCKET", bucket)
-        print("KEY", key)
-        #key = "/".join(parts[3:]) # s3://{bucket}/{key/with/slashes}
-
-        # Ensure local folder exists
-        local_folder = model_resource_path #os.path.join(model_resource_path, *parts[3:-1])
+    cache_size = server_config.get('resource_cache_gb', RESOURCE_CACHE_GB)
+    cache = ResourceCache(server_config.get('resource_cache_dir', DEFAULT_CACHE_DIR),
+                          None if cache_size is None else int(float(cache_size) * 1024 ** 3))
+    progress = DownloadProgress()
+    cached_paths = []
 
-        print("local_folder", local_folder)
-        if not os.path.exists(local_folder):
-            print("Makedirs")
-            os.makedirs(local_folder)
+    def download(resource_name):
+        region, bucket, key = downloads[resource_name]
+        s3_path = model['required_resources'][resource_name]
+        client = s3_client(region, endpoint_url, concurrency * part_concurrency)
+        local_path = os.path.join(model_resource_path, resource_name, os.path.basename(key))
+        extracting = archives.archive_format(key) is not None and \
+            (extract is True or resource_name in (extract or []))
+        variant = ""
+        if extracting:
+            local_path = os.path.join(model_resource_path, resource_name,
+                                      archives.extracted_name(key))
+            variant = ":extracted"
 
-        local_path = os.path.join(model_resource_path, key.replace("/", "_"))
-        print("local_path", local_path)
+        def fetch(path):
+            print("Downloading resource %s from %s" % (resource_name, s3_path))
+            progress.start(resource_name, head['ContentLength'])
+            if extracting:
+                with archives.RangedReader(client, bucket, key, head['ContentLength'],
+                                           head['ETag'], concurrency=part_concurrency,
+                                           callback=progress.callback(resource_name)) as reader:
+                    archives.extract(reader, key, path)
+            else:
+                client.download_file(bucket, key, path, Config=transfer_config,
+                                     Callback=progress.callback(resource_name))
+            progress.finish(resource_name)
         try:
-            client.download_file(bucket, key, local_path)
+            head = client.head_object(Bucket=bucket, Key=key)
+            if cache.get(head['ETag'], head['ContentLength'], local_path, fetch, variant):
+                print("Using cached resource %s from %s" % (resource_name, s3_path))
         except botocore.exceptions.ClientError as e:
             raise RuntimeError("Failed to download resource '%s' @ %s: %s" % \
-                  (resource_name, s3_path, "bucket" + bucket + "key" + key + str(e)))
-        resources[resource_name] = local_path
+                  (resource_name, s3_path, e))
+        cached_paths.append(cache.path(head['ETag'], head['ContentLength'], variant))
+        return local_path
+
+    def fetch_deferred(resource_name):
+        path = download(resource_name)
+        cache.evict(keep=cached_paths)
+        return path
+
+    eager = []
+    for resource_name in downloads:
+        if lazy is True or resource_name in (lazy or []):
+            resources.defer(resource_name, functools.partial(fetch_deferred, resource_name))
+        else:
+            eager.append(resource_name)
+    if not eager:
+        return resources
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="download") as executor:
+        futures = [(name, executor.submit(download, name)) for name in eager]
+        try:
+            for resource_name, future in futures:
+                resources[resource_name] = future.result()
+        except Exception:
+            for resource_name, future in futures:
+                future.cancel()
+            raise
+    progress.summary()
+    cache.evict(keep=cached_paths)
     print("Resources Acquired")
     return resources
@@ -0,0 +1,135 @@
+"""
+ profiler.py
+ On-demand profiling of model method invocations inside a model worker.
+
+ A ProfileSession is started by a control message from the front end and runs
+ for a number of seconds or requests. The profiler is only active while the
+ worker is processing requests, so time spent waiting on the pipe is excluded.
+ Two formats are supported:
+   pstats    - deterministic profile from cProfile, as pstats text sorted by
+               cumulative time
+   collapsed - statistical profile from a SIGPROF based stack sampler, as
+               collapsed stacks ("frame;frame;frame count") ready for
+               flamegraph tools. Time inside a long running native call is
+               attributed to the Python frame that made it.
+"""
+
+import cProfile
+import collections
+import io
+import os
+import pstats
+import signal
+import time
+
+MAX_PROFILE_SECONDS = 600
+
+
+class CProfileProfiler(object):
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def resume(self):
+        self._profile.enable()
+
+    def pause(self):
+        self._profile.disable()
+
+    def report(self):
+        # pstats cannot be built from a profile that recorded nothing
+        if not self._profile.getstats():
+            return ""
+        stream = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(100)
+        return stream.getvalue()
+
+
+class StackSampler(object):
+    """
+    Samples the worker's stack every `interval` seconds of CPU time. The timer
+    runs for the whole session, as requests are often shorter than `interval`,
+    and samples taken outside of request processing are discarded.
+    """
+    def __init__(self, interval=0.001):
+        self._interval = interval
+        self._counts = collections.Counter()
+        self._previous_handler = None
+        self._active = False
+
+    def _sample(self, signum, frame):
+        if not self._active:
+            return
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        self._counts[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self._interval, self._interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+
+    def resume(self):
+        self._active = True
+
+    def pause(self):
+        self._active = False
+
+    def report(self):
+        return "\n".join("%s %d" % (stack, count)
+                         for stack, count in self._counts.most_common()) + "\n"
+
+
+PROFILERS = {
+    'pstats': CProfileProfiler,
+    'collapsed': StackSampler
+}
+
+
+class ProfileSession(object):
+    """
+    Profiles a worker's requests until `seconds` have passed or `requests`
+    requests have been processed, whichever comes first.
+    """
+    def __init__(self, item, format='pstats', seconds=10, requests=None):
+        if format not in PROFILERS:
+            raise ValueError("Unknown profile format %s" % format)
+        self.item = item
+        self.profiler = PROFILERS[format]()
+        self.deadline = time.time() + min(float(seconds or MAX_PROFILE_SECONDS), MAX_PROFILE_SECONDS)
+        self.requests = requests
+        self.processed = 0
+        self.started = time.time()
+        self.profiler.start()
+
+    def remaining_time(self):
+        return max(self.deadline - time.time(), 0)
+
+    def count(self, processed):
+        self.processed += processed
+
+    def done(self):
+        if self.requests is not None and self.processed >= self.requests:
+            return True
+        return time.time() >= self.deadline
+
+    def summary(self):
+        self.profiler.stop()
+        return {
+            "requests": self.processed,
+            "seconds": time.time() - self.started,
+            "profile": self.profiler.report()
+        }
@@ -0,0 +1,233 @@
+"""
+ resource_cache.py
+ A persistent cache of downloaded S3 resources, shared by every model on a
+ host.
+
+ Objects are stored under a name derived from their ETag and size, so a
+ resource is only downloaded again when the object in S3 has changed (which a
+ HEAD request reveals), and models referencing the same object share one copy.
+ Each model's resource path is a hardlink to the cached object (or a copy,
+ where the resource path is on another filesystem). Extracted archives are
+ cached as directories, and linked file by file. Cached files are read-only,
+ as they may be shared.
+
+ The least recently used objects are evicted to keep the cache within
+ `max_size` bytes. An object still linked from a resource path only frees its
+ space once that link is replaced. Locks on each object keep concurrent loads,
+ in this process or others, from downloading the same object twice. Partial
+ downloads left behind by processes that died mid-download are removed once
+ they are `partial_max_age` seconds old.
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+DEFAULT_CACHE_DIR = os.path.join("~", ".cache", "pressurize", "resources")
+PARTIAL_MAX_AGE = 60 * 60
+
+
+class ResourceCache(object):
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_size=None, partial_max_age=PARTIAL_MAX_AGE):
+        self.root = os.path.expanduser(root)
+        self.max_size = max_size
+        self.partial_max_age = partial_max_age
+        self._objects = os.path.join(self.root, "objects")
+        self._locks = os.path.join(self.root, "locks")
+        os.makedirs(self._objects, exist_ok=True)
+        os.makedirs(self._locks, exist_ok=True)
+
+    def digest(self, etag, size, variant=""):
+        """
+        Names an object by its ETag and size, and the `variant` of it cached,
+        such as its extracted contents
+        """
+        name = "%s-%d%s" % (etag.strip('"'), size, variant)
+        return hashlib.sha256(name.encode("utf-8")).hexdigest()
+
+    def path(self, etag, size, variant=""):
+        return os.path.join(self._objects, self.digest(etag, size, variant))
+
+    def _lock(self, digest, blocking=True):
+        """
+        Returns an open file holding the lock on an object, or None if it is
+        held elsewhere and not `blocking`
+        """
+        path = os.path.join(self._locks, digest)
+        while True:
+            f = open(path, "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                return None
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            # The lock file was removed by an eviction while waiting on it
+            f.close()
+
+    def get(self, etag, size, target, download, variant=""):
+        """
+        Links the cached object with `etag` and `size` to `target`, first
+        calling download(path) to fetch it to `path` (a file, or a directory)
+        if it is not cached. Returns whether it was cached.
+        """
+        object_path = self.path(etag, size, variant)
+        lock = self._lock(self.digest(etag, size, variant))
+        try:
+            cached = os.path.exists(object_path)
+            if cached:
+                os.utime(object_path)
+            else:
+                partial = "%s.%d.%d.partial" % (object_path, os.getpid(), threading.get_ident())
+                try:
+                    download(partial)
+                    for path in files(partial):
+                        os.chmod(path, 0o444)
+                    os.rename(partial, object_path)
+                finally:
+                    remove(partial)
+            link(object_path, target)
+        finally:
+            lock.close()
+        return cached
+
+    def size(self):
+        total = 0
+        for name in os.listdir(self._objects):
+            if name.endswith(".partial"):
+                continue
+            try:
+                total += tree_size(os.path.join(self._objects, name))
+            except FileNotFoundError:
+                continue
+        return total
+
+    def sweep_partials(self):
+        """
+        Removes partial downloads older than `partial_max_age` that are not
+        being downloaded, as their process has died. Returns the number removed.
+        """
+        removed = 0
+        for name in os.listdir(self._objects):
+            if not name.endswith(".partial"):
+                continue
+            path = os.path.join(self._objects, name)
+            try:
+                if time.time() - os.stat(path).st_mtime < self.partial_max_age:
+                    continue
+            except FileNotFoundError:
+                continue
+            # Downloads hold the lock of the object they are fetching
+            digest = name.split(".")[0]
+            lock = self._lock(digest, blocking=False)
+            if lock is None:
+                continue
+            try:
+                print("Removing stale partial download %s" % name)
+                remove(path)
+                removed += 1
+                if not os.path.exists(os.path.join(self._objects, digest)):
+                    os.remove(os.path.join(self._locks, digest))
+            finally:
+                lock.close()
+        return removed
+
+    def evict(self, keep=()):
+        """
+        Removes stale partial downloads, and then the least recently used
+        objects until the cache is within `max_size`, except for the objects
+        at the paths in `keep`. Returns the number of objects removed.
+        """
+        self.sweep_partials()
+        if self.max_size is None:
+            return 0
+        entries = []
+        for name in os.listdir(self._objects):
+            if name.endswith(".partial"):
+                continue
+            path = os.path.join(self._objects, name)
+            try:
+                entries.append((os.stat(path).st_mtime, name, tree_size(path)))
+            except FileNotFoundError:
+                # Evicted by another process or thread since it was listed
+                continue
+        total = sum(size for mtime, name, size in entries)
+        removed = 0
+        for mtime, name, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            path = os.path.join(self._objects, name)
+            if path in keep:
+                continue
+            # Objects being fetched or linked are left alone
+            lock = self._lock(name, blocking=False)
+            if lock is None:
+                continue
+            try:
+                if os.path.exists(path):
+                    print("Evicting cached resource %s (%d bytes)" % (name, size))
+                    remove(path)
+                    total -= size
+                    removed += 1
+                # Removed while held, so that waiters see it is stale and retry
+                os.remove(os.path.join(self._locks, name))
+            finally:
+                lock.close()
+        return removed
+
+
+def files(path):
+    """
+    The path of a file, or of every file in a directory tree
+    """
+    if not os.path.isdir(path):
+        return [path] if os.path.exists(path) else []
+    return [os.path.join(root, name) for root, dirs, names in os.walk(path) for name in names]
+
+
+def tree_size(path):
+    return sum(os.path.getsize(name) for name in files(path))
+
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def link_file(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def link(source, target):
+    """
+    Replaces `target` with a hardlink to `source`, or a copy of it if they are
+    on different filesystems. Directories are linked file by file.
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temporary = "%s.%d.%d.link" % (target, os.getpid(), threading.get_ident())
+    if os.path.isdir(source):
+        shutil.copytree(source, temporary, symlinks=True, copy_function=link_file)
+    else:
+        link_file(source, temporary)
+    if os.path.isdir(target) and not os.path.islink(target):
+        # Directories cannot be replaced in one rename
+        replaced = temporary + ".old"
+        os.rename(target, replaced)
+        os.rename(temporary, target)
+        shutil.rmtree(replaced)
+    else:
+        if os.path.isdir(temporary):
+            remove(target)
+        os.replace(temporary, target)
@@ -0,0 +1,260 @@
+"""
+ resources.py
+ A model's resources: fetched on first access, and memory mapped read-only.
+
+ A model's resources map resource names to local file paths, as they always
+ have. Resources can be deferred, so that they are only fetched when the model
+ first reads them, in whichever process reads them, rather than before the
+ model starts. Each is fetched once, and prefetch() fetches the rest in the
+ background.
+
+ Resources.mmap and Resources.memmap also map a resource's file into
+ memory read-only, so every worker and model on the host reading the same file
+ shares one copy of it in the page cache, instead of each loading its own into
+ private memory. Combined with the resource cache, models referencing the same
+ S3 object map the same file.
+
+ NumPy arrays are mapped from .npy files, whose header gives their dtype and
+ shape. flatten() converts other common formats into .npy files that can be
+ mapped.
+"""
+
+import collections.abc
+import mmap
+import os
+import pickle
+import threading
+
+# Text formats flatten() reads as a table of numbers, by delimiter
+TEXT_DELIMITERS = {".csv": ",", ".tsv": "\t", ".txt": None}
+
+
+class Resources(collections.abc.MutableMapping):
+    """
+    Maps resource names to local paths, fetching deferred resources on first
+    access, and maps resources into memory
+    """
+    def __init__(self, *args, **kwargs):
+        self._paths = dict(*args, **kwargs)
+        # Functions fetching deferred resources, returning their paths
+        self._deferred = {}
+        self._fetching = {}
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        if name in self._deferred:
+            return self.fetch(name)
+        return self._paths[name]
+
+    def __setitem__(self, name, path):
+        with self._lock:
+            self._paths[name] = path
+            self._deferred.pop(name, None)
+
+    def __delitem__(self, name):
+        with self._lock:
+            if name not in self._paths and name not in self._deferred:
+                raise KeyError(name)
+            self._paths.pop(name, None)
+            self._deferred.pop(name, None)
+
+    def __iter__(self):
+        return iter(list(self._paths) + [name for name in list(self._deferred)
+                                         if name not in self._paths])
+
+    def __len__(self):
+        return len(set(self._paths) | set(self._deferred))
+
+    def __repr__(self):
+        return "Resources(%r, deferred=%r)" % (self._paths, sorted(self._deferred))
+
+    def defer(self, name, fetch):
+        """
+        Defers a resource until it is first accessed, when fetch() is called
+        to fetch it and return its path
+        """
+        with self._lock:
+            self._deferred[name] = fetch
+            self._fetching.setdefault(name, threading.Lock())
+
+    def deferred(self):
+        """
+        The names of the resources that have not been fetched yet
+        """
+        return list(self._deferred)
+
+    def fetch(self, name):
+        """
+        Fetches a deferred resource, once, returning its path
+        """
+        with self._fetching[name]:
+            fetch = self._deferred.get(name)
+            if fetch is not None:
+                path = fetch()
+                with self._lock:
+                    self._paths[name] = path
+                    self._deferred.pop(name, None)
+        return self._paths[name]
+
+    def prefetch(self):
+        """
+        Fetches every deferred resource in a background thread, returning it
+        """
+        def run():
+            for name in self.deferred():
+                try:
+                    self.fetch(name)
+                except Exception as e:
+                    print("Failed to prefetch resource %s: %s" % (name, e))
+        thread = threading.Thread(target=run, name="prefetch-resources")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def mmap(self, name):
+        """
+        A read-only mmap of a resource's file, shared by every call for the
+        same resource
+        """
+        # Resolved first, as fetching a deferred resource takes the lock
+        path = self[name]
+        with self._lock:
+            if name not in self._maps:
+                with open(path, "rb") as f:
+                    self._maps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._maps[name]
+
+    def memmap(self, name, dtype=None, shape=None, offset=0):
+        """
+        A read-only NumPy memmap of a resource. .npy files are mapped with
+        their own dtype and shape, and other files as raw `dtype` (default
+        uint8) values from `offset`, in `shape` if given.
+        """
+        import numpy
+        path = self[name]
+        if dtype is None and shape is None and is_npy(path):
+            return numpy.load(path, mmap_mode="r")
+        return numpy.memmap(path, dtype=dtype or numpy.uint8, mode="r", offset=offset,
+                            shape=shape)
+
+
+def is_npy(path):
+    with open(path, "rb") as f:
+        return f.read(6) == b"\x93NUMPY"
+
+
+def flatten(source, target=None, dtype=None):
+    """
+    Converts a file of arrays into .npy files that Resources.memmap can map,
+    returning their paths by name (the target path for single arrays):
+      .npy          - returned as is, or converted to `dtype` (by default
+                      into {source}_{dtype}.npy)
+      .npz          - each array is written to {target}/{name}.npy
+      .pkl/.pickle  - a pickled array, or dict of arrays, is written as for
+                      .npy/.npz
+      .vec or word vectors in .txt - word2vec or GloVe text, written to
+                      {target}.npy with one word per line in {target}.vocab
+      .csv/.tsv/.txt - a table of numbers is written to {target}.npy
+    `target` defaults to `source` without its extension, and `dtype` converts
+    arrays, such as to float32 to halve the size of float64 embeddings.
+    """
+    import numpy
+    base, extension = os.path.splitext(source)
+    extension = extension.lower()
+    target = target or base
+
+    def save(array, path):
+        array = numpy.asarray(array)
+        if array.dtype == object:
+            raise ValueError("Arrays of Python objects cannot be mapped")
+        if dtype is not None:
+            array = array.astype(dtype)
+        if not path.endswith(".npy"):
+            path += ".npy"
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        numpy.save(path, numpy.ascontiguousarray(array))
+        return path
+
+    def save_all(arrays):
+        return dict((name, save(array, os.path.join(target, name)))
+                    for name, array in arrays.items())
+
+    if extension == ".npy":
+        # Fails for arrays of Python objects, which cannot be mapped
+        array = numpy.load(source, mmap_mode="r", allow_pickle=False)
+        if dtype is None:
+            return source
+        return save(array, target if target != base else
+                    "%s_%s" % (base, numpy.dtype(dtype).name))
+    if extension == ".npz":
+        with numpy.load(source, allow_pickle=False) as arrays:
+            return save_all(dict(arrays.items()))
+    if extension in (".pkl", ".pickle"):
+        with open(source, "rb") as f:
+            value = pickle.load(f)
+        return save_all(value) if isinstance(value, dict) else save(value, target)
+    if extension == ".vec" or (extension == ".txt" and is_word_vectors(source)):
+        return flatten_word_vectors(source, target, dtype or numpy.float32)
+    if extension in TEXT_DELIMITERS:
+        return save(numpy.loadtxt(source, delimiter=TEXT_DELIMITERS[extension], ndmin=2), target)
+    raise ValueError("Cannot flatten %s files" % extension)
+
+
+def word2vec_header(line):
+    """
+    The number of dimensions given by a word2vec "{words} {dimensions}" header
+    line, or None if `line` is not one
+    """
+    fields = line.split()
+    if len(fields) != 2:
+        return None
+    try:
+        words, dimensions = int(fields[0]), int(fields[1])
+    except ValueError:
+        return None
+    return dimensions if words >= 0 and dimensions > 0 else None
+
+
+def is_word_vectors(path):
+    """
+    Whether a text file starts with a word followed by numbers, after a
+    word2vec header if it has one
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        first, second = f.readline(), f.readline()
+    dimensions = word2vec_header(first)
+    if dimensions is not None:
+        # A table of two integer columns is not a header followed by vectors
+        return len(second.split()) == dimensions + 1
+    fields = first.split()
+    try:
+        [float(value) for value in fields[1:]]
+    except ValueError:
+        return False
+    try:
+        float(fields[0])
+    except (ValueError, IndexError):
+        return len(fields) > 1
+    return False
+
+
+def flatten_word_vectors(source, target, dtype):
+    """
+    Converts word2vec or GloVe text into {target}.npy, with a row per word,
+    and {target}.vocab with a word per line. Returns their paths.
+    """
+    import numpy
+    words, rows = [], []
+    with open(source, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f):
+            if number == 0 and word2vec_header(line) is not None:
+                continue
+            fields = line.rstrip().split(" ")
+            words.append(fields[0])
+            rows.append(numpy.array(fields[1:], dtype=dtype))
+    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    numpy.save(target + ".npy", numpy.vstack(rows))
+    with open(target + ".vocab", "w", encoding="utf-8") as f:
+        f.write("".join(word + "\n" for word in words))
+    return {"vectors": target + ".npy", "vocab": target + ".vocab"}
@@ -0,0 +1,105 @@
+"""
+ scheduler.py
+ Orders the requests waiting in a model worker.
+
+ Requests are served by strict priority: every waiting request of a more
+ urgent priority class (a lower number) is served before any request of a less
+ urgent one. Within a class, callers share the worker by weighted fair
+ queuing. Each request is tagged with a virtual finish time, which advances by
+ cost / weight from the later of the caller's previous tag and the class's
+ virtual clock, and requests are served in tag order. A caller sending a burst
+ of requests then only delays other callers by its weighted share.
+"""
+
+import heapq
+import itertools
+
+PRIORITY_CLASSES = {
+    "interactive": 0,
+    "batch": 1
+}
+# Control messages from the front end are handled before any request
+CONTROL_PRIORITY = -1
+
+
+def priority_class(value, default=0):
+    """
+    Parses a priority class given by name or number, raising ValueError for
+    anything else
+    """
+    if value is None or value == "":
+        return default
+    if value in PRIORITY_CLASSES:
+        return PRIORITY_CLASSES[value]
+    priority = int(value)
+    if priority < 0:
+        raise ValueError("Priority must not be negative")
+    return priority
+
+
+class RequestQueue(object):
+    def __init__(self, weights=None):
+        self.weights = weights or {}
+        self._heaps = {}
+        # Virtual clock and callers' last finish tags, per priority class
+        self._clock = {}
+        self._finish = {}
+        self._sequence = itertools.count()
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, item):
+        priority = CONTROL_PRIORITY if "control" in item else item.get("priority", 0)
+        caller = item.get("caller")
+        cost = len(item["data"]) if item.get("bulk") else 1
+        finish_tags = self._finish.setdefault(priority, {})
+        start = max(self._clock.get(priority, 0), finish_tags.get(caller, 0))
+        finish = start + cost / float(self.weights.get(caller, 1))
+        finish_tags[caller] = finish
+        heapq.heappush(self._heaps.setdefault(priority, []),
+                       (finish, next(self._sequence), item))
+        self._length += 1
+
+    def _advance(self, priority, finish):
+        self._clock[priority] = max(self._clock.get(priority, 0), finish)
+        self._length -= 1
+
+    def _prune(self, priority):
+        # An idle class starts afresh, so tags for past callers are not kept
+        if not self._heaps[priority]:
+            del self._heaps[priority]
+            del self._clock[priority]
+            del self._finish[priority]
+
+    def popleft(self):
+        """
+        Removes and returns the next request to serve
+        """
+        priority = min(self._heaps)
+        finish, sequence, item = heapq.heappop(self._heaps[priority])
+        self._advance(priority, finish)
+        self._prune(priority)
+        return item
+
+    def take(self, predicate, limit):
+        """
+        Removes and returns up to `limit` requests matching `predicate`, in the
+        order they would be served
+        """
+        taken = []
+        for priority in sorted(self._heaps):
+            if len(taken) >= limit:
+                break
+            kept = []
+            # A sorted list is a valid heap
+            for entry in sorted(self._heaps[priority]):
+                if len(taken) < limit and predicate(entry[2]):
+                    taken.append(entry[2])
+                    self._advance(priority, entry[0])
+                else:
+                    kept.append(entry)
+            self._heaps[priority] = kept
+            self._prune(priority)
+        return taken
@@ -0,0 +1,145 @@
+"""
+ supervisor.py
+ Replaces model worker processes that die or hang.
+
+ A Supervisor thread in the front end checks a model's workers every
+ `interval` seconds. When a worker's process has exited (a segfault in native
+ code, an OOM kill, ...) its requests in flight fail at once with a
+ DispatchError, and a replacement takes its place in the dispatcher. With
+ `worker_timeout` set, a worker that has had requests in flight for that many
+ seconds without sending anything back is considered hung and is killed.
+
+ Replacements are forked from the front end, which holds the loaded model
+ (lazy models are loaded again by the replacement), but they still have to
+ enter the model's context before serving. With
+ `spare_workers`, that many extra workers are started and kept idle, and a
+ worker that dies is replaced by promoting a spare, after which a new spare is
+ started in the background.
+
+ A worker that dies soon after starting is replaced after an increasing delay,
+ so that a model that cannot start is not forked continuously.
+"""
+
+import collections
+import threading
+import time
+
+# Workers that exit sooner than this after starting delay their replacement
+MIN_LIFETIME = 10
+MAX_RESTART_DELAY = 30
+
+
+class Supervisor(object):
+    def __init__(self, dispatcher, spawn, processes, spares=(), worker_timeout=None,
+                 interval=0.5):
+        """
+        `spawn` starts a worker process, returning (process, conn). `processes`
+        are the processes of the dispatcher's workers, in order, and `spares`
+        are (process, conn) pairs for idle workers.
+        """
+        self.dispatcher = dispatcher
+        self.spawn = spawn
+        self.processes = list(processes)
+        self.spares = collections.deque(spares)
+        self.spare_workers = len(self.spares)
+        self.worker_timeout = worker_timeout
+        self.interval = interval
+        self.restarts = 0
+        self._started = [time.time()] * len(self.processes)
+        self._delay = 0
+        self._next_spawn = 0
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="supervisor-%s" % self.dispatcher.name)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Stops supervising, and stops every worker process
+        """
+        with self._lock:
+            self._stopped = True
+            for process in self.processes + [process for process, conn in self.spares]:
+                process.terminate()
+            for idx, process in enumerate(self.processes):
+                process.join()
+                self.dispatcher.workers[idx].close("Model %s was stopped" % self.dispatcher.name)
+            for process, conn in self.spares:
+                process.join()
+                conn.close()
+
+    def pids(self):
+        """
+        The process ids of every worker, including spares
+        """
+        return [process.pid for process in self.processes + [spare[0] for spare in self.spares]]
+
+    def _run(self):
+        while not self._stopped:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                print("Failed to check workers of model %s: %s" % (self.dispatcher.name, e))
+
+    def check(self):
+        """
+        Kills hung workers and replaces any that have exited
+        """
+        with self._lock:
+            if not self._stopped:
+                self._check()
+
+    def _check(self):
+        for idx, process in enumerate(self.processes):
+            worker = self.dispatcher.workers[idx]
+            if not worker.alive and process.is_alive():
+                # The pipe closes before the process has finished exiting
+                process.join(1)
+                if process.is_alive():
+                    print("Model worker %s closed its pipe, killing it" % worker.name)
+                    process.kill()
+                    process.join()
+            if self.worker_timeout and process.is_alive() and worker.stalled(self.worker_timeout):
+                print("Model worker %s made no progress for %ss, killing it" %
+                      (worker.name, self.worker_timeout))
+                process.kill()
+                process.join()
+            if not process.is_alive() and time.time() >= self._next_spawn:
+                self.replace(idx)
+        for spare in list(self.spares):
+            if not spare[0].is_alive():
+                print("Spare worker for model %s exited with code %s" %
+                      (self.dispatcher.name, spare[0].exitcode))
+                self.spares.remove(spare)
+                spare[1].close()
+                self._backoff(0)
+        while len(self.spares) < self.spare_workers and time.time() >= self._next_spawn:
+            self.spares.append(self.spawn())
+
+    def replace(self, idx):
+        process = self.processes[idx]
+        process.join()
+        worker = self.dispatcher.workers[idx]
+        message = "Model worker %s exited with code %s" % (worker.name, process.exitcode)
+        print(message)
+        worker.close(message)
+        self._backoff(time.time() - self._started[idx])
+        if self.spares:
+            process, conn = self.spares.popleft()
+        else:
+            process, conn = self.spawn()
+        self.processes[idx] = process
+        self._started[idx] = time.time()
+        self.dispatcher.replace_worker(idx, conn)
+        self.restarts += 1
+
+    def _backoff(self, lifetime):
+        if lifetime >= MIN_LIFETIME:
+            self._delay = 0
+            return
+        self._delay = min(max(self._delay * 2, 1), MAX_RESTART_DELAY)
+        self._next_spawn = time.time() + self._delay
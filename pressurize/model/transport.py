@@ -0,0 +1,120 @@
+"""
+ transport.py
+ Moves large messages between the front end and model workers through shared
+ memory instead of through the pipe.
+
+ Messages are pickled with protocol 5, so buffers such as NumPy arrays are
+ kept out-of-band. When a message's out-of-band buffers add up to the
+ transport's threshold, the pickle stream and its buffers are written once
+ into an anonymous shared memory file (memfd), whose file descriptor is passed
+ to the other process over the pipe's unix socket. Only a small
+ SharedMemoryDescriptor travels through the pipe itself. The receiver maps the
+ file copy-on-write and unpickles directly from the mapping, so out-of-band
+ buffers are not copied again.
+
+ Only out-of-band buffers gain from this: messages made of ordinary Python
+ objects, such as decoded JSON or bytes (which pickle keeps in-band), are
+ unpickled into new objects either way, and benchmarks/bench_transport.py
+ shows them no faster through shared memory. They use the pipe exactly as
+ before, as do all messages on platforms without memfd or pickle protocol 5.
+"""
+
+import mmap
+import os
+import pickle
+import socket
+from multiprocessing import reduction
+
+SHARED_MEMORY_SUPPORTED = hasattr(os, "memfd_create") and pickle.HIGHEST_PROTOCOL >= 5
+DEFAULT_THRESHOLD = 1024 * 1024
+IOV_MAX = 1024
+
+
+class SharedMemoryDescriptor(object):
+    def __init__(self, size, stream_length, buffer_lengths):
+        self.size = size
+        self.stream_length = stream_length
+        self.buffer_lengths = buffer_lengths
+
+
+class SharedMemoryConnection(object):
+    """
+    Wraps one end of a duplex multiprocessing Pipe, sending messages with at
+    least `threshold` bytes of out-of-band buffers through shared memory.
+    """
+    def __init__(self, conn, threshold=DEFAULT_THRESHOLD):
+        self._conn = conn
+        self._threshold = threshold
+        self._sock = None
+
+    def _socket(self):
+        # Created lazily so that only the process using this end holds a duplicate
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM,
+                                       fileno=os.dup(self._conn.fileno()))
+        return self._sock
+
+    def fileno(self):
+        return self._conn.fileno()
+
+    @property
+    def closed(self):
+        return self._conn.closed
+
+    def poll(self, timeout=0.0):
+        return self._conn.poll(timeout)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+        self._conn.close()
+
+    def send(self, obj):
+        if not SHARED_MEMORY_SUPPORTED:
+            return self._conn.send(obj)
+        buffers = []
+        stream = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        views = [buf.raw() for buf in buffers]
+        if sum(view.nbytes for view in views) < self._threshold:
+            if views:
+                stream = pickle.dumps(obj, protocol=5)
+            return self._conn.send_bytes(stream)
+
+        fd = os.memfd_create("pressurize-message", os.MFD_CLOEXEC)
+        try:
+            chunks = [memoryview(stream)] + views
+            while chunks:
+                written = os.writev(fd, chunks[:IOV_MAX])
+                while chunks and written >= chunks[0].nbytes:
+                    written -= chunks[0].nbytes
+                    chunks.pop(0)
+                if chunks:
+                    chunks[0] = chunks[0][written:]
+            size = len(stream) + sum(view.nbytes for view in views)
+            descriptor = SharedMemoryDescriptor(size, len(stream),
+                                                [view.nbytes for view in views])
+            self._conn.send_bytes(pickle.dumps(descriptor, protocol=5))
+            reduction.sendfds(self._socket(), [fd])
+        finally:
+            os.close(fd)
+
+    def recv(self):
+        if not SHARED_MEMORY_SUPPORTED:
+            return self._conn.recv()
+        obj = pickle.loads(self._conn.recv_bytes())
+        if not isinstance(obj, SharedMemoryDescriptor):
+            return obj
+
+        fd = reduction.recvfds(self._socket(), 1)[0]
+        try:
+            shared = mmap.mmap(fd, obj.size, access=mmap.ACCESS_COPY)
+        finally:
+            os.close(fd)
+        # Out-of-band buffers keep the mapping alive for as long as they are used
+        view = memoryview(shared)
+        buffers = []
+        offset = obj.stream_length
+        for length in obj.buffer_lengths:
+            buffers.append(view[offset:offset + length])
+            offset += length
+        return pickle.loads(view[:obj.stream_length], buffers=buffers)
@@ -0,0 +1,63 @@
+# Copyright 2017 Morgan McDermott
+
+import unittest
+from pressurize.model import activation
+from pressurize.model.activation import ActivationManager
+from pressurize.model.dispatcher import OverloadedError
+
+class Dispatcher(object):
+    def __init__(self):
+        self.requests = 0
+        self.streams = 0
+
+    def outstanding(self):
+        return self.requests
+
+    def in_flight(self):
+        return self.requests + self.streams
+
+class Supervisor(object):
+    def __init__(self):
+        self.dispatcher = Dispatcher()
+
+    def pids(self):
+        return []
+
+class TestActivationManager(unittest.TestCase):
+    def setUp(self):
+        activation.MIN_IDLE = 0
+        self.supervisors = {}
+        self.manager = ActivationManager(self.supervisors, memory_budget=200)
+        for name in ("a", "b", "c"):
+            self.manager.register(name, lambda name=name: self.start(name),
+                                  lambda name=name: self.supervisors.pop(name), required_memory=100)
+
+    def tearDown(self):
+        activation.MIN_IDLE = 1
+
+    def start(self, name):
+        self.supervisors[name] = Supervisor()
+
+    def test_evicts_least_recently_used(self):
+        self.manager.activate("a")
+        self.manager.activate("b")
+        self.manager.activate("a")
+        self.manager.activate("c")
+        self.assertEqual(sorted(self.supervisors), ["a", "c"])
+        self.assertEqual(self.manager.evictions["b"], 1)
+
+    def test_busy_models_are_not_evicted(self):
+        self.manager.activate("a")
+        self.manager.activate("b")
+        self.supervisors["a"].dispatcher.requests = 1
+        self.supervisors["b"].dispatcher.requests = 1
+        self.assertRaises(OverloadedError, self.manager.activate, "c")
+        self.assertEqual(sorted(self.supervisors), ["a", "b"])
+
+    def test_streaming_models_are_not_evicted(self):
+        self.manager.activate("a")
+        self.manager.activate("b")
+        self.supervisors["a"].dispatcher.streams = 1
+        self.supervisors["b"].dispatcher.streams = 1
+        self.assertRaises(OverloadedError, self.manager.activate, "c")
+        self.assertEqual(sorted(self.supervisors), ["a", "b"])
@@ -0,0 +1,159 @@
+# Copyright 2017 Morgan McDermott
+
+import asyncio
+import json
+import unittest
+from pressurize.model import async_server
+
+async def handler(request):
+    if request.path == "/echo/":
+        body = await request.body()
+        return 200, {"Content-Type": "application/json"}, json.dumps({
+            "method": request.method,
+            "query": request.query,
+            "header": request.headers.get("x-test"),
+            "body": body.decode("utf-8")
+        }).encode("utf-8")
+    if request.path == "/lines/":
+        lines = [line async for line in request.lines()]
+        return 200, {}, b"|".join(lines)
+    if request.path == "/wait/":
+        await request.body()
+        watcher = asyncio.ensure_future(request.disconnected())
+        done, pending = await asyncio.wait([watcher], timeout=0.2)
+        watcher.cancel()
+        return 200, {}, b"disconnected" if done else b"connected"
+    if request.path == "/stream/":
+        async def chunks():
+            for idx in range(3):
+                yield b"%d\n" % idx
+        return 200, {}, chunks()
+    if request.path == "/broken-stream/":
+        async def chunks():
+            yield b"0\n"
+            raise RuntimeError("Failed mid-stream")
+        return 200, {}, chunks()
+    raise RuntimeError("Failed to handle request")
+
+async def read_response(reader):
+    """
+    Reads a response, returning (status, headers, body)
+    """
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line == b"\r\n":
+            break
+        key, value = line.decode("latin-1").split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+    if headers.get("transfer-encoding") != "chunked":
+        return status, headers, await reader.readexactly(int(headers["content-length"]))
+    body = b""
+    while True:
+        size = int(await reader.readline(), 16)
+        if size == 0:
+            await reader.readline()
+            return status, headers, body
+        body += await reader.readexactly(size)
+        await reader.readline()
+
+class TestAsyncServer(unittest.TestCase):
+    def exchange(self, *requests, half_close=False):
+        """
+        Sends raw requests over one connection, returning the responses read
+        and whether the server then closed the connection. With `half_close`,
+        the client stops sending after the requests.
+        """
+        async def run():
+            server = await async_server.create_server(handler, asyncio.get_event_loop(),
+                                                      host="127.0.0.1", port=0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            responses = []
+            try:
+                for request in requests:
+                    writer.write(request)
+                    if half_close:
+                        writer.write_eof()
+                    try:
+                        responses.append(await asyncio.wait_for(read_response(reader), 5))
+                    except (asyncio.IncompleteReadError, ValueError, IndexError):
+                        responses.append(None)
+                        break
+                closed = await asyncio.wait_for(reader.read(), 5) == b""
+            finally:
+                writer.close()
+                server.close()
+                await server.wait_closed()
+            return responses, closed
+        # asyncio.run is not available on Python 3.6
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_request_parsing(self):
+        (response,), closed = self.exchange(
+            b"POST /echo/?a=1 HTTP/1.1\r\nX-Test: value\r\nContent-Length: 7\r\n"
+            b"Connection: close\r\n\r\n{\"a\":1}")
+        status, headers, body = response
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode("utf-8")),
+                         {"method": "POST", "query": "a=1", "header": "value", "body": '{"a":1}'})
+        self.assertEqual(headers["connection"], "close")
+        self.assertTrue(closed)
+
+    def test_chunked_request(self):
+        (response,), closed = self.exchange(
+            b"POST /lines/ HTTP/1.1\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+            b"4\r\na\nbc\r\n3\r\n\nd\n\r\n0\r\n\r\n")
+        self.assertEqual(response[2], b"a|bc|d")
+
+    def test_keep_alive(self):
+        request = b"POST /echo/ HTTP/1.1\r\nContent-Length: 2\r\n\r\nhi"
+        responses, closed = self.exchange(request, request,
+                                          b"GET /echo/ HTTP/1.0\r\n\r\n")
+        self.assertEqual([response[0] for response in responses], [200, 200, 200])
+        self.assertEqual(responses[0][1]["connection"], "keep-alive")
+        self.assertEqual(responses[2][1]["connection"], "close")
+        self.assertTrue(closed)
+
+    def test_unread_body_is_skipped(self):
+        responses, closed = self.exchange(
+            b"GET /stream/ HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello",
+            b"GET /echo/ HTTP/1.1\r\nConnection: close\r\n\r\n")
+        self.assertEqual([response[0] for response in responses], [200, 200])
+
+    def test_chunked_response(self):
+        (response,), closed = self.exchange(b"GET /stream/ HTTP/1.1\r\nConnection: close\r\n\r\n")
+        status, headers, body = response
+        self.assertEqual(headers["transfer-encoding"], "chunked")
+        self.assertEqual(body, b"0\n1\n2\n")
+
+    def test_handler_error(self):
+        responses, closed = self.exchange(b"GET /missing/ HTTP/1.1\r\n\r\n",
+                                          b"GET /echo/ HTTP/1.1\r\nConnection: close\r\n\r\n")
+        self.assertEqual(responses[0][0], 500)
+        self.assertEqual(json.loads(responses[0][2].decode("utf-8")),
+                         {"error": "Internal server error"})
+        # The connection is still usable
+        self.assertEqual(responses[1][0], 200)
+
+    def test_error_mid_stream(self):
+        responses, closed = self.exchange(b"GET /broken-stream/ HTTP/1.1\r\n\r\n")
+        self.assertEqual(responses, [None])
+        self.assertTrue(closed)
+
+    def test_malformed_request(self):
+        responses, closed = self.exchange(b"NONSENSE\r\n\r\n")
+        self.assertEqual(responses, [None])
+        self.assertTrue(closed)
+
+    def test_disconnected(self):
+        request = b"POST /wait/ HTTP/1.1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+        (response,), closed = self.exchange(request)
+        self.assertEqual(response[2], b"connected")
+        (response,), closed = self.exchange(request, half_close=True)
+        self.assertEqual(response[2], b"disconnected")
@@ -0,0 +1,56 @@
+# Copyright 2017 Morgan McDermott
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from pressurize.model.batch_predict import batch_predict
+
+TEST_DIR = os.path.join(os.path.dirname(__file__), "..", "test_data", "test_model_server")
+
+class TestBatchPredict(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        with open(os.path.join(TEST_DIR, "pressurize.json")) as f:
+            self.config = json.load(f)
+        self.config["models"][0]["required_resources"]["parameters"] = \
+            os.path.join(TEST_DIR, "parameters.txt")
+        self.output_path = os.path.join(self.tmp, "results.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_batch_predict(self, lines, method="predict", **kwargs):
+        input_path = os.path.join(self.tmp, "requests.jsonl")
+        with open(input_path, "w") as f:
+            f.write("".join(line + "\n" for line in lines))
+        summary = batch_predict(self.config, "TestModel", method, input_path, self.output_path,
+                                source_path=TEST_DIR, resource_path=self.tmp, **kwargs)
+        with open(self.output_path) as f:
+            return summary, [json.loads(line) for line in f]
+
+    def test_output_order(self):
+        lines = ['{"data": {"number": %d}}' % number for number in range(25)]
+        (records, errors, seconds), results = self.run_batch_predict(lines, processes=3,
+                                                                      batch_size=2)
+        self.assertEqual((records, errors), (25, 0))
+        self.assertEqual([res["result"]["number"] for res in results], list(range(1, 26)))
+        self.assertEqual(results[0]["result"]["parameters"], "123\n")
+
+    def test_invalid_lines(self):
+        with open(os.path.join(TEST_DIR, "payloads.jsonl")) as f:
+            lines = [line.rstrip("\n") for line in f]
+        lines[1:1] = ["not json", "", '{"data": {}}']
+        (records, errors, seconds), results = self.run_batch_predict(lines, processes=2,
+                                                                      batch_size=2)
+        self.assertEqual((records, errors), (5, 2))
+        self.assertEqual(results[0]["result"]["number"], 2)
+        self.assertEqual(results[1], {"error": "Invalid JSON request"})
+        self.assertTrue(results[2]["error"].startswith("Exception: "))
+        self.assertEqual([res["result"]["number"] for res in results[3:]], [3, 4])
+
+    def test_unknown_model_or_method(self):
+        self.assertRaises(RuntimeError, self.run_batch_predict, [], method="missing")
+        self.config["models"][0]["name"] = "OtherModel"
+        self.assertRaises(RuntimeError, self.run_batch_predict, [])
@@ -0,0 +1,82 @@
+# Copyright 2017 Morgan McDermott
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from click.testing import CliRunner
+from pressurize.cli import cli
+from pressurize.model import bench
+
+TEST_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "test_data",
+                                        "test_model_server"))
+os.environ.setdefault("PRESSURIZE_LOGFILE", os.devnull)
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class TestBench(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(bench.percentile(values, 50), 50)
+        self.assertEqual(bench.percentile(values, 99), 99)
+        self.assertEqual(bench.percentile(values, 99.9), 100)
+        self.assertEqual(bench.percentile([7], 50), 7)
+        self.assertIsNone(bench.percentile([], 50))
+
+    def test_summarize(self):
+        samples = [(0.01 * idx, True) for idx in range(1, 11)] + [(5.0, False)] * 2
+        summary = bench.summarize("rate", 20, samples, 2.0)
+        self.assertEqual(summary["requests"], 12)
+        self.assertEqual(summary["throughput"], 5.0)
+        self.assertAlmostEqual(summary["error_rate"], 2 / 12.0)
+        # Failed requests are left out of the percentiles
+        self.assertAlmostEqual(summary["p50_ms"], 50)
+        self.assertAlmostEqual(summary["p999_ms"], 100)
+
+    def test_unreachable_server(self):
+        results = bench.bench("http://127.0.0.1:%d/api/TestModel/predict/" % free_port(),
+                              [{"data": {"number": 1}}], concurrency=[2], duration=0.3,
+                              warmup=0)
+        self.assertGreater(results[0]["requests"], 0)
+        self.assertEqual(results[0]["error_rate"], 1.0)
+        self.assertIsNone(results[0]["p50_ms"])
+        table = bench.format_table(results).splitlines()
+        self.assertEqual(table[0].split()[:2], ["mode", "level"])
+        self.assertEqual(table[1].split()[4:8], ["-"] * 4)
+
+    def test_cli(self):
+        tmp = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        json_path = os.path.join(tmp, "results.json")
+        os.chdir(TEST_DIR)
+        try:
+            result = CliRunner().invoke(cli, [
+                "bench", "TestModel", "predict", "--payloads", "payloads.jsonl",
+                "--resource", "parameters=parameters.txt", "--port", str(free_port()),
+                "--concurrency", "1,2", "--duration", "0.5", "--warmup", "0.2",
+                "--json", json_path])
+            with open(json_path) as f:
+                results = json.load(f)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual([(res["mode"], res["level"]) for res in results],
+                         [("concurrency", 1), ("concurrency", 2)])
+        for res in results:
+            self.assertGreater(res["requests"], 0)
+            self.assertEqual(res["error_rate"], 0)
+            self.assertLessEqual(res["p50_ms"], res["p95_ms"])
+            self.assertLessEqual(res["p95_ms"], res["p99_ms"])
+            self.assertLessEqual(res["p99_ms"], res["p999_ms"])
+        lines = [line.split() for line in result.output.splitlines()]
+        self.assertIn(["mode", "level", "requests", "throughput", "p50_ms", "p95_ms",
+                       "p99_ms", "p999_ms", "error_rate"], lines)
+        self.assertEqual(len([line for line in lines if line[:1] == ["concurrency"]]), 2)
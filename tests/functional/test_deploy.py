@@ -57,3 +57,66 @@ class TestDeployComponents(unittest.TestCase):
     def create_api_cluster(self):
         controller = Controller(self.config)
         cluster = controller._resource_manager.create_api_cluster("somefile.zip")
+
+# Named after a hash of "Medium,Small,Tiny"
+SHARED = 'shared43e91c9f'
+
+class TestPackModels(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            "deployment_name": "pressurize_test",
+            "aws_region": "us-west-2",
+            "pack_models": True,
+            "models": [
+                self.model("Small", 1, 0.5),
+                self.model("Medium", 2, 1.5),
+                self.model("Tiny", 1, 0.3),
+                self.model("Large", 8, 30),
+                self.model("Pinned", 1, 0.5, instance_type="t2.small")
+            ]
+        }
+
+    def model(self, name, ecu, memory, **conf):
+        conf.update({"name": name, "path": "TestModel.TestModel", "methods": ["predict"],
+                     "required_ecu": ecu, "required_memory": memory,
+                     "required_resources": {}})
+        return conf
+
+    def test_packs_small_models(self):
+        controller = Controller(self.config)
+        deployments = {d['name']: d for d in controller.deployments()}
+        self.assertEqual(deployments[SHARED]['models'], ['Medium', 'Small', 'Tiny'])
+        self.assertEqual(deployments['Pinned']['instance_type'], 't2.small')
+        self.assertEqual(deployments['Large']['models'], ['Large'])
+        for deployment in deployments.values():
+            self.assertTrue(deployment['memory'] > deployment['required_memory'] or
+                            deployment['name'] == 'Pinned')
+
+        unpacked = controller._resource_manager.plan_deployments(self.config['models'])
+        self.assertEqual(len(unpacked), 5)
+        self.assertTrue(sum(d['hourly_cost'] for d in deployments.values()) <
+                        sum(d['hourly_cost'] for d in unpacked))
+
+    def test_deployment_config(self):
+        controller = Controller(self.config)
+        config = controller.deployment_config(SHARED)
+        self.assertEqual([model['name'] for model in config['models']],
+                         ['Small', 'Medium', 'Tiny'])
+        self.assertTrue(all(model['deployment'] == SHARED for model in config['models']))
+        self.assertEqual(controller.api_config()['models'][3]['deployment'], 'Large')
+        self.assertEqual(controller.deployment_for('Tiny')['name'], SHARED)
+
+    def test_shared_names(self):
+        self.config['models'].reverse()
+        self.assertIn(SHARED, [d['name'] for d in Controller(self.config).deployments()])
+        # A name taken by a model gets a longer hash
+        self.config['models'].append(self.model(SHARED, 1, 0.5, instance_type="t2.small"))
+        names = [d['name'] for d in Controller(self.config).deployments()]
+        self.assertEqual(names.count(SHARED), 1)
+        self.assertIn('shared43e91c9fd', names)
+
+    def test_unpacked_by_default(self):
+        del self.config['pack_models']
+        controller = Controller(self.config)
+        self.assertEqual([d['name'] for d in controller.deployments()],
+                         ['Small', 'Medium', 'Tiny', 'Large', 'Pinned'])
@@ -0,0 +1,96 @@
+# Copyright 2017 Morgan McDermott
+
+import threading
+import unittest
+from multiprocessing import Pipe
+from pressurize.model.dispatcher import ModelDispatcher, DispatchError, OverloadedError
+
+class TestDispatcher(unittest.TestCase):
+    def setUp(self):
+        server_conn, self.worker_conn = Pipe()
+        self.dispatcher = ModelDispatcher("TestModel", [server_conn])
+
+    def serve(self, respond):
+        def worker():
+            item = self.worker_conn.recv()
+            for response in respond(item):
+                response["resId"] = item["resId"]
+                self.worker_conn.send(response)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        return thread
+
+    def test_response(self):
+        thread = self.serve(lambda item: [{"result": item["data"]["number"] + 1}])
+        res = self.dispatcher.submit("predict", {"number": 1}).result(timeout=5)
+        thread.join()
+        self.assertEqual(res["result"], 2)
+        self.assertIn("returned", res["timings"])
+        self.assertEqual(self.dispatcher.in_flight(), 0)
+
+    def test_stream(self):
+        thread = self.serve(lambda item: [{"chunk": 0}, {"chunk": 1}, {"done": True}])
+        stream = self.dispatcher.submit("generate", {}).result(timeout=5)["stream"]
+        messages = [stream.get().result(timeout=5) for idx in range(3)]
+        thread.join()
+        self.assertEqual([message.get("chunk") for message in messages], [0, 1, None])
+        self.assertTrue(messages[-1]["done"])
+        self.assertEqual(self.dispatcher.in_flight(), 0)
+
+    def test_stream_worker_exit(self):
+        def respond(item):
+            yield {"chunk": 0}
+            self.worker_conn.close()
+        thread = self.serve(respond)
+        stream = self.dispatcher.submit("generate", {}).result(timeout=5)["stream"]
+        thread.join()
+        self.assertEqual(stream.get().result(timeout=5)["chunk"], 0)
+        self.assertRaises(DispatchError, stream.get().result, 5)
+
+    def test_admission_control(self):
+        self.dispatcher.max_queue_size_by_method = {"predict": 1}
+        release = threading.Event()
+        def respond(item):
+            release.wait(5)
+            yield {"result": 1}
+        thread = self.serve(respond)
+        future = self.dispatcher.submit("predict", {})
+        with self.assertRaises(OverloadedError) as context:
+            self.dispatcher.submit("predict", {})
+        self.assertGreaterEqual(context.exception.retry_after, 1)
+        self.assertEqual(self.dispatcher.rejected["predict"], 1)
+        release.set()
+        future.result(timeout=5)
+        thread.join()
+
+    def test_stream_admission_control(self):
+        self.dispatcher.max_queue_size = 1
+        release = threading.Event()
+        def respond(item):
+            yield {"chunk": 0}
+            release.wait(5)
+            yield {"done": True}
+        thread = self.serve(respond)
+        stream = self.dispatcher.submit("generate", {}).result(timeout=5)["stream"]
+        self.assertEqual(stream.get().result(timeout=5)["chunk"], 0)
+        # The open stream still holds its slot
+        self.assertRaises(OverloadedError, self.dispatcher.submit, "generate", {})
+        release.set()
+        self.assertTrue(stream.get().result(timeout=5)["done"])
+        thread.join()
+        self.assertEqual(self.dispatcher.outstanding(), 0)
+
+    def test_bulk_not_admission_controlled(self):
+        self.dispatcher.max_queue_size = 50
+        release = threading.Event()
+        def respond(item):
+            release.wait(5)
+            yield {"results": [{"result": 1}] * len(item["data"])}
+        thread = self.serve(respond)
+        bulk = self.dispatcher.submit("predict", [{}] * 100, bulk=True)
+        self.assertEqual(self.dispatcher.outstanding(), 100)
+        future = self.dispatcher.submit("predict", {})
+        self.assertEqual(self.dispatcher.outstanding(), 101)
+        release.set()
+        bulk.result(timeout=5)
+        thread.join()
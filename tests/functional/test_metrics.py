@@ -0,0 +1,26 @@
+# Copyright 2017 Morgan McDermott
+
+import unittest
+from pressurize.model.metrics import Registry, Histogram, Gauge
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_render(self):
+        registry = Registry()
+        histogram = registry.register(Histogram("latency_seconds", "Latency",
+                                                ("model",), buckets=(0.1, 1.0)))
+        histogram.observe(("TestModel",), 0.05)
+        histogram.observe(("TestModel",), 0.5)
+        histogram.observe(("TestModel",), 5)
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE latency_seconds histogram", lines)
+        self.assertIn('latency_seconds_bucket{model="TestModel",le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{model="TestModel",le="1.0"} 2', lines)
+        self.assertIn('latency_seconds_bucket{model="TestModel",le="+Inf"} 3', lines)
+        self.assertIn('latency_seconds_sum{model="TestModel"} 5.55', lines)
+        self.assertIn('latency_seconds_count{model="TestModel"} 3', lines)
+
+    def test_gauge_render(self):
+        registry = Registry()
+        registry.register(Gauge("in_flight", "In flight", ("model",),
+                                lambda: {("TestModel",): 2}))
+        self.assertIn('in_flight{model="TestModel"} 2.0', registry.render().splitlines())
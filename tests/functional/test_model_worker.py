@@ -0,0 +1,346 @@
+# Copyright 2017 Morgan McDermott
+
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from pressurize.model import model_server
+from pressurize.model.activation import ActivationManager
+from pressurize.model.dispatcher import ModelDispatcher
+from pressurize.model.model_server import ModelServer, ModelRequest, BulkRequest, stage_durations
+
+TEST_DIR = os.path.join(os.path.dirname(__file__), "..", "test_data", "test_model_server")
+os.environ.setdefault("PRESSURIZE_LOGFILE", os.devnull)
+
+class WorkerTestCase(unittest.TestCase):
+    """
+    Runs a worker process for EchoModel, with a dispatcher in the test
+    """
+    model_conf = {}
+
+    def setUp(self):
+        context = multiprocessing.get_context("fork")
+        server_conn, worker_conn = context.Pipe()
+        model_conf = {"name": "EchoModel", "path": "models.EchoModel.EchoModel",
+                      "required_resources": {}}
+        model_conf.update(self.model_conf)
+        server = ModelServer({}, TEST_DIR, None, model_conf)
+        self.process = context.Process(target=server.run, args=(worker_conn,))
+        self.process.start()
+        worker_conn.close()
+        self.dispatcher = ModelDispatcher("EchoModel", [server_conn])
+
+    def tearDown(self):
+        self.process.terminate()
+        self.process.join(5)
+        self.dispatcher.workers[0].close("Test finished")
+
+    def predict(self, number, **params):
+        data = dict(params, number=number)
+        return self.dispatcher.submit("predict", data).result(timeout=5)
+
+class TestProfile(WorkerTestCase):
+    def test_idle_profile(self):
+        res = self.dispatcher.control("profile", format="pstats", seconds=0.1).result(timeout=5)
+        self.assertEqual(res["result"]["requests"], 0)
+        self.assertEqual(res["result"]["profile"], "")
+        self.assertEqual(self.predict(1)["result"], 1)
+
+    def test_failing_control_message(self):
+        res = self.dispatcher.control("profile", seconds=[1]).result(timeout=5)
+        self.assertIn("error", res)
+        self.assertEqual(self.predict(1)["result"], 1)
+        self.assertTrue(self.process.is_alive())
+
+class TestTimings(WorkerTestCase):
+    def test_queue_behind_busy_worker(self):
+        first = self.dispatcher.submit("predict", {"number": 1, "sleep": 0.3})
+        second = self.dispatcher.submit("predict", {"number": 2})
+        first_stages = stage_durations(first.result(timeout=5)["timings"])
+        stages = stage_durations(second.result(timeout=5)["timings"])
+        self.assertLess(first_stages["queue"], 0.1)
+        self.assertGreater(stages["queue"], 0.2)
+        for stage in ("ipc", "batch_wait", "preprocess"):
+            self.assertLess(stages[stage], 0.1)
+        self.assertGreater(first_stages["method"], 0.2)
+
+    def test_stage_durations(self):
+        timings = {"submitted": 0.0, "sent": 1.0, "receiving": 3.0, "received": 3.5,
+                   "dequeued": 5.0, "started": 5.25, "preprocess": 0.5, "method": 1.0,
+                   "replied": 7.0, "returned": 7.5}
+        self.assertEqual(stage_durations(timings), {
+            "queue": 3.5, "ipc": 1.0, "batch_wait": 0.25, "preprocess": 0.5, "method": 1.0})
+        # An idle worker is already receiving when the request is sent
+        timings.update({"receiving": 0.5})
+        self.assertEqual(stage_durations(timings)["queue"], 1.5)
+        self.assertEqual(stage_durations(timings)["ipc"], 3.0)
+
+class TestDeadlines(WorkerTestCase):
+    def test_expired(self):
+        res = self.dispatcher.submit("predict", {"number": 1},
+                                     deadline=time.time() - 1).result(timeout=5)
+        self.assertTrue(res["expired"])
+        self.assertEqual(res["error"], "Deadline exceeded")
+
+    def test_cancel(self):
+        first = self.dispatcher.submit("predict", {"number": 1, "sleep": 0.5})
+        second = self.dispatcher.submit("predict", {"number": 2})
+        self.dispatcher.cancel(second)
+        self.assertEqual(first.result(timeout=5)["result"], 1)
+        res = second.result(timeout=5)
+        self.assertTrue(res["cancelled"])
+        self.assertNotIn("result", res)
+
+    def test_timeout(self):
+        model_server.models["EchoModel"] = {"name": "EchoModel"}
+        model_server.dispatchers["EchoModel"] = self.dispatcher
+        try:
+            model_request = ModelRequest("EchoModel", "predict", {"number": 1, "sleep": 1},
+                                         timeout=0.1)
+            self.assertEqual(model_request.run(), (504, {"error": "Deadline exceeded"}))
+        finally:
+            model_server.models.pop("EchoModel")
+            model_server.dispatchers.pop("EchoModel")
+
+class TestBatching(WorkerTestCase):
+    model_conf = {"max_batch_size": 3, "min_batch_time": 200, "max_batch_time": 300}
+
+    def submit_behind(self, requests):
+        """
+        Submits requests for add while the worker is busy, so they are
+        batched from its backlog, returning their responses
+        """
+        busy = self.dispatcher.submit("predict", {"number": 0, "sleep": 0.2})
+        futures = [self.dispatcher.submit("add", request) for request in requests]
+        busy.result(timeout=5)
+        return [future.result(timeout=5) for future in futures]
+
+    def test_max_batch_size(self):
+        responses = self.submit_behind([{"number": number} for number in range(7)])
+        self.assertEqual([res["result"]["number"] for res in responses], list(range(1, 8)))
+        self.assertEqual([res["result"]["batch_size"] for res in responses],
+                         [3, 3, 3, 3, 3, 3, 1])
+
+    def test_response_count_mismatch(self):
+        responses = self.submit_behind([{"number": 1}, {"number": 2, "mismatch": True},
+                                        {"number": 3}])
+        for res in responses:
+            self.assertEqual(res["error"],
+                             "Exception: batch_add returned 2 responses for 3 requests")
+
+    def test_preprocess_failure(self):
+        responses = self.submit_behind([{"number": 1}, {"number": 2, "fail": True},
+                                        {"number": 3}])
+        self.assertEqual(responses[0]["result"], {"number": 2, "batch_size": 2})
+        self.assertEqual(responses[1]["error"], "Exception: Invalid request")
+        self.assertEqual(responses[2]["result"], {"number": 4, "batch_size": 2})
+
+class TestBatchTime(WorkerTestCase):
+    model_conf = {"max_batch_size": 10, "min_batch_time": 200, "max_batch_time": 300}
+
+    def test_max_batch_time(self):
+        # Sets the last arrival, so that the next requests wait for a batch
+        self.dispatcher.submit("add", {"number": 0}).result(timeout=5)
+        futures = []
+        for number in range(8):
+            futures.append(self.dispatcher.submit("add", {"number": number}))
+            time.sleep(0.06)
+        responses = [future.result(timeout=5) for future in futures]
+        self.assertEqual([res["result"]["number"] for res in responses], list(range(1, 9)))
+        sizes = [res["result"]["batch_size"] for res in responses]
+        # Batches of requests arriving 60ms apart are cut off after 300ms
+        self.assertGreater(max(sizes), 1)
+        self.assertLess(max(sizes), 8)
+
+class LazyModelServer(object):
+    load_timings = None
+
+class TestLazyModels(unittest.TestCase):
+    def test_required_memory_per_instance(self):
+        model_conf = {"name": "EchoModel", "required_memory": 2, "workers": 4}
+        model_server.start_workers([(model_conf, LazyModelServer())], None)
+        try:
+            self.assertTrue(model_server.activations.is_lazy("EchoModel"))
+            self.assertEqual(model_server.activations._models["EchoModel"][2],
+                             2 * 1024 ** 3)
+        finally:
+            model_server.models.pop("EchoModel")
+            model_server.activations._models.pop("EchoModel")
+
+class TestLoadModels(unittest.TestCase):
+    def setUp(self):
+        self.resource_dir = tempfile.mkdtemp()
+        self.config = {"models": [
+            {"name": "TestModel", "path": "models.TestModel.TestModel", "methods": ["predict"],
+             "required_resources": {"parameters": os.path.join(TEST_DIR, "parameters.txt")}},
+            {"name": "EchoModel", "path": "models.EchoModel.EchoModel", "methods": ["predict"],
+             "required_resources": {}, "workers": 2}
+        ]}
+
+    def tearDown(self):
+        for name in list(model_server.supervisors):
+            model_server.stop_model(name)
+        model_server.models.clear()
+        del model_server.server_conns[:]
+        shutil.rmtree(self.resource_dir)
+
+    def test_load_models(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            model_servers = model_server.load_models(self.config, TEST_DIR, self.resource_dir)
+        for name in ("TestModel", "EchoModel"):
+            self.assertRegex(output.getvalue(), r"Loaded model %s in [0-9.]+s \(resources" % name)
+        self.assertIn("Loaded 2 model(s)", output.getvalue())
+        self.assertEqual([model["name"] for model, server in model_servers],
+                         ["TestModel", "EchoModel"])
+        for model, server in model_servers:
+            self.assertEqual(sorted(server.load_timings), ["import", "init", "resources"])
+        model_server.start_workers(model_servers, multiprocessing.get_context("fork"))
+        self.assertEqual(len(model_server.dispatchers["EchoModel"].workers), 2)
+        res = model_server.dispatchers["TestModel"].submit(
+            "predict", {"data": {"number": 1}}).result(timeout=5)
+        self.assertEqual(res["result"]["number"], 2)
+        res = model_server.dispatchers["EchoModel"].submit(
+            "predict", {"number": 3}).result(timeout=5)
+        self.assertEqual(res["result"], 3)
+
+class TestBulkRequest(WorkerTestCase):
+    def setUp(self):
+        super(TestBulkRequest, self).setUp()
+        model_server.models["EchoModel"] = {"name": "EchoModel", "max_batch_size": 2}
+        model_server.dispatchers["EchoModel"] = self.dispatcher
+
+    def tearDown(self):
+        model_server.models.pop("EchoModel")
+        model_server.dispatchers.pop("EchoModel")
+        super(TestBulkRequest, self).tearDown()
+
+    def results(self, lines, method="predict"):
+        bulk_request = BulkRequest("EchoModel", method)
+        chunks = bulk_request.iter_results(line.encode("utf-8") for line in lines)
+        return [json.loads(line) for chunk in chunks for line in chunk.decode("utf-8").splitlines()]
+
+    def test_route(self):
+        body = '{"number": 1}\n\nnot json\n{"number": 2, "fail": true}\n{"number": 3}'
+        response = model_server.app.test_client().post("/api/EchoModel/predict/bulk/", data=body)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, model_server.NDJSON_CONTENT_TYPE)
+        results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(results, [{"result": 1}, {"error": "Invalid JSON request"},
+                                   {"error": "Exception: Invalid request"}, {"result": 3}])
+
+    def test_route_unknown_model(self):
+        response = model_server.app.test_client().post("/api/Missing/predict/bulk/", data="{}")
+        self.assertEqual(response.status_code, 404)
+
+    def test_order(self):
+        results = self.results(['{"number": %d}' % number for number in range(9)], method="add")
+        self.assertEqual([res["result"]["number"] for res in results], list(range(1, 10)))
+        self.assertEqual([res["result"]["batch_size"] for res in results], [2] * 8 + [1])
+
+    def test_worker_exit_mid_stream(self):
+        lines = ['{"number": %d}' % number for number in range(8)]
+        bulk_request = BulkRequest("EchoModel", "predict")
+        chunks = bulk_request.iter_results(line.encode("utf-8") for line in lines)
+        results = [json.loads(line) for line in next(chunks).decode("utf-8").splitlines()]
+        self.process.terminate()
+        self.process.join(5)
+        for chunk in chunks:
+            results += [json.loads(line) for line in chunk.decode("utf-8").splitlines()]
+        # Every request is answered, in order, with the batches after the exit failing
+        self.assertEqual(len(results), len(lines))
+        self.assertEqual(results[:2], [{"result": 0}, {"result": 1}])
+        self.assertIn("error", results[-1])
+        for number, res in enumerate(results):
+            self.assertEqual(res.get("result", number), number)
+
+    def test_dispatch_error(self):
+        activations = model_server.activations
+        # A lazy model that never fits in memory
+        model_server.activations = ActivationManager({}, memory_budget=0)
+        model_server.activations.register("EchoModel", None, None, required_memory=1)
+        try:
+            results = self.results(['{"number": 1}', 'not json', '{"number": 2}'])
+        finally:
+            model_server.activations = activations
+        error = {"error": "Not enough memory to load model EchoModel"}
+        self.assertEqual(results, [error, {"error": "Invalid JSON request"}, error])
+
+class Request(object):
+    """
+    A request to the asyncio front end's handler
+    """
+    def __init__(self, path, body, headers=None):
+        self.method = "POST"
+        self.path = path
+        self.headers = headers or {}
+        self._body = body
+
+    async def body(self):
+        return self._body
+
+    async def disconnected(self):
+        await asyncio.sleep(60)
+
+def handle(path, body, headers=None):
+    loop = asyncio.new_event_loop()
+    try:
+        status, headers, body = loop.run_until_complete(
+            model_server.handle_async_request(Request(path, body, headers)))
+    finally:
+        loop.close()
+    return status, json.loads(body.decode("utf-8"))
+
+class TestAsyncHandler(WorkerTestCase):
+    def setUp(self):
+        super(TestAsyncHandler, self).setUp()
+        model_server.models["EchoModel"] = {"name": "EchoModel", "methods": ["predict", "length"]}
+        model_server.dispatchers["EchoModel"] = self.dispatcher
+
+    def tearDown(self):
+        model_server.models.pop("EchoModel")
+        model_server.dispatchers.pop("EchoModel")
+        super(TestAsyncHandler, self).tearDown()
+
+    def test_request(self):
+        status, payload = handle("/api/EchoModel/predict/", b'{"number": 1}')
+        self.assertEqual((status, payload), (200, {"result": 1}))
+        # Any JSON value is passed on to the model
+        status, payload = handle("/api/EchoModel/length/", b'[1, 2, 3]')
+        self.assertEqual((status, payload), (200, {"result": 3}))
+
+    def test_invalid_json(self):
+        status, payload = handle("/api/EchoModel/predict/", b'{"number": ')
+        self.assertEqual((status, payload), (400, {"error": "Data not provided"}))
+
+    def test_invalid_timeout(self):
+        for timeout in ("inf", "1e400", "nan", "0", "-1", "soon"):
+            status, payload = handle("/api/EchoModel/predict/", b'{"data": {}}',
+                                     {"x-request-timeout": timeout})
+            self.assertEqual(status, 400)
+            self.assertEqual(payload, {"error": "Invalid X-Request-Timeout %s" % timeout})
+
+    def test_non_object_profile_parameters(self):
+        model_server.admin_endpoints = True
+        try:
+            status, payload = handle("/admin/profile/EchoModel/", b'[1]')
+        finally:
+            model_server.admin_endpoints = False
+        self.assertEqual(status, 400)
+
+    def test_method_labels(self):
+        handle("/api/EchoModel/predict/", b'{"number": 1}')
+        status, payload = handle("/api/EchoModel/missing_method_1234/", b'{"number": 1}')
+        self.assertEqual(status, 400)
+        metrics = model_server.registry.render()
+        self.assertIn('pressurize_request_seconds_count{model="EchoModel",method="predict",status="200"}',
+                      metrics)
+        self.assertIn('pressurize_request_seconds_count{model="EchoModel",method="unknown",status="400"}',
+                      metrics)
+        self.assertNotIn("missing_method_1234", metrics)
@@ -0,0 +1,347 @@
+# Copyright 2017 Morgan McDermott
+
+import gzip
+import hashlib
+import http.server
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+from pressurize.model.model_server_utils import acquire_resources, parse_s3_url
+from pressurize.model import resource_cache
+from pressurize.model.resource_cache import ResourceCache
+from pressurize.model.resources import Resources, flatten
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class S3StandIn(http.server.BaseHTTPRequestHandler):
+    """
+    Serves HEAD and (ranged) GET requests for path style S3 object urls
+    """
+    objects = {}
+    ranges = []
+    gets = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_object(self, body):
+        data = self.objects.get(self.path.split("?")[0].lstrip("/"))
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Type", "application/xml")
+            error = b"<Error><Code>NoSuchKey</Code><Message>Not found</Message></Error>"
+            self.send_header("Content-Length", str(len(error) if body else 0))
+            self.end_headers()
+            if body:
+                self.wfile.write(error)
+            return
+        start, end = 0, len(data) - 1
+        requested = self.headers.get("Range")
+        if requested and body:
+            self.ranges.append(requested)
+            first, last = requested.split("=")[1].split("-")
+            start, end = int(first), min(int(last or end), end)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", '"%s"' % hashlib.md5(data).hexdigest())
+        self.end_headers()
+        if body:
+            self.wfile.write(data[start:end + 1])
+
+    def do_HEAD(self):
+        self.send_object(False)
+
+    def do_GET(self):
+        self.gets.append(self.path)
+        self.send_object(True)
+
+class TestResources(unittest.TestCase):
+    def setUp(self):
+        for name in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]:
+            os.environ.setdefault(name, "testing")
+        S3StandIn.objects = {
+            "weights/model/large.bin": os.urandom(5 * 1024 * 1024 + 17),
+            "weights/vocab.txt": b"a\nb\nc\n"
+        }
+        S3StandIn.ranges = []
+        S3StandIn.gets = []
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), S3StandIn)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.resource_path = tempfile.mkdtemp()
+        self.config = {
+            "aws_region": "us-west-2",
+            "model_server": {
+                "s3_endpoint_url": "http://127.0.0.1:%d" % self.server.server_address[1],
+                "multipart_chunksize_mb": 1,
+                "resource_cache_dir": os.path.join(self.resource_path, "cache")
+            }
+        }
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.resource_path)
+
+    def test_parse_s3_url(self):
+        self.assertEqual(parse_s3_url("s3://bucket/a/b.txt", "us-west-2"),
+                         ("us-west-2", "bucket", "a/b.txt"))
+        self.assertEqual(parse_s3_url("s3://eu-west-1//bucket//a/b.txt"),
+                         ("eu-west-1", "bucket", "a/b.txt"))
+        self.assertRaises(ValueError, parse_s3_url, "s3://bucket")
+
+    def test_downloads_in_parts(self):
+        model = {"required_resources": {
+            "large": "s3://weights/model/large.bin",
+            "vocab": "s3://weights/vocab.txt",
+            "local": "/data/local.txt"
+        }}
+        resources = acquire_resources(self.config, model, os.path.join(self.resource_path, "Model"))
+        self.assertEqual(resources["local"], "/data/local.txt")
+        for name, key in [("large", "weights/model/large.bin"), ("vocab", "weights/vocab.txt")]:
+            with open(resources[name], "rb") as f:
+                self.assertEqual(f.read(), S3StandIn.objects[key])
+        self.assertEqual(len(S3StandIn.ranges), 6)
+
+    def test_missing_resource(self):
+        model = {"required_resources": {"missing": "s3://weights/missing.bin"}}
+        self.assertRaises(RuntimeError, acquire_resources, self.config, model,
+                          os.path.join(self.resource_path, "Model"))
+
+    def test_cached(self):
+        model = {"required_resources": {"vocab": "s3://weights/vocab.txt"}}
+        first = acquire_resources(self.config, model, os.path.join(self.resource_path, "First"))
+        second = acquire_resources(self.config, model, os.path.join(self.resource_path, "Second"))
+        self.assertEqual(len(S3StandIn.gets), 1)
+        self.assertEqual(os.stat(first["vocab"]).st_ino, os.stat(second["vocab"]).st_ino)
+
+        # A changed object has a new ETag, so it is downloaded again
+        S3StandIn.objects["weights/vocab.txt"] = b"d\n"
+        first = acquire_resources(self.config, model, os.path.join(self.resource_path, "First"))
+        self.assertEqual(len(S3StandIn.gets), 2)
+        with open(first["vocab"], "rb") as f:
+            self.assertEqual(f.read(), b"d\n")
+
+    def archive(self, files):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+            for name, data in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        return buffer.getvalue()
+
+    def test_extracts_archives(self):
+        weights = os.urandom(3 * 1024 * 1024)
+        S3StandIn.objects["weights/bundle.tar.gz"] = self.archive({
+            "bundle/weights.bin": weights, "bundle/vocab.txt": b"a\nb\n"})
+        S3StandIn.objects["weights/table.csv.gz"] = gzip.compress(b"1,2\n")
+        model = {"extract_resources": True, "required_resources": {
+            "bundle": "s3://weights/bundle.tar.gz",
+            "table": "s3://weights/table.csv.gz",
+            "vocab": "s3://weights/vocab.txt"
+        }}
+        resources = acquire_resources(self.config, model, os.path.join(self.resource_path, "Model"))
+        self.assertTrue(resources["bundle"].endswith(os.path.join("bundle", "bundle")))
+        with open(os.path.join(resources["bundle"], "bundle", "weights.bin"), "rb") as f:
+            self.assertEqual(f.read(), weights)
+        with open(resources["table"], "rb") as f:
+            self.assertEqual(f.read(), b"1,2\n")
+        self.assertTrue(os.path.isfile(resources["vocab"]))
+        # Archives are streamed with ranged GETs rather than downloaded
+        self.assertTrue(S3StandIn.ranges)
+
+        gets = len(S3StandIn.gets)
+        again = acquire_resources(self.config, model, os.path.join(self.resource_path, "Other"))
+        self.assertEqual(len(S3StandIn.gets), gets)
+        self.assertTrue(os.path.isfile(os.path.join(again["bundle"], "bundle", "vocab.txt")))
+
+    def test_rejects_unsafe_archives(self):
+        S3StandIn.objects["weights/unsafe.tar.gz"] = self.archive({"../escape.txt": b"x"})
+        model = {"extract_resources": ["unsafe"],
+                 "required_resources": {"unsafe": "s3://weights/unsafe.tar.gz"}}
+        self.assertRaises(Exception, acquire_resources, self.config, model,
+                          os.path.join(self.resource_path, "Model"))
+        self.assertFalse(os.path.exists(os.path.join(self.resource_path, "Model", "escape.txt")))
+        self.assertFalse(os.path.exists(os.path.join(self.resource_path, "Model", "unsafe")))
+
+    def test_lazy_resources(self):
+        model = {"lazy_resources": ["vocab", "large"], "required_resources": {
+            "large": "s3://weights/model/large.bin",
+            "vocab": "s3://weights/vocab.txt"
+        }}
+        resources = acquire_resources(self.config, model, os.path.join(self.resource_path, "Model"))
+        self.assertEqual(S3StandIn.gets, [])
+        self.assertEqual(sorted(resources), ["large", "vocab"])
+
+        paths = []
+        threads = [threading.Thread(target=lambda: paths.append(resources["vocab"]))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(paths)), 1)
+        self.assertEqual(len(S3StandIn.gets), 1)
+        self.assertEqual(resources.deferred(), ["large"])
+
+        resources.prefetch().join()
+        self.assertEqual(resources.deferred(), [])
+        with open(resources.get("large"), "rb") as f:
+            self.assertEqual(f.read(), S3StandIn.objects["weights/model/large.bin"])
+
+    def test_evicts_least_recently_used(self):
+        cache = ResourceCache(os.path.join(self.resource_path, "cache"), max_size=12)
+
+        def fetch(data):
+            def download(path):
+                with open(path, "wb") as f:
+                    f.write(data)
+            return download
+        for idx, etag in enumerate(["a", "b", "c"]):
+            cache.get(etag, 6, os.path.join(self.resource_path, etag), fetch(b"x" * 6))
+            os.utime(cache.path(etag, 6), (idx, idx))
+        self.assertEqual(cache.evict(keep=[cache.path("a", 6)]), 1)
+        self.assertFalse(os.path.exists(cache.path("b", 6)))
+        cache.max_size = 6
+        self.assertEqual(cache.evict(), 1)
+        self.assertFalse(os.path.exists(cache.path("a", 6)))
+        self.assertEqual(cache.size(), 6)
+        self.assertTrue(cache.get("c", 6, os.path.join(self.resource_path, "c"), None))
+        # Only the lock files of cached objects are kept
+        self.assertEqual(os.listdir(os.path.join(cache.root, "locks")),
+                         [cache.digest("c", 6)])
+
+    def test_evict_skips_removed_objects(self):
+        cache = ResourceCache(os.path.join(self.resource_path, "cache"), max_size=0)
+        for etag in ("a", "b"):
+            cache.get(etag, 1, os.path.join(self.resource_path, etag), self.write(b"x"))
+        tree_size = resource_cache.tree_size
+
+        def evicted_elsewhere(path):
+            # Another process evicts the other object after they are listed
+            for etag in ("a", "b"):
+                if path != cache.path(etag, 1) and os.path.exists(cache.path(etag, 1)):
+                    os.remove(cache.path(etag, 1))
+            return tree_size(path)
+        resource_cache.tree_size = evicted_elsewhere
+        try:
+            self.assertEqual(cache.evict(), 1)
+        finally:
+            resource_cache.tree_size = tree_size
+        self.assertEqual(os.listdir(os.path.join(cache.root, "objects")), [])
+
+    def write(self, data):
+        def download(path):
+            with open(path, "wb") as f:
+                f.write(data)
+        return download
+
+    def test_sweeps_stale_partials(self):
+        cache = ResourceCache(os.path.join(self.resource_path, "cache"), partial_max_age=60)
+        partials = {}
+        for name in ("stale", "fresh", "downloading"):
+            partials[name] = "%s.1.1.partial" % cache.path(name, 1)
+            with open(partials[name], "wb") as f:
+                f.write(b"x")
+            if name != "fresh":
+                os.utime(partials[name], (0, 0))
+        lock = cache._lock(cache.digest("downloading", 1))
+        try:
+            cache.evict()
+        finally:
+            lock.close()
+        self.assertFalse(os.path.exists(partials["stale"]))
+        self.assertTrue(os.path.exists(partials["fresh"]))
+        self.assertTrue(os.path.exists(partials["downloading"]))
+        self.assertNotIn(cache.digest("stale", 1), os.listdir(os.path.join(cache.root, "locks")))
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestMappedResources(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_memmap(self):
+        array = numpy.arange(12, dtype=numpy.float32).reshape(3, 4)
+        numpy.save(os.path.join(self.path, "table.npy"), array)
+        with open(os.path.join(self.path, "raw.bin"), "wb") as f:
+            f.write(array.tobytes())
+        resources = Resources(table=os.path.join(self.path, "table.npy"),
+                              raw=os.path.join(self.path, "raw.bin"))
+        mapped = resources.memmap("table")
+        self.assertIsInstance(mapped, numpy.memmap)
+        self.assertFalse(mapped.flags.writeable)
+        numpy.testing.assert_array_equal(mapped, array)
+        numpy.testing.assert_array_equal(resources.memmap("raw", numpy.float32, (3, 4)), array)
+        self.assertIs(resources.mmap("raw"), resources.mmap("raw"))
+        self.assertEqual(resources.mmap("raw")[:4], array.tobytes()[:4])
+
+    def test_deferred(self):
+        array = numpy.arange(6, dtype=numpy.int64)
+        numpy.save(os.path.join(self.path, "ids.npy"), array)
+        with open(os.path.join(self.path, "raw.bin"), "wb") as f:
+            f.write(b"abcd")
+        resources = Resources()
+        resources.defer("ids", lambda: os.path.join(self.path, "ids.npy"))
+        resources.defer("raw", lambda: os.path.join(self.path, "raw.bin"))
+        results = {}
+        thread = threading.Thread(target=lambda: results.update(
+            raw=resources.mmap("raw")[:], ids=resources.memmap("ids")))
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(results["raw"], b"abcd")
+        numpy.testing.assert_array_equal(results["ids"], array)
+        self.assertEqual(resources.deferred(), [])
+
+    def test_flatten(self):
+        glove = os.path.join(self.path, "glove.txt")
+        with open(glove, "w") as f:
+            f.write("the 0.5 1.5\ncat -1 2\n")
+        paths = flatten(glove)
+        with open(paths["vocab"]) as f:
+            self.assertEqual(f.read().split(), ["the", "cat"])
+        vectors = Resources(vectors=paths["vectors"]).memmap("vectors")
+        self.assertEqual(vectors.dtype, numpy.float32)
+        numpy.testing.assert_array_equal(vectors, [[0.5, 1.5], [-1, 2]])
+
+        arrays = os.path.join(self.path, "arrays.npz")
+        numpy.savez(arrays, a=numpy.ones(3), b=numpy.zeros((2, 2)))
+        paths = flatten(arrays, dtype="float32")
+        self.assertEqual(sorted(paths), ["a", "b"])
+        self.assertEqual(numpy.load(paths["b"], mmap_mode="r").dtype, numpy.float32)
+
+        word2vec = os.path.join(self.path, "word2vec.txt")
+        with open(word2vec, "w") as f:
+            f.write("2 2\nthe 0.5 1.5\ncat -1 2\n")
+        paths = flatten(word2vec)
+        with open(paths["vocab"]) as f:
+            self.assertEqual(f.read().split(), ["the", "cat"])
+        numpy.testing.assert_array_equal(numpy.load(paths["vectors"]), [[0.5, 1.5], [-1, 2]])
+
+        # Tables of two numeric columns are not mistaken for a word2vec header
+        for name, text in (("floats.txt", "1.0 2.0\n3.0 4.0\n5.0 6.0\n"),
+                           ("ints.txt", "1 2\n3 4\n5 6\n")):
+            numeric = os.path.join(self.path, name)
+            with open(numeric, "w") as f:
+                f.write(text)
+            numpy.testing.assert_array_equal(numpy.load(flatten(numeric)),
+                                             [[1, 2], [3, 4], [5, 6]])
+
+        table = os.path.join(self.path, "table.csv")
+        with open(table, "w") as f:
+            f.write("1,2\n3,4\n")
+        numpy.testing.assert_array_equal(numpy.load(flatten(table)), [[1, 2], [3, 4]])
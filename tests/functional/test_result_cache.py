@@ -0,0 +1,48 @@
+# Copyright 2017 Morgan McDermott
+
+import unittest
+import time
+from pressurize.model.cache import ResultCache, request_key
+
+class TestResultCache(unittest.TestCase):
+    def test_request_key_is_canonical(self):
+        self.assertEqual(request_key({"data": {"a": 1, "b": 2}}),
+                         request_key({"data": {"b": 2, "a": 1}}))
+        self.assertNotEqual(request_key({"data": {"a": 1}}),
+                            request_key({"data": {"a": 2}}))
+
+    def test_hits_and_misses(self):
+        cache = ResultCache(1024)
+        self.assertEqual(cache.get("a"), (False, None))
+        cache.put("a", {"number": 1})
+        self.assertEqual(cache.get("a"), (True, {"number": 1}))
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["bytes"], len('{"number":1}'))
+
+    def test_evicts_least_recently_used(self):
+        cache = ResultCache(30)
+        cache.put("a", "x" * 10)
+        cache.put("b", "x" * 10)
+        cache.get("a")
+        cache.put("c", "x" * 10)
+        self.assertTrue(cache.get("a")[0])
+        self.assertFalse(cache.get("b")[0])
+        self.assertTrue(cache.get("c")[0])
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertTrue(cache.stats()["bytes"] <= 30)
+
+    def test_oversized_results_are_not_cached(self):
+        cache = ResultCache(10)
+        cache.put("a", "x" * 100)
+        self.assertFalse(cache.get("a")[0])
+
+    def test_entries_expire(self):
+        cache = ResultCache(1024, ttl=0.05)
+        cache.put("a", 1)
+        self.assertTrue(cache.get("a")[0])
+        time.sleep(0.1)
+        self.assertFalse(cache.get("a")[0])
+        self.assertEqual(cache.stats()["expirations"], 1)
+        self.assertEqual(cache.stats()["bytes"], 0)
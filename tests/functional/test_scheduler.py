@@ -0,0 +1,42 @@
+# Copyright 2017 Morgan McDermott
+
+import unittest
+from pressurize.model.scheduler import RequestQueue, priority_class
+
+def request(name, priority=0, caller=None, method="predict"):
+    return {"name": name, "priority": priority, "caller": caller, "method": method}
+
+class TestRequestQueue(unittest.TestCase):
+    def drain(self, queue):
+        return [queue.popleft()["name"] for _ in range(len(queue))]
+
+    def test_strict_priority(self):
+        queue = RequestQueue()
+        queue.append(request("batch", priority=1))
+        queue.append(request("interactive", priority=0))
+        queue.append({"control": "profile", "name": "control"})
+        self.assertEqual(self.drain(queue), ["control", "interactive", "batch"])
+
+    def test_weighted_fair_queuing(self):
+        queue = RequestQueue(weights={"web": 2})
+        for idx in range(4):
+            queue.append(request("backfill%d" % idx, caller="backfill"))
+        for idx in range(4):
+            queue.append(request("web%d" % idx, caller="web"))
+        self.assertEqual(self.drain(queue)[:6],
+                         ["web0", "backfill0", "web1", "web2", "backfill1", "web3"])
+
+    def test_take(self):
+        queue = RequestQueue()
+        queue.append(request("a", priority=1))
+        queue.append(request("b", method="other"))
+        queue.append(request("c"))
+        taken = queue.take(lambda item: item["method"] == "predict", 10)
+        self.assertEqual([item["name"] for item in taken], ["c", "a"])
+        self.assertEqual(self.drain(queue), ["b"])
+
+    def test_priority_class(self):
+        self.assertEqual(priority_class("batch"), 1)
+        self.assertEqual(priority_class(None, default=1), 1)
+        self.assertEqual(priority_class("3"), 3)
+        self.assertRaises(ValueError, priority_class, "urgent")
@@ -0,0 +1,61 @@
+# Copyright 2017 Morgan McDermott
+
+import multiprocessing
+import os
+import signal
+import time
+import unittest
+from pressurize.model.dispatcher import ModelDispatcher, DispatchError
+from pressurize.model.supervisor import Supervisor
+
+context = multiprocessing.get_context("fork")
+
+def echo(conn, parent_conn):
+    parent_conn.close()
+    while True:
+        item = conn.recv()
+        time.sleep(item["data"].get("sleep", 0))
+        conn.send({"resId": item["resId"], "result": item["data"], "pid": os.getpid()})
+
+def spawn():
+    server_conn, worker_conn = context.Pipe()
+    process = context.Process(target=echo, args=(worker_conn, server_conn))
+    process.daemon = True
+    process.start()
+    worker_conn.close()
+    return process, server_conn
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        process, conn = spawn()
+        self.dispatcher = ModelDispatcher("TestModel", [conn])
+        self.supervisor = Supervisor(self.dispatcher, spawn, [process], [spawn()],
+                                     worker_timeout=1)
+
+    def tearDown(self):
+        for process in self.supervisor.processes + [spare[0] for spare in self.supervisor.spares]:
+            process.kill()
+
+    def test_replaces_dead_worker(self):
+        first = self.dispatcher.submit("predict", {}).result(timeout=5)["pid"]
+        spare = self.supervisor.spares[0][0].pid
+        future = self.dispatcher.submit("predict", {"sleep": 10})
+        os.kill(first, signal.SIGKILL)
+        self.assertRaises(DispatchError, future.result, 5)
+        self.supervisor.check()
+        self.assertEqual(self.supervisor.restarts, 1)
+        self.assertEqual(self.dispatcher.submit("predict", {}).result(timeout=5)["pid"], spare)
+        # The worker died young, so its spare is only replaced after a delay
+        self.assertEqual(len(self.supervisor.spares), 0)
+        time.sleep(1.1)
+        self.supervisor.check()
+        self.assertEqual(len(self.supervisor.spares), 1)
+
+    def test_kills_hung_worker(self):
+        future = self.dispatcher.submit("predict", {"sleep": 10})
+        time.sleep(1.5)
+        self.supervisor.check()
+        self.assertRaises(DispatchError, future.result, 5)
+        self.assertEqual(self.supervisor.restarts, 1)
+        self.assertEqual(self.dispatcher.submit("predict", {"ok": 1}).result(timeout=5)["result"],
+                         {"ok": 1})
@@ -0,0 +1,92 @@
+# Copyright 2017 Morgan McDermott
+
+import pickle
+import threading
+import unittest
+from multiprocessing import Pipe
+from pressurize.model import transport
+from pressurize.model.transport import SharedMemoryConnection
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+@unittest.skipUnless(transport.SHARED_MEMORY_SUPPORTED, "Shared memory is not supported")
+class TestSharedMemoryConnection(unittest.TestCase):
+    def setUp(self):
+        self.conns = []
+
+    def tearDown(self):
+        for conn in self.conns:
+            conn.close()
+
+    def round_trip(self, obj, threshold=transport.DEFAULT_THRESHOLD):
+        """
+        Sends `obj` across a pipe, returning what was received and whether it
+        went through shared memory
+        """
+        sender, receiver = [SharedMemoryConnection(conn, threshold) for conn in Pipe()]
+        self.conns += [sender, receiver]
+        # Sent from another thread, as messages through the pipe may not fit its buffer
+        thread = threading.Thread(target=sender.send, args=(obj,))
+        thread.start()
+        received = receiver.recv()
+        thread.join()
+        # The socket used to pass file descriptors is only created when needed
+        return received, receiver._sock is not None
+
+    def test_threshold(self):
+        obj = {"data": pickle.PickleBuffer(bytearray(b"x" * 4096)), "name": "x" * 4096}
+        # Only out-of-band buffers count towards the threshold
+        received, shared = self.round_trip(obj, threshold=4097)
+        self.assertEqual(bytes(received["data"]), b"x" * 4096)
+        self.assertFalse(shared)
+        received, shared = self.round_trip(obj, threshold=4096)
+        self.assertEqual(bytes(received["data"]), b"x" * 4096)
+        self.assertTrue(shared)
+
+    def test_in_band_messages(self):
+        # Bytes and JSON-like objects gain nothing from shared memory
+        for obj in [b"x" * (transport.DEFAULT_THRESHOLD * 2),
+                    {"data": [1.5] * transport.DEFAULT_THRESHOLD}]:
+            received, shared = self.round_trip(obj)
+            self.assertEqual(received, obj)
+            self.assertFalse(shared)
+
+    def test_out_of_band_buffers(self):
+        obj = [pickle.PickleBuffer(bytearray(b"%d" % idx) * 1000) for idx in range(3)]
+        received, shared = self.round_trip(obj, threshold=0)
+        self.assertTrue(shared)
+        # Out-of-band buffers are views of the shared mapping
+        self.assertEqual([bytes(buf) for buf in received], [bytes(buf.raw()) for buf in obj])
+        self.assertIsInstance(received[0], memoryview)
+
+    def test_more_buffers_than_iov_max(self):
+        obj = [pickle.PickleBuffer(bytearray(b"%8d" % idx)) for idx in range(transport.IOV_MAX * 2 + 1)]
+        received, shared = self.round_trip(obj, threshold=0)
+        self.assertTrue(shared)
+        self.assertEqual([bytes(buf) for buf in received], [bytes(buf.raw()) for buf in obj])
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_numpy_arrays(self):
+        obj = {"matrix": numpy.arange(512 * 1024, dtype=numpy.float64).reshape(512, 1024),
+               "vector": numpy.arange(10, dtype=numpy.int32)}
+        received, shared = self.round_trip(obj)
+        self.assertTrue(shared)
+        for name in obj:
+            self.assertTrue(numpy.array_equal(received[name], obj[name]))
+            self.assertEqual(received[name].dtype, obj[name].dtype)
+        # Received arrays are copy-on-write, leaving the sender's data alone
+        received["matrix"][0, 0] = -1
+        self.assertEqual(obj["matrix"][0, 0], 0)
+
+    def test_pipe_fallback(self):
+        transport.SHARED_MEMORY_SUPPORTED = False
+        try:
+            obj = {"data": b"x" * (transport.DEFAULT_THRESHOLD * 2)}
+            received, shared = self.round_trip(obj, threshold=0)
+        finally:
+            transport.SHARED_MEMORY_SUPPORTED = True
+        self.assertEqual(received, obj)
+        self.assertFalse(shared)
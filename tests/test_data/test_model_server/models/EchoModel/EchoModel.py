@@ -0,0 +1,27 @@
+import time
+
+from pressurize.model import PressurizeModel
+
+class EchoModel(PressurizeModel):
+    def preprocess(self, request):
+        if isinstance(request, dict) and request.get("fail"):
+            raise ValueError("Invalid request")
+        return request
+
+    def predict(self, request):
+        time.sleep(request.get("sleep", 0))
+        return request["number"]
+
+    def length(self, request):
+        return len(request)
+
+    def add(self, request):
+        return {"number": request["number"] + 1, "batch_size": 1}
+
+    def batch_add(self, batch):
+        requests = batch["requests"]
+        responses = [{"number": request["number"] + 1, "batch_size": len(requests)}
+                     for request in requests]
+        if any(request.get("mismatch") for request in requests):
+            responses.pop()
+        return {"responses": responses}